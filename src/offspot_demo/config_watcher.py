@@ -4,6 +4,7 @@ import argparse
 import re
 import sys
 from pathlib import Path
+from typing import Any
 
 import requests
 
@@ -12,9 +13,16 @@ from offspot_demo.constants import (
     DEFAULT_HTTP_TIMEOUT_SECONDS,
     MULTI_CONFIG_URL,
     OFFSPOT_CONFIGURATION,
+    OFFSPOT_DEMOS_CONFIG_PATH,
 )
 from offspot_demo.utils import fail, is_root
-from offspot_demo.utils.yaml import yaml_load
+from offspot_demo.utils.config_diff import diff_demos, record_changes
+from offspot_demo.utils.deployment import (
+    Deployment,
+    load_demos_settings,
+    load_deployments,
+)
+from offspot_demo.utils.yaml import yaml_dump, yaml_load
 
 RE_ENVIRON = re.compile(
     r"^(?P<name>[A-Za-z0-9\_]+)=([\"\']?)(?P<value>[^\"\']+)([\"\']?)$"
@@ -60,6 +68,31 @@ def save_environ(environ: dict[str, str], fpath: Path):
     fpath.write_text("\n".join(new_lines))
 
 
+def load_configured_deployments() -> dict[str, Deployment]:
+    """deployments from current config files (as config changes while we run)"""
+    return load_deployments(
+        [
+            entry
+            for entry in load_environ(OFFSPOT_CONFIGURATION)
+            .get("OFFSPOT_DEMOS_LIST", "")
+            .split(",")
+            if entry.strip()
+        ],
+        load_demos_settings(),
+    )
+
+
+def get_previous_demos(environ: dict[str, str]) -> list[dict[str, Any]]:
+    """demos entries from the previous config copy (or environ if missing)"""
+    if OFFSPOT_DEMOS_CONFIG_PATH.exists():
+        return list(load_demos_settings(OFFSPOT_DEMOS_CONFIG_PATH).values())
+    return [
+        dict(zip(("ident", "alias", "name"), entry.split(":", 3)[:3], strict=False))
+        for entry in environ.get("OFFSPOT_DEMOS_LIST", "").split(",")
+        if entry.strip()
+    ]
+
+
 def check_and_record():
     """Check if a new image has to be deployed, and deploy it"""
     if not is_root():
@@ -77,6 +110,24 @@ def check_and_record():
     )
 
     environ = load_environ(OFFSPOT_CONFIGURATION)
+
+    # per-demo changes are recorded for update-watcher to act upon
+    changes = diff_demos(previous=get_previous_demos(environ), current=payload["demos"])
+    for change in changes.values():
+        logger.info(f"> [{change.ident}] {change.kind} {','.join(change.fields)}")
+    if changes:
+        record_changes(changes)
+
+    # per-demo settings (resources) are read from a local copy of the config
+    demos_config = yaml_dump({"demos": payload["demos"]})
+    if (
+        not OFFSPOT_DEMOS_CONFIG_PATH.exists()
+        or OFFSPOT_DEMOS_CONFIG_PATH.read_text() != demos_config
+    ):
+        logger.info(f"> Recording demos config to {OFFSPOT_DEMOS_CONFIG_PATH}")
+        OFFSPOT_DEMOS_CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        OFFSPOT_DEMOS_CONFIG_PATH.write_text(demos_config)
+
     if environ["OFFSPOT_DEMOS_LIST"] == demos_conf:
         logger.info("> No change, exiting.")
         return 0
@@ -2,12 +2,14 @@ import enum
 import os
 from pathlib import Path
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-
 # general, machine-specific
 OFFSPOT_CONFIGURATION = Path(
     os.getenv("OFFSPOT_CONFIGURATION") or "/etc/demo/environment"
 )
+# local copy of the demos YAML config (for per-demo settings)
+OFFSPOT_DEMOS_CONFIG_PATH = Path(
+    os.getenv("OFFSPOT_DEMOS_CONFIG_PATH") or "/etc/demo/demos.yaml"
+)
 OFFSPOT_DEMO_MAIN_FQDN = os.getenv("OFFSPOT_DEMO_FQDN", "")
 OFFSPOT_DEMOS_LIST = [
     entry
@@ -23,21 +25,76 @@ OFFSPOT_DEMO_TARGET_ROOT_DIR = Path(
 OFFSPOT_DEMO_COMPOSE_ROOT_DIR = Path(
     os.getenv("OFFSPOT_DEMO_COMPOSE_ROOT_DIR") or "/data/demo/compose"
 )
+# tool's own state (pending changes, etc)
+OFFSPOT_DEMO_STATE_DIR = Path(os.getenv("OFFSPOT_DEMO_STATE_DIR") or "/data/demo/state")
 OFFSPOT_DEMO_TLS_EMAIL = os.getenv("OFFSPOT_DEMO_TLS_EMAIL", "dev@kiwix.org")
 
+# disk space (GiB) all demos' previous images kept for rollback can use
+OFFSPOT_DEMO_ROLLBACK_BUDGET_GIB = int(
+    os.getenv("OFFSPOT_DEMO_ROLLBACK_BUDGET_GIB") or "100"
+)
+
+# seconds without request after which a demo is stopped (0 disables hibernation)
+OFFSPOT_DEMO_IDLE_TIMEOUT = int(os.getenv("OFFSPOT_DEMO_IDLE_TIMEOUT") or "0")
+# address multi-proxy reaches the host (demos, demo-waker) on
+OFFSPOT_DEMO_HOST_IP = os.getenv("OFFSPOT_DEMO_HOST_IP") or "127.0.0.1"
+# port demo-waker listens on (on OFFSPOT_DEMO_HOST_IP)
+OFFSPOT_DEMO_WAKER_PORT = int(os.getenv("OFFSPOT_DEMO_WAKER_PORT") or "8090")
+# shared with multi-proxy, which sends it to demo-waker (required)
+OFFSPOT_DEMO_WAKER_TOKEN = os.getenv("OFFSPOT_DEMO_WAKER_TOKEN") or ""
+# demo-reconciler's trigger endpoint (disabled without a token)
+OFFSPOT_DEMO_TRIGGER_HOST = os.getenv("OFFSPOT_DEMO_TRIGGER_HOST") or "127.0.0.1"
+OFFSPOT_DEMO_TRIGGER_PORT = int(os.getenv("OFFSPOT_DEMO_TRIGGER_PORT") or "8091")
+OFFSPOT_DEMO_TRIGGER_TOKEN = os.getenv("OFFSPOT_DEMO_TRIGGER_TOKEN") or ""
+
+# seconds external commands (docker compose, systemctl…) and image downloads
+# (aria2c) may run before being terminated
+OFFSPOT_DEMO_COMMAND_TIMEOUT = int(os.getenv("OFFSPOT_DEMO_COMMAND_TIMEOUT") or "1800")
+OFFSPOT_DEMO_DOWNLOAD_TIMEOUT = int(
+    os.getenv("OFFSPOT_DEMO_DOWNLOAD_TIMEOUT") or "21600"
+)
+
+# seconds an operation on a demo waits for another one on it to complete
+OFFSPOT_DEMO_LOCK_TIMEOUT = int(os.getenv("OFFSPOT_DEMO_LOCK_TIMEOUT") or "1800")
+
+# demos' jobs run concurrently by update-watcher (and demo-reconciler)
+OFFSPOT_DEMO_MAX_PARALLEL_JOBS = int(os.getenv("OFFSPOT_DEMO_MAX_PARALLEL_JOBS") or "4")
+# concurrent uses of each shared resource (network, disk, mount, docker), as
+# `stage=limit,…` ; unset stages use defaults (network=2,disk=1,mount=1,docker=2)
+OFFSPOT_DEMO_STAGE_LIMITS = os.getenv("OFFSPOT_DEMO_STAGE_LIMITS", "")
+
+# demo-reconciler: seconds between checks of a demo (backing off up to 4 times as
+# long while it doesn't change) and between fetches of the online demos config
+OFFSPOT_DEMO_RECONCILE_INTERVAL = int(
+    os.getenv("OFFSPOT_DEMO_RECONCILE_INTERVAL") or "900"
+)
+OFFSPOT_DEMO_CONFIG_INTERVAL = int(os.getenv("OFFSPOT_DEMO_CONFIG_INTERVAL") or "300")
+
+# minimum seconds between two host-wide docker garbage collections (demo-gc)
+OFFSPOT_DEMO_GC_MIN_INTERVAL = int(os.getenv("OFFSPOT_DEMO_GC_MIN_INTERVAL") or "21600")
+
+# resources profile applied to demos not specifying one
+OFFSPOT_DEMO_RESOURCE_PROFILE = os.getenv("OFFSPOT_DEMO_RESOURCE_PROFILE") or "default"
+
+IMAGER_SERVICE_API_URL = (
+    os.getenv("IMAGER_SERVICE_API_URL") or "https://api.imager.kiwix.org"
+)
 IMAGER_SERVICE_API_USERNAME = os.getenv("IMAGER_SERVICE_API_USERNAME") or ""
 IMAGER_SERVICE_API_PASSWORD = os.getenv("IMAGER_SERVICE_API_PASSWORD") or ""
 
+# docker daemon's API socket (scripts talk to the Engine API directly)
+DOCKER_SOCKET_PATH = Path(
+    os.getenv("OFFSPOT_DEMO_DOCKER_SOCKET") or "/var/run/docker.sock"
+)
 # Default timeout of HTTP requests made by the scripts
 DEFAULT_HTTP_TIMEOUT_SECONDS = 30
-# maintenance container and images must be labeled with this
-# in order not to be purged by deploy
-DOCKER_LABEL_MAINT = "maintenance"
 OCI_PLATFORM = os.getenv("OFFSPOT_DEMO_OCI_PLATFORM", "linux/amd64")
-# Expected duration for the service startup ; scripts use this to pause and check that
-# service is still up after this duration
-STARTUP_DURATION = int(os.getenv("STARTUP_DURATION") or "10")
+# Maximum duration for the service startup ; scripts wait up to this for the demo
+# to serve before considering it failed
+STARTUP_DURATION = int(os.getenv("STARTUP_DURATION") or "60")
 SRC_PATH = Path(__file__).parent
+# rewrite rules applied to image's compose services by prepare
+COMPOSE_RULES_PATH = SRC_PATH / "compose-rules.yaml"
 
 SYSTEMD_UNITS_PATH = Path("/etc/systemd/system/")
 SYSTEMD_OFFSPOT_UNIT_NAME = "demo-offspot"
@@ -48,9 +105,6 @@ MULTI_CONFIG_URL = (
     or "https://raw.githubusercontent.com/offspot/demo/main/demos.yaml"
 )
 
-JINJA_ENV = Environment(
-    loader=FileSystemLoader(Path(__file__).parent), autoescape=select_autoescape()
-)
 DEBUG: bool = bool(os.getenv("DEBUG") or "")
 
 
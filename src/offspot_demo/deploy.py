@@ -13,7 +13,6 @@ import http
 import logging
 import shutil
 import sys
-from contextlib import ExitStack
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from typing import NamedTuple
@@ -23,13 +22,34 @@ import requests
 from offspot_demo import logger
 from offspot_demo.constants import (
     DEFAULT_HTTP_TIMEOUT_SECONDS,
-    DOCKER_LABEL_MAINT,
+    OFFSPOT_DEMO_DOWNLOAD_TIMEOUT,
+    OFFSPOT_DEMO_IMAGES_ROOT_DIR,
+    OFFSPOT_DEMO_ROLLBACK_BUDGET_GIB,
     Mode,
 )
 from offspot_demo.prepare import prepare_for
-from offspot_demo.toggle import toggle_demo
-from offspot_demo.utils import fail, is_root
-from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
+from offspot_demo.toggle import get_mode, toggle_demo
+from offspot_demo.utils import (
+    describe_failures,
+    fail,
+    is_root,
+    recording_failures,
+    state,
+)
+from offspot_demo.utils.deployment import (
+    DEPLOYMENTS,
+    MAX_REPLICAS,
+    SLOTS,
+    Deployment,
+    get_active_slot,
+)
+from offspot_demo.utils.docker import (
+    get_compose_images,
+    is_demo_healthy,
+    remove_stopped_containers,
+    remove_unused_images,
+    stop_demo,
+)
 from offspot_demo.utils.image import (
     attach_to_device,
     detach_device,
@@ -39,7 +59,16 @@ from offspot_demo.utils.image import (
     mount_on,
     unmount,
 )
+from offspot_demo.utils.locks import (
+    LOOP_DEVICES,
+    RESOURCE_LOCK_TIMEOUT,
+    lock,
+    locking_demo,
+)
+from offspot_demo.utils.multiproxy import reconfigure_multiproxy
 from offspot_demo.utils.process import run_command
+from offspot_demo.utils.readiness import wait_until_served
+from offspot_demo.utils.scheduler import stage
 
 ONE_MIB = 2**20
 
@@ -50,33 +79,18 @@ def is_url_correct(url: str) -> bool:
         return resp.status_code == http.HTTPStatus.OK
 
 
-def prune_docker():
-    """Remove all containers and images not associated with maintenance mode"""
-    # purge all containers except maint-labeled ones
-    if run_command(
-        [
-            "/usr/bin/docker",
-            "container",
-            "prune",
-            "--force",
-            "--filter",
-            f"label!={DOCKER_LABEL_MAINT}",
-        ]
-    ).returncode:
-        logger.warning("Failed to prune containers")
-
-    # purge all containers except maint-labeled ones
-    if run_command(
-        [
-            "/usr/bin/docker",
-            "image",
-            "prune",
-            "--force",
-            "--filter",
-            f"label!={DOCKER_LABEL_MAINT}",
-        ]
-    ).returncode:
-        logger.warning("Failed to prune images")
+def cleanup_docker_for(deployment: Deployment):
+    """remove leftover containers of the demo's compose projects (all slots)
+
+    host-wide pruning is left to the (rate-limited) demo-gc"""
+    removed = sum(
+        remove_stopped_containers(
+            deployment.in_slot(slot).in_replica(replica).compose_project
+        )
+        for slot in SLOTS
+        for replica in range(MAX_REPLICAS)
+    )
+    logger.debug(f"Removed {removed} stopped containers")
 
 
 class S3CompatibleETag(NamedTuple):
@@ -178,16 +192,23 @@ def download_file_into(url: str, dest: Path, digest: S3CompatibleETag) -> int:
         if digest.is_singlepart:
             args += ["--checksum", digest.checksum]
         args += [url]
-        aria2 = run_command(args, quiet=False)
+        with stage("network"):
+            aria2 = run_command(
+                args,
+                quiet=False,
+                timeout=OFFSPOT_DEMO_DOWNLOAD_TIMEOUT,
+                failsafe=True,
+            )
 
-        if aria2.returncode != 0:
-            logger.error("Failed to download with aria2c: {aria2.returncode}")
-            return aria2.returncode
+        if aria2.returncode != 0 or aria2.timed_out:
+            logger.error(f"Failed to download with aria2c: {aria2.returncode}")
+            return aria2.returncode or 1
 
         if digest.is_multipart:
             logger.info(">> verify checksum…")
 
-            computed = compute_s3etag_for(fpath=tmp_dest, digest=digest)
+            with stage("disk"):
+                computed = compute_s3etag_for(fpath=tmp_dest, digest=digest)
             if computed != digest.etag:
                 logger.error(
                     f"MD5 checksum validation failed: {computed=} != {digest.etag}"
@@ -201,20 +222,7 @@ def download_file_into(url: str, dest: Path, digest: S3CompatibleETag) -> int:
     return 0
 
 
-def reconfigure_multiproxy():
-    """request multi-proxy to regenerate+refresh its Caddy configuration and homepage
-    based on current list of deployments"""
-    demos_str = ",".join(
-        f"{depl.ident}:{depl.alias}:{depl.name}:{'|'.join(depl.subdomains)}"
-        for depl in DEPLOYMENTS.values()
-    )
-    run_command(
-        ["docker", "exec", "multi-proxy", "gen-server", "--demos", demos_str],
-        failsafe=True,
-    )
-    run_command(["docker", "exec", "multi-proxy", "caddy-reload"], failsafe=True)
-
-
+@locking_demo
 def deploy_for(
     deployment: Deployment, *, reuse_image: bool, force_prepare: bool = False
 ):
@@ -225,30 +233,64 @@ def deploy_for(
         reuse_image: whether to not remove existing image file and skip download (dev)
     """
 
-    rc = -1
-    # add a post-exectution callback to do_deploy so our cleanup func is run
-    # should the function raise an exception or an error
-    with ExitStack() as stack:
-        stack.callback(on_error_cleanup, deployment=deployment)
-        rc = do_deploy(deployment, reuse_image=reuse_image, force_prepare=force_prepare)
-        # if the rc is 0 (success), we remove the callback from the stack
-        # so it's not run
-        if not rc:
-            stack.pop_all()
+    # our cleanup func is run should do_deploy raise an exception or an error,
+    # recording what failed
+    with recording_failures() as failures:
+        try:
+            rc = do_deploy(
+                deployment, reuse_image=reuse_image, force_prepare=force_prepare
+            )
+        except BaseException as exc:
+            on_error_cleanup(deployment, error=str(exc) or type(exc).__name__)
+            raise
+        if rc:
+            on_error_cleanup(
+                deployment,
+                error=describe_failures(failures) or f"failed with code {rc}",
+            )
     return rc
 
 
-def on_error_cleanup(deployment: Deployment):
+def on_error_cleanup(deployment: Deployment, error: str):
     """cleanup and resource release to apply post-error"""
     logger.debug("Post-error cleanup")
+    state.fail_in_progress(deployment.ident, error)
+    active = Deployment.using(
+        ident=deployment.ident,
+        alias=deployment.alias,
+        name=deployment.name,
+        settings=deployment.settings,
+    )
+    # staged slot never served: stop and release it
+    staged = active.in_slot(active.other_slot)
+    if not staged.can_rollback:
+        stop_demo(staged)
+        if unmount_detach_release(staged):
+            fail(f"> Error releasing {staged}")
+
+    # active slot is left untouched if it still serves
+    if get_mode(active) == Mode.IMAGE and is_demo_healthy(active):
+        logger.info(f"> {active} still serving")
+        return
+
+    # otherwise restart the last good version if we have one
+    active.mark_verified(verified=False)
+    if staged.can_rollback:
+        logger.info(f"> rolling back to {staged}")
+        if rollback_for(active) == 0:
+            return
     for func in (set_maint_mode, unmount_detach_release):
-        rc = func(deployment=deployment)
+        rc = func(deployment=active)
         if rc:
             fail(f"> Error cleaning up {func}")
 
 
 def do_deploy(deployment: Deployment, *, reuse_image: bool, force_prepare: bool):
-    """actual deployment ; no failsafe. Prefer deploy_url()"""
+    """actual deployment ; no failsafe. Prefer deploy_for()
+
+    A new image is staged in the inactive slot, next to the active one which keeps
+    serving until multi-proxy is switched to the staged slot (once ready).
+    Reusing image redeploys the active slot in place, through maintenance mode."""
     logger.info(f"deploying for {deployment.download_url}")
 
     if not is_root():
@@ -258,63 +300,220 @@ def do_deploy(deployment: Deployment, *, reuse_image: bool, force_prepare: bool)
         return fail(f"URL is incorrect: {deployment.download_url}")
     logger.info("> URL is OK")
 
+    digest = get_checksum_from(deployment.download_url)
+
+    target = deployment if reuse_image else deployment.in_slot(deployment.other_slot)
+    logger.info(f"Deploying into {target.slot} slot")
+    # version in target slot (if any) is replaced: can't rollback to it anymore
+    if not reuse_image:
+        target.mark_verified(verified=False)
+    target.set_phase(state.DOWNLOADING)
+
     logger.info(f"Download image file using aria2 ({reuse_image=})")
     if (
-        not reuse_image or not deployment.image_path.exists()
-    ) and not deployment.tmp_image_path.exists():
+        not reuse_image or not target.image_path.exists()
+    ) and not target.tmp_image_path.exists():
         rc = download_file_into(
             url=deployment.download_url,
-            dest=deployment.tmp_image_path,
-            digest=get_checksum_from(deployment.download_url),
+            dest=target.tmp_image_path,
+            digest=digest,
         )
         if rc:
             return fail("Failed to download image", rc)
 
-    rc = toggle_demo(deployment, mode=Mode.MAINT)
-    if rc:
-        return fail("Failed to switch to maintenance mode")
+    if reuse_image:
+        rc = toggle_demo(target, mode=Mode.MAINT)
+        if rc:
+            return fail("Failed to switch to maintenance mode")
+    else:
+        # leftovers of a previous attempt
+        stop_demo(target)
 
-    rc = unmount_detach_release(deployment)
+    rc = unmount_detach_release(target)
     if rc:
         return fail("Unable to release image", rc)
 
-    if deployment.image_path.exists() and not reuse_image:
-        logger.info(f"> removing {deployment.image_path}")
+    if target.image_path.exists() and not reuse_image:
+        logger.info(f"> removing {target.image_path}")
         try:
-            deployment.image_path.unlink(missing_ok=True)  # should not be missing
+            target.image_path.unlink(missing_ok=True)  # should not be missing
         except Exception as exc:
             logger.exception(exc)
-            return fail(f"Failed to remove {deployment.image_path}: {exc}")
+            return fail(f"Failed to remove {target.image_path}: {exc}")
 
     if not reuse_image:
         logger.info("Replacing image with downloaded one")
         try:
-            deployment.image_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(deployment.tmp_image_path, deployment.image_path)
+            target.image_path.parent.mkdir(parents=True, exist_ok=True)
+            with stage("disk"):
+                shutil.move(target.tmp_image_path, target.image_path)
         except Exception as exc:
             logger.exception(exc)
             return fail(
-                f"Failed to rename {deployment.tmp_image_path} "
-                f"to {deployment.image_path}: {exc}"
+                f"Failed to rename {target.tmp_image_path} "
+                f"to {target.image_path}: {exc}"
             )
+        # identifies image content (for prepare cache)
+        target.record_image(digest.etag if digest.found else "")
 
-    logger.info("> purging docker")
-    prune_docker()
+    rc = attach_and_mount(target)
+    if rc:
+        return rc
 
-    logger.info("Requesting loop device")
-    try:
-        loop_dev = get_loopdev()
-    except Exception as exc:
-        logger.exception(exc)
-        return fail("Failed to get loop-devices (all slots taken?)")
-    logger.info(f"> {loop_dev}")
+    target.set_phase(state.PREPARING)
+    rc = prepare_for(target, force=force_prepare)
+    if rc:
+        return fail("Failed to prepare image", rc)
 
-    logger.info(f"Attaching image to {loop_dev}")
-    try:
-        attach_to_device(img_fpath=deployment.image_path, loop_dev=loop_dev)
-    except Exception as exc:
-        logger.debug(exc)
-        return fail(f"Failed to attach image to {loop_dev}: {exc}")
+    logger.info("Switching to image mode")
+    target.set_phase(state.STARTING)
+    rc = toggle_demo(target, mode=Mode.IMAGE)
+    if rc:
+        return fail("Failed to switch to image mode", rc)
+
+    logger.info(f"Switching multi-proxy to {target.slot} slot")
+    target.set_phase(state.SWITCHING)
+    switch_to(target)
+
+    served = wait_until_served(target)
+    if not served.ready:
+        if target is not deployment:
+            logger.info(f"> switching back to {deployment.slot} slot")
+            switch_to(deployment)
+        return fail(f"Demo is not properly served: {served.reason}")
+    logger.info(f"> served in {served.duration:.1f}s")
+    target.mark_verified()
+    target.set_phase(state.SERVING)
+
+    if target is not deployment:
+        # demo is served by target already: failing here is not a deploy failure
+        if retire_slot(deployment):
+            logger.warning(f"Failed to retire {deployment}")
+
+    logger.info("> cleaning docker up")
+    cleanup_docker_for(target)
+
+    logger.info("> demo ready")
+    return 0
+
+
+def switch_to(deployment: Deployment):
+    """make deployment's slot the one serving the demo"""
+    deployment.activate()
+    if deployment.ident in DEPLOYMENTS:
+        DEPLOYMENTS[deployment.ident] = deployment
+    reconfigure_multiproxy()
+
+
+def teardown_slot(deployment: Deployment) -> int:
+    """stop and release a slot not serving anymore, removing its files"""
+    logger.info(f"Tearing down {deployment}")
+    stop_demo(deployment)
+    rc = unmount_detach_release(deployment)
+    if rc:
+        return rc
+    compose_dirs = [
+        deployment.in_replica(replica).compose_dir for replica in range(MAX_REPLICAS)
+    ]
+    images = {
+        image
+        for compose_dir in compose_dirs
+        for image in get_compose_images(compose_dir / "image-compose.yaml")
+    }
+    for path in (deployment.image_path.parent, deployment.target_dir, *compose_dirs):
+        shutil.rmtree(path, ignore_errors=True)
+
+    # images only this slot used ; others' (and kept slots') are preserved
+    reclaimed = remove_unused_images(images)
+    logger.debug(f"Reclaimed {reclaimed // ONE_MIB} MiB of images")
+    state.clear_slot(deployment.ident, deployment.slot)
+    return 0
+
+
+def get_kept_images_size(*, excluding: str) -> int:
+    """disk usage of previous images kept for rollback, but excluding's"""
+    size = 0
+    for fpath in OFFSPOT_DEMO_IMAGES_ROOT_DIR.glob("*/*/image.img"):
+        ident, slot = fpath.parent.parent.name, fpath.parent.name
+        if ident != excluding and slot != get_active_slot(ident):
+            # actual usage as images are sparse files
+            size += fpath.stat().st_blocks * 512
+    return size
+
+
+def retire_slot(deployment: Deployment) -> int:
+    """stop a slot not serving anymore
+
+    Verified slots are kept (unmounted) for rollback within disk budget"""
+    if deployment.can_rollback:
+        size = deployment.image_path.stat().st_blocks * 512
+        budget = OFFSPOT_DEMO_ROLLBACK_BUDGET_GIB * 2**30
+        if get_kept_images_size(excluding=deployment.ident) + size <= budget:
+            logger.info(f"Keeping {deployment} for rollback")
+            stop_demo(deployment)
+            deployment.set_phase(state.RETIRED)
+            return unmount_detach_release(deployment)
+        logger.info(f"Not keeping {deployment}: rollback budget exceeded")
+    return teardown_slot(deployment)
+
+
+@locking_demo
+def rollback_for(deployment: Deployment) -> int:
+    """switch demo back to the previous version kept in its other slot
+
+    deployment is the active slot, retired once the previous version serves"""
+    previous = deployment.in_slot(deployment.other_slot)
+    logger.info(f"rolling back {deployment} to {previous}")
+
+    if not is_root():
+        return fail("must be root", 1)
+
+    if not previous.can_rollback:
+        return fail(f"No previous version to rollback to in {previous}")
+
+    if not is_mounted(previous.target_dir):
+        rc = attach_and_mount(previous)
+        if rc:
+            return fail("Failed to mount previous image", rc)
+
+    rc = toggle_demo(previous, mode=Mode.IMAGE)
+    if rc:
+        return fail("Failed to start previous version", rc)
+
+    logger.info(f"Switching multi-proxy to {previous.slot} slot")
+    switch_to(previous)
+    previous.set_phase(state.SERVING)
+    # rejected image is not redeployed until another one is published
+    deployment.record_rollback(
+        previous.image_download_url, rejected_url=deployment.image_download_url
+    )
+
+    if retire_slot(deployment):
+        logger.warning(f"Failed to retire {deployment}")
+
+    logger.info("> rolled back")
+    return 0
+
+
+@stage("mount")
+def attach_and_mount(deployment: Deployment) -> int:
+    """attach deployment's image to a loop device and mount its data partition"""
+    # free loop device must not be taken by another process before we attach
+    with lock(LOOP_DEVICES, timeout=RESOURCE_LOCK_TIMEOUT, purpose=str(deployment)):
+        logger.info("Requesting loop device")
+        try:
+            loop_dev = get_loopdev()
+        except Exception as exc:
+            logger.exception(exc)
+            return fail("Failed to get loop-devices (all slots taken?)")
+        logger.info(f"> {loop_dev}")
+
+        logger.info(f"Attaching image to {loop_dev}")
+        try:
+            attach_to_device(img_fpath=deployment.image_path, loop_dev=loop_dev)
+        except Exception as exc:
+            logger.debug(exc)
+            return fail(f"Failed to attach image to {loop_dev}: {exc}")
 
     deployment.target_dir.mkdir(parents=True, exist_ok=True)
 
@@ -323,12 +522,27 @@ def do_deploy(deployment: Deployment, *, reuse_image: bool, force_prepare: bool)
         dev_path=f"{loop_dev}p3", mount_point=deployment.target_dir, filesystem="ext4"
     ):
         return fail(f"Failed to mount {loop_dev}p3 to TARGET_DIR")
+    return 0
+
+
+@locking_demo
+def reprepare_for(deployment: Deployment) -> int:
+    """re-prepare a deployment off its already mounted image and restart it
+
+    Used when only prepare-relevant settings (alias) have changed."""
+    logger.info(f"re-preparing {deployment}")
 
-    rc = prepare_for(deployment, force=force_prepare)
+    if not is_root():
+        return fail("must be root", 1)
+
+    if not is_mounted(deployment.target_dir):
+        return fail(f"Image is not mounted on {deployment.target_dir}")
+
+    rc = prepare_for(deployment, force=True)
     if rc:
         return fail("Failed to prepare image", rc)
 
-    logger.info("Switching to image mode")
+    logger.info("Restarting in image mode")
     rc = toggle_demo(deployment, mode=Mode.IMAGE)
     if rc:
         return fail("Failed to switch to image mode", rc)
@@ -340,6 +554,7 @@ def do_deploy(deployment: Deployment, *, reuse_image: bool, force_prepare: bool)
     return 0
 
 
+@stage("mount")
 def unmount_detach_release(deployment: Deployment) -> int:
     """unmount image and release loop-device"""
     if is_mounted(deployment.target_dir):
@@ -389,7 +604,7 @@ def entrypoint():
     try:
         sys.exit(
             deploy_for(
-                deployment=DEPLOYMENTS[args.ident],
+                DEPLOYMENTS[args.ident],
                 reuse_image=args.reuse_image,
                 force_prepare=args.force_prepare,
             )
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Host-wide docker garbage collection
+
+Removes stopped containers, dangling images and unused build cache. Deploys only
+clean their own compose projects up so this runs separately (demo-gc.timer), at
+most once every OFFSPOT_DEMO_GC_MIN_INTERVAL seconds."""
+
+import argparse
+import logging
+import sys
+import time
+
+from offspot_demo import logger
+from offspot_demo.constants import OFFSPOT_DEMO_GC_MIN_INTERVAL, OFFSPOT_DEMO_STATE_DIR
+from offspot_demo.utils import fail
+from offspot_demo.utils.docker_api import DockerAPIError, get_docker_client
+
+# mtime is that of last collection
+GC_STAMP_PATH = OFFSPOT_DEMO_STATE_DIR / "gc.last"
+ONE_MIB = 2**20
+
+
+def get_seconds_since_last_gc() -> float | None:
+    """seconds since last collection, None if never ran"""
+    try:
+        return time.time() - GC_STAMP_PATH.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def collect_garbage() -> int:
+    """prune containers, dangling images and build cache ; bytes reclaimed"""
+    client = get_docker_client()
+    reclaimed = 0
+
+    pruned = client.prune_containers()
+    logger.info(f"> removed {len(pruned.get('ContainersDeleted') or [])} containers")
+    reclaimed += int(pruned.get("SpaceReclaimed") or 0)
+
+    pruned = client.prune_images()
+    logger.info(f"> removed {len(pruned.get('ImagesDeleted') or [])} images")
+    reclaimed += int(pruned.get("SpaceReclaimed") or 0)
+
+    pruned = client.prune_build_cache()
+    logger.info(f"> removed {len(pruned.get('CachesDeleted') or [])} build caches")
+    reclaimed += int(pruned.get("SpaceReclaimed") or 0)
+
+    return reclaimed
+
+
+def gc(*, force: bool) -> int:
+    since = get_seconds_since_last_gc()
+    if not force and since is not None and since < OFFSPOT_DEMO_GC_MIN_INTERVAL:
+        logger.info(
+            f"Last collection was {since:.0f}s ago "
+            f"(< {OFFSPOT_DEMO_GC_MIN_INTERVAL}s), skipping"
+        )
+        return 0
+
+    logger.info("Collecting docker garbage")
+    started_on = time.monotonic()
+    try:
+        reclaimed = collect_garbage()
+    except DockerAPIError as exc:
+        return fail(f"Failed to collect garbage: {exc}")
+
+    GC_STAMP_PATH.parent.mkdir(parents=True, exist_ok=True)
+    GC_STAMP_PATH.touch()
+    logger.info(
+        f"Reclaimed {reclaimed // ONE_MIB} MiB "
+        f"in {time.monotonic() - started_on:.1f}s"
+    )
+    return 0
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-gc",
+        description="Remove unused docker containers, images and build cache",
+    )
+    parser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        default=False,
+        help="Run even if last collection is more recent than "
+        f"{OFFSPOT_DEMO_GC_MIN_INTERVAL}s",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="debug",
+        default=False,
+        help="Activate debug logs",
+    )
+
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    try:
+        sys.exit(gc(force=args.force))
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""Heal a mounted and prepared demo which is not running (anymore)
+
+Instead of a full redeploy (maintenance mode, remount, re-prepare, pulls), a
+graded ladder is climbed, stopping at the first step that brings it back:
+
+- services: restart crashed containers only
+- project: restart its compose project(s) from scratch
+- remount: release and remount its image, then start it
+- redeploy: deploy it again off the image on disk
+
+Most crashes don't even get here: compose services restart on failure on their
+own (see `restart-on-failure` compose rule)."""
+
+import argparse
+import logging
+import sys
+import time
+from collections.abc import Callable
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.constants import STARTUP_DURATION, Mode
+from offspot_demo.deploy import deploy_for, unmount_detach_release
+from offspot_demo.resume import remount
+from offspot_demo.toggle import toggle_demo
+from offspot_demo.utils import fail, is_root
+from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
+from offspot_demo.utils.docker import get_compose_states, stop_demo
+from offspot_demo.utils.docker_api import DockerAPIError, get_docker_client
+from offspot_demo.utils.locks import locking_demo
+from offspot_demo.utils.readiness import wait_until_replicas_ready
+
+SERVICES = "services"
+PROJECT = "project"
+REMOUNT = "remount"
+REDEPLOY = "redeploy"
+
+
+def get_failed_containers(deployment: Deployment) -> list[dict[str, Any]] | None:
+    """compose states of deployment's containers not running or unhealthy
+
+    None if some replica has no container at all (nothing to restart)"""
+    failed: list[dict[str, Any]] = []
+    for replica in deployment.replica_deployments:
+        states = get_compose_states(replica)
+        if not states:
+            return None
+        failed += [
+            state
+            for state in states
+            if state.get("State") != "running" or state.get("Health") == "unhealthy"
+        ]
+    return failed
+
+
+def restart_services(deployment: Deployment) -> int:
+    """restart crashed containers, waiting for the demo to serve"""
+    failed = get_failed_containers(deployment)
+    if failed is None:
+        return fail("Missing containers")
+    started_on = time.time()
+    client = get_docker_client()
+    for state in failed:
+        logger.info(f"> restarting {state['Name']} ({state['State']})")
+        try:
+            client.restart_container(state["ID"])
+        except DockerAPIError as exc:
+            return fail(f"Failed to restart {state['Name']}: {exc}")
+    readiness = wait_until_replicas_ready(
+        deployment.replica_deployments,
+        since=started_on,
+        timeout=STARTUP_DURATION,
+    )
+    if not readiness.ready:
+        return fail(f"Not ready after restarting services: {readiness.reason}")
+    return 0
+
+
+def restart_project(deployment: Deployment) -> int:
+    """stop then start deployment's compose project(s)"""
+    stop_demo(deployment)
+    return toggle_demo(deployment, mode=Mode.IMAGE)
+
+
+def remount_and_start(deployment: Deployment) -> int:
+    """release and remount deployment's image, then start it"""
+    stop_demo(deployment)
+    if rc := unmount_detach_release(deployment):
+        return rc
+    if rc := remount(deployment):
+        return rc
+    return toggle_demo(deployment, mode=Mode.IMAGE)
+
+
+def redeploy(deployment: Deployment) -> int:
+    return deploy_for(deployment, reuse_image=True, force_prepare=True)
+
+
+LADDER: list[tuple[str, Callable[[Deployment], int]]] = [
+    (SERVICES, restart_services),
+    (PROJECT, restart_project),
+    (REMOUNT, remount_and_start),
+    (REDEPLOY, redeploy),
+]
+
+
+@locking_demo
+def heal_for(deployment: Deployment, since: str = SERVICES) -> int:
+    """climb the ladder (from since) until deployment serves again ; 0 if it does"""
+    steps = [name for name, _ in LADDER]
+    rc = 1
+    for name, step in LADDER[steps.index(since) :]:
+        started_on = time.monotonic()
+        logger.info(f"[{deployment}] healing: {name}")
+        try:
+            rc = step(deployment)
+        except Exception as exc:
+            logger.exception(exc)
+            rc = 1
+        duration = time.monotonic() - started_on
+        if not rc:
+            logger.info(f"[{deployment}] healed by {name} in {duration:.1f}s")
+            return 0
+        logger.warning(f"[{deployment}] {name} did not heal ({duration:.1f}s)")
+    return rc
+
+
+def heal(ident: str, since: str) -> int:
+    if not is_root():
+        return fail("must be root", 1)
+    if ident not in DEPLOYMENTS:
+        return fail(f"Unknown demo: {ident}")
+    return heal_for(DEPLOYMENTS[ident], since=since)
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-heal",
+        description="Bring a crashed demo back, from lightest to heaviest steps",
+    )
+    parser.add_argument(dest="ident", help="Demo to heal")
+    parser.add_argument(
+        "--from",
+        dest="since",
+        choices=[name for name, _ in LADDER],
+        default=SERVICES,
+        help="First step of the ladder to try",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="debug",
+        default=False,
+        help="Activate debug logs",
+    )
+
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    try:
+        sys.exit(heal(args.ident, args.since))
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
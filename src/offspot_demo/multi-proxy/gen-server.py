@@ -19,6 +19,7 @@ debug: bool = bool(os.getenv("DEBUG", ""))
 caddyfile_fpath = Path("/etc/caddy/Caddyfile")
 homepage_fpath = Path("/var/www/index.html")
 FQDN = os.getenv("FQDN", "") or "notset"
+WAKER_PORT = os.getenv("WAKER_PORT", "") or "8090"
 
 
 def port_from(ident: str) -> int:
@@ -34,26 +35,38 @@ class Demo:
     ident: str
     dns_alias: str
     name: str
-    port: int
+    ports: list[int]
     captive_port: int
     subdomains: list[str]
+    flags: list[str] = dataclasses.field(default_factory=list)
 
     @classmethod
     def from_line(cls, text: str):
-        """Demo from ident:[alias]:subdomains format"""
-        ident, dns_alias, name, subdomains = text.strip().split(":", 3)
+        """Demo from ident:[alias]:name:subdomains[:ports:captive_port:flags] format
+
+        ports are those of the demo's active slot (one per replica, |-separated),
+        computed from ident if absent. flags: hibernated, maintenance"""
+        ident, dns_alias, name, subdomains, *extra = text.strip().split(":")
         if not dns_alias:
             dns_alias = ident
+        port, captive_port, flags = [*extra, "", "", ""][:3]
 
         return cls(
             ident=ident,
             dns_alias=dns_alias,
             name=name.strip(),
-            port=port_from(ident),
-            captive_port=captive_port_from(ident),
+            ports=[int(p) for p in port.split("|") if p] or [port_from(ident)],
+            captive_port=(
+                int(captive_port) if captive_port else captive_port_from(ident)
+            ),
             subdomains=[sd for sd in subdomains.strip().split("|") if sd],
+            flags=[flag for flag in flags.strip().split("|") if flag],
         )
 
+    @property
+    def port(self) -> int:
+        return self.ports[0]
+
     @property
     def icon_url(self) -> str:
         ident = {"computers": "computer", "wikipedia-en": "wikipedia"}.get(
@@ -102,7 +115,26 @@ http://{{demo.dns_alias}}.{$FQDN}, https://{{demo.dns_alias}}.{$FQDN}, http://*.
         Disallow: /
         EOT 200
 
-    reverse_proxy http://{$HOST_IP}:{{demo.port}}
+    {% if "maintenance" in demo.flags %}
+    # demo is stopped for maintenance
+    respond "The “{{demo.ident}}” demo is under maintenance, \
+please come back in a moment." 503
+    {% else %}
+    {% if "hibernated" in demo.flags %}
+    # demo is stopped: demo-waker starts it (holding the request) first
+    forward_auth http://{$HOST_IP}:{{waker_port}} {
+        uri /wake/{{demo.ident}}
+        header_up Authorization "Bearer {$WAKER_TOKEN}"
+    }
+    {% endif %}
+    reverse_proxy{% for port in demo.ports %} http://{$HOST_IP}:{{port}}{% endfor %}{% if demo.ports|length > 1 %} {
+        # replicas: prefer least busy one, skipping those failing
+        lb_policy least_conn
+        lb_try_duration 5s
+        fail_duration 30s
+        unhealthy_status 5xx
+    }{% endif %}
+    {% endif %}
 
     handle_errors 502 {
         respond "The “{{demo.ident}}” demo is not available or ready. \
@@ -208,6 +240,7 @@ def gen_caddyfile(demos: dict[str, Demo]) -> int:
                 debug=debug,
                 demos=demos,
                 nb_demos=len(demos),
+                waker_port=WAKER_PORT,
             )
         )
     except Exception as exc:
@@ -3,7 +3,8 @@
 import argparse
 import logging
 import sys
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 
 from offspot_demo import logger
 from offspot_demo.constants import (
@@ -11,36 +12,114 @@ from offspot_demo.constants import (
     OFFSPOT_DEMO_TLS_EMAIL,
 )
 from offspot_demo.utils import fail, is_root
+from offspot_demo.utils.cache import (
+    get_prepare_cache_key,
+    restore_prepared,
+    store_prepared,
+)
 from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
-from offspot_demo.utils.process import run_command
+from offspot_demo.utils.docker_api import (
+    DockerAPIError,
+    DockerClient,
+    get_docker_client,
+)
+from offspot_demo.utils.locks import locking_demo
+from offspot_demo.utils.resources import apply_resource_limits
+from offspot_demo.utils.rules import RulesResult, get_compose_rules
+from offspot_demo.utils.scheduler import stage
 from offspot_demo.utils.yaml import yaml_dump, yaml_load
 
 
-def docker_pull(ident: str) -> int:
-    """pull a docker image via docker CLI"""
-
-    # should we validate `ident` first? As it comes from an external file
-    # and we pass it to subprocess…
-    return (
-        run_command(
-            [
-                "docker",
-                "image",
-                "pull",
-                "--platform",
-                OCI_PLATFORM,
-                ident,
-            ]
-        ).returncode
-        == 0
+def docker_pull(ident: str, client: DockerClient | None = None) -> bool:
+    """pull a docker image via the Engine API"""
+    try:
+        with stage("docker"):
+            (client or get_docker_client()).pull(ident, platform=OCI_PLATFORM)
+    except DockerAPIError as exc:
+        logger.error(f"Failed to pull {ident}: {exc}")
+        return False
+    return True
+
+
+def docker_pull_all(idents: list[str]) -> list[str]:
+    """pull docker images concurrently (up to docker stage's limit) ; those failed
+
+    each over its own connection as the shared client serializes requests"""
+
+    def pull(ident: str) -> bool:
+        logger.info(f"> Pulling OCI Image {ident}")
+        client = DockerClient()
+        try:
+            return docker_pull(ident, client)
+        finally:
+            client.close()
+
+    with ThreadPoolExecutor(
+        max_workers=max(len(idents), 1), thread_name_prefix="pull"
+    ) as executor:
+        return [
+            ident
+            for ident, pulled in zip(idents, executor.map(pull, idents), strict=True)
+            if not pulled
+        ]
+
+
+def rewrite_compose(
+    deployment: Deployment, compose: dict[str, Any], orig_fqdn: str
+) -> RulesResult:
+    """rewrite an image's compose in place for deployment (and its replica)"""
+    # update compose name so we can have several in parallel
+    compose["name"] = deployment.compose_project
+
+    # rewrite services according to compose rules
+    rules = get_compose_rules()
+    result = rules.apply(
+        compose,
+        context={
+            "fqdn": deployment.fqdn,
+            "orig_fqdn": orig_fqdn,
+            "target_dir": deployment.target_dir,
+            "log_dir": deployment.log_dir,
+            "http_port": deployment.http_port,
+            "captive_http_port": deployment.captive_http_port,
+            "tls_email": OFFSPOT_DEMO_TLS_EMAIL,
+            "replica": deployment.replica,
+        },
+    )
+
+    # cap each service so a busy demo can't starve others
+    apply_resource_limits(compose, deployment.resources)
+
+    # ATM we only support services
+    for key in ("networks", "volumes", "configs", "secrets"):
+        if compose.get(key):
+            del compose[key]
+    return result
+
+
+def write_replicas_composes(deployment: Deployment, image_yaml_text: str):
+    """write image-compose of extra replicas, serving the same mounted content"""
+    if deployment.replicas < 2:  # noqa: PLR2004
+        return
+    orig_fqdn = str(
+        yaml_load(deployment.dashboard_orig_path.read_text())["metadata"]["fqdn"]
     )
+    for replica in deployment.replica_deployments[1:]:
+        logger.info(f"> writing compose for {replica}")
+        compose = yaml_load(image_yaml_text)["offspot"]["containers"]
+        rewrite_compose(replica, compose, orig_fqdn)
+        replica.compose_dir.mkdir(parents=True, exist_ok=True)
+        replica.image_compose_path.write_text(yaml_dump(compose))
 
 
-def prepare_for(deployment: Deployment, *, force: bool) -> int:
+@locking_demo
+def prepare_for(deployment: Deployment, *, force: bool, use_cache: bool = True) -> int:
     """Prepare a deployment from a mounted image path
 
     Parameters:
-        target_dir: the path of a mounted 3rd partition or an offspot image
+        deployment: the deployment which image is mounted on its target_dir
+        force: whether to prepare again an already prepared deployment
+        use_cache: whether to restore a previous output for same image and params
     """
     logger.info(f"prepare-image from {deployment.target_dir!s}")
 
@@ -50,8 +129,8 @@ def prepare_for(deployment: Deployment, *, force: bool) -> int:
     if deployment.is_already_prepared and not force:
         return 0
 
-    dashboard_path = deployment.target_dir / "contents" / "dashboard.yaml"
-    image_yaml_path = deployment.target_dir / "image.yaml"
+    dashboard_path = deployment.dashboard_path
+    image_yaml_path = deployment.image_yaml_path
 
     for fpath in (image_yaml_path, dashboard_path):
         if not fpath.exists():
@@ -61,8 +140,18 @@ def prepare_for(deployment: Deployment, *, force: bool) -> int:
                 1,
             )
 
+    image_yaml_text = image_yaml_path.read_text()
+    cache_key = get_prepare_cache_key(deployment, image_yaml_text)
+    if use_cache and restore_prepared(deployment, cache_key):
+        logger.info(f"> restored from prepare cache ({cache_key})")
+        write_replicas_composes(deployment, image_yaml_text)
+        deployment.mark_prepared()
+        return 0
+
     # read and parse /data/contents/dashboard.yaml
-    dashboard = yaml_load(dashboard_path.read_text())
+    # from its pristine copy as dashboard is rewritten in place
+    deployment.backup_dashboard()
+    dashboard = yaml_load(deployment.dashboard_orig_path.read_text())
 
     # record original FQDN as we'll need it for replaces
     orig_fqdn = str(dashboard["metadata"]["fqdn"])
@@ -92,148 +181,31 @@ def prepare_for(deployment: Deployment, *, force: bool) -> int:
     # overwrite file
     dashboard_path.write_text(yaml_dump(dashboard))
 
-    image_yaml = yaml_load(image_yaml_path.read_text())
+    image_yaml = yaml_load(image_yaml_text)
     compose = image_yaml.get("offspot", {}).get("containers")
     if not compose:
         return fail("Missing compose definition in image.yaml (offspot.containers)", 1)
 
-    # update compose name so we can have several in parallel
-    compose["name"] = f"offspot_{deployment.ident}"
-
-    offspot_data_root = Path("/data")
-
-    subdomains: list[str] = []
-
-    for svcname, service in compose.get("services", {}).items():
-
-        # delete container_name so we can have multiple compose in parallel
-        if "container_name" in service.keys():
-            del service["container_name"]
-
-        orig_volumes = list(service.get("volumes", []))
-        service["volumes"] = []
-        for volume in orig_volumes:
-
-            # we accept /data prefixed sources
-            if Path(volume["source"]).is_relative_to(offspot_data_root):
-                # rewrite so it works off any `target_dir`
-                volume["source"] = str(
-                    deployment.target_dir
-                    / Path(volume["source"]).relative_to(offspot_data_root)
-                )
-                service["volumes"].append(volume)
-                continue
-
-            # reverse-proxy only is allowed to mount /var/log (for metrics)
-            if (
-                svcname == "reverse-proxy"
-                and volume["source"] == "/var/log"
-                and service["image"].startswith("ghcr.io/offspot/reverse-proxy:")
-            ):
-                volume["source"] = f"/var/log/offspot-demo_{deployment.ident}"
-                service["volumes"].append(volume)
-                Path(f"/var/log/offspot-demo_{deployment.ident}").mkdir(
-                    parents=True, exist_ok=True
-                )
-                continue
-
-            # metrics shares this with reverse-proxy
-            if (
-                svcname == "metrics"
-                and volume["source"] == "/var/log"
-                and service["image"].startswith("ghcr.io/offspot/metrics:")
-            ):
-                volume["source"] = f"/var/log/offspot-demo_{deployment.ident}"
-                service["volumes"].append(volume)
-                Path(f"/var/log/offspot-demo_{deployment.ident}").mkdir(
-                    parents=True, exist_ok=True
-                )
-                continue
-
-            # other volumes are not accepted and thus removed (not added-back)
-
-        # disabled healthcheck for home (its defined in image)
-        if svcname == "home":
-            service["healthcheck"] = {"disable": True}
-
-        # remove metrics dependency to home being healthy as we disabled healthcheck
-        if (
-            svcname == "metrics"
-            and service.get("depends_on", {}).get("home", {}).get("condition", "")
-            == "service_healthy"
-        ):
-            service["depends_on"]["home"]["condition"] = "service_started"
-
-        # remove cap_add for all ; will break captive portal but it's OK
-        if "cap_add" in service:
-            del service["cap_add"]
-
-        # only allow reverse-proxy to define ports ; ensure its 80/443
-        if not (
-            svcname == "reverse-proxy"
-            and service["image"].startswith("ghcr.io/offspot/reverse-proxy:")
-        ):
-            if "ports" in service:
-                del service["ports"]
-        else:
-            service["ports"] = [
-                f"{deployment.http_port}:80",
-            ]
-
-        # dont allow using network_mode (captive portal with be switched to ports)
-        if "network_mode" in service:
-            del service["network_mode"]
-
-        # convert captive-portal's network_mode expose to new ports
-        if svcname == "home-portal" and service["image"].startswith(
-            "ghcr.io/offspot/captive-portal:"
-        ):
-            service["ports"] = [
-                f"{deployment.captive_http_port}:2080",
-            ]
-
-        # allow none to be privileged ; breaks hwclock but it's OK
-        if "privileged" in service:
-            del service["privileged"]
-
-        # replace fqdn in all environment
-        for key, value in list(service.get("environment", {}).items()):
-            if key not in ("PROTECTED_SERVICES",):
-                service["environment"][key] = value.replace(orig_fqdn, deployment.fqdn)
-
-        if svcname == "reverse-proxy":
-            service["environment"]["DEMO_TLS_EMAIL"] = OFFSPOT_DEMO_TLS_EMAIL
-            service["environment"]["IS_ONLINE_DEMO"] = "true"
-            service["environment"]["FQDN"] = deployment.fqdn
-            # services can be mapping
-            subdomains += [
-                fm.split(":")[0] for fm in service["environment"]["SERVICES"].split(",")
-            ]
-            subdomains += [
-                fm.split(":")[0]
-                for fm in service["environment"].get("FILES_MAPPING", "").split(",")
-            ]
-
-    deployment.subdomains = subdomains
-
-    # ATM we only support services
-    for key in ("networks", "volumes", "configs", "secrets"):
-        if compose.get(key):
-            del compose[key]
+    deployment.subdomains = rewrite_compose(deployment, compose, orig_fqdn).subdomains
 
     # pull all OCI images from oci_images
     for entry in image_yaml.get("oci_images", []):
         if entry["ident"] == "ghcr.io/offspot/reverse-proxy:1.7":
             entry["ident"] = "ghcr.io/offspot/reverse-proxy:1.8"
-        logger.info(f"> Pulling OCI Image {entry['ident']}")
-        docker_pull(entry["ident"])
+    if failed := docker_pull_all(
+        [entry["ident"] for entry in image_yaml.get("oci_images", [])]
+    ):
+        return fail(f"Unable to pull {', '.join(failed)}")
 
     # write new compose to partition
+    deployment.compose_dir.mkdir(parents=True, exist_ok=True)
     deployment.image_compose_path.write_text(yaml_dump(compose))
 
     logger.debug(deployment.image_compose_path.read_text())
 
-    deployment.prepared_ok_path.touch()
+    store_prepared(deployment, cache_key)
+    write_replicas_composes(deployment, image_yaml_text)
+    deployment.mark_prepared()
     return 0
 
 
@@ -250,12 +222,23 @@ def entrypoint():
         default=False,
         help="Re-prepare even if already prepared",
     )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        default=True,
+        help="Don't restore output from prepare cache",
+    )
 
     args = parser.parse_args()
     logger.setLevel(logging.DEBUG)
 
     try:
-        sys.exit(prepare_for(DEPLOYMENTS[args.ident], force=args.force))
+        sys.exit(
+            prepare_for(
+                DEPLOYMENTS[args.ident], force=args.force, use_cache=args.use_cache
+            )
+        )
     except Exception as exc:
         logger.exception(exc)
         logger.critical(str(exc))
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+"""Resident daemon keeping deployments in line with config and images
+
+Unlike demo-watcher (a fresh process every 15mn), it keeps its state warm: the
+imager-service client (token, ETags), the docker connection and the deployments,
+reloaded as soon as config changes. An asyncio loop runs:
+
+- config: online demos config fetched every OFFSPOT_DEMO_CONFIG_INTERVAL seconds ;
+  local config files are watched and reloaded on change
+- demo:{ident}: each demo reconciled on its own schedule, every
+  OFFSPOT_DEMO_RECONCILE_INTERVAL seconds while it changes, backing off while it
+  doesn't and retrying sooner after a failure
+- hibernation: idle demos stopped (if OFFSPOT_DEMO_IDLE_TIMEOUT is set)
+
+Demos (or config) can also be reconciled right away on a push trigger (see
+utils.trigger), if OFFSPOT_DEMO_TRIGGER_TOKEN is set.
+
+Blocking work (deploys, docker, HTTP) runs in threads, up to
+OFFSPOT_DEMO_MAX_PARALLEL_JOBS demos at once and limited per stage as in
+update-watcher. Runs and durations of each loop are recorded in the state store
+(demo-status --loops)."""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import signal
+import sys
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.config_watcher import check_and_record, load_configured_deployments
+from offspot_demo.constants import (
+    OFFSPOT_CONFIGURATION,
+    OFFSPOT_DEMO_CONFIG_INTERVAL,
+    OFFSPOT_DEMO_IDLE_TIMEOUT,
+    OFFSPOT_DEMO_MAX_PARALLEL_JOBS,
+    OFFSPOT_DEMO_RECONCILE_INTERVAL,
+    OFFSPOT_DEMO_TRIGGER_HOST,
+    OFFSPOT_DEMO_TRIGGER_PORT,
+    OFFSPOT_DEMO_TRIGGER_TOKEN,
+    OFFSPOT_DEMOS_CONFIG_PATH,
+)
+from offspot_demo.update_watcher import execute_plan
+from offspot_demo.utils import fail, is_root, state
+from offspot_demo.utils.config_diff import clear_change, load_pending_changes
+from offspot_demo.utils.deployment import (
+    DEPLOYMENTS,
+    Deployment,
+    replace_deployments,
+)
+from offspot_demo.utils.hibernation import hibernate_idle
+from offspot_demo.utils.migration import migrate_legacy_layout
+from offspot_demo.utils.planner import make_plan
+from offspot_demo.utils.trigger import CONFIG, Trigger, serve_triggers
+
+# outcomes of a demo's reconciliation (failures raise ReconcileError)
+UNCHANGED = "unchanged"
+UPDATED = "updated"
+
+# seconds before first retry of a failed demo (doubling up to regular interval)
+RETRY_INTERVAL = 60
+# unchanged demos are checked up to this many times less often
+MAX_BACKOFF = 4
+BACKOFF_FACTOR = 1.5
+# seconds between checks of local config files for changes
+CONFIG_WATCH_INTERVAL = 5
+HIBERNATION_INTERVAL = 60
+
+
+class ReconcileError(Exception):
+    """a demo could not be brought to its desired state"""
+
+
+@dataclass
+class Schedule:
+    """when a demo is reconciled next (monotonic), adapting to outcomes"""
+
+    interval: float = OFFSPOT_DEMO_RECONCILE_INTERVAL
+    next_on: float = 0.0
+    failures: int = 0
+
+    def after(self, outcome: str | None, now: float):
+        """schedule next run after one with that outcome (None if failed)"""
+        if outcome is None:
+            self.failures += 1
+            self.next_on = now + min(
+                RETRY_INTERVAL * 2 ** (self.failures - 1),
+                OFFSPOT_DEMO_RECONCILE_INTERVAL,
+            )
+            return
+        self.failures = 0
+        if outcome == UPDATED:
+            self.interval = OFFSPOT_DEMO_RECONCILE_INTERVAL
+        self.next_on = now + self.interval
+        if outcome == UNCHANGED:
+            self.interval = min(
+                self.interval * BACKOFF_FACTOR,
+                OFFSPOT_DEMO_RECONCILE_INTERVAL * MAX_BACKOFF,
+            )
+
+
+def refreshed(deployment: Deployment) -> Deployment:
+    """deployment in its current active slot, without cached download URL"""
+    return Deployment.using(
+        ident=deployment.ident,
+        alias=deployment.alias,
+        name=deployment.name,
+        settings=deployment.settings,
+    )
+
+
+def reconcile_demo(ident: str) -> str:
+    """bring a demo to its desired state (undeployed if not configured anymore)"""
+    migrate_legacy_layout(ident)
+    change = load_pending_changes().get(ident)
+    deployments = {ident: refreshed(DEPLOYMENTS[ident])} if ident in DEPLOYMENTS else {}
+    plan = make_plan(
+        deployments.values(), {ident: change} if change else {}, idents={ident}
+    )
+    if execute_plan(plan, deployments):
+        raise ReconcileError(f"{plan.actions[0].kind} failed")
+    if change and ident not in plan.deferred:
+        clear_change(change)
+    return UPDATED if plan else UNCHANGED
+
+
+def get_config_mtimes() -> tuple[float, ...]:
+    """modification times of local config files (0 if missing)"""
+    mtimes: list[float] = []
+    for fpath in (OFFSPOT_CONFIGURATION, OFFSPOT_DEMOS_CONFIG_PATH):
+        try:
+            mtimes.append(fpath.stat().st_mtime)
+        except FileNotFoundError:
+            mtimes.append(0.0)
+    return tuple(mtimes)
+
+
+class Reconciler:
+    def __init__(self, max_parallel: int = OFFSPOT_DEMO_MAX_PARALLEL_JOBS):
+        self.schedules: dict[str, Schedule] = {}
+        # demos being worked on, and those requested again meanwhile
+        self.running: set[str] = set()
+        self.requested: set[str] = set()
+        self.tasks: set[asyncio.Task[None]] = set()
+        self.slots = asyncio.Semaphore(max(max_parallel, 1))
+        self.wakeup = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.config_requested = asyncio.Event()
+        self.config_mtimes: tuple[float, ...] = ()
+
+    def stop(self):
+        logger.info("Stopping…")
+        self.stopping.set()
+
+    async def sleep(self, seconds: float):
+        """sleep for seconds, unless stopping"""
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(self.stopping.wait(), timeout=seconds)
+
+    async def timed(self, name: str, func: Callable[..., Any], *args: Any) -> Any:
+        """result of func ran in a thread (None if it raised), recording timings"""
+        started_on, start = time.time(), time.monotonic()
+        result, error = None, ""
+        try:
+            result = await asyncio.to_thread(func, *args)
+        except Exception as exc:
+            if not isinstance(exc, ReconcileError):
+                logger.exception(exc)
+            error = str(exc) or type(exc).__name__
+        except SystemExit as exc:
+            # would otherwise end the event loop, stopping the reconciler
+            error = f"exited with {exc.code}"
+        duration = time.monotonic() - start
+        logger.info(
+            f"[{name}] {f'failed: {error}' if error else result or 'done'} "
+            f"in {duration:.1f}s"
+        )
+        await asyncio.to_thread(state.record_loop, name, started_on, duration, error)
+        return result
+
+    def schedule(self, idents: Iterable[str], delay: float = 0.0):
+        """reconcile those demos within delay seconds"""
+        due_on = time.monotonic() + delay
+        for ident in idents:
+            schedule = self.schedules.setdefault(ident, Schedule(next_on=due_on))
+            schedule.next_on = min(schedule.next_on, due_on)
+            if ident in self.running:
+                self.requested.add(ident)
+        self.wakeup.set()
+
+    def on_trigger(self, trigger: Trigger) -> list[str] | None:
+        """schedule what trigger asks for ; None if it targets unknown demos"""
+        if trigger.kind == CONFIG:
+            self.config_requested.set()
+            return []
+        if unknown := [
+            ident
+            for ident in trigger.idents
+            if ident not in DEPLOYMENTS and ident not in self.schedules
+        ]:
+            logger.warning(f"Ignoring trigger for unknown demos: {unknown}")
+            return None
+        self.schedule(trigger.idents)
+        return trigger.idents
+
+    async def reload_config(self):
+        """reload deployments from config files, scheduling affected demos"""
+        self.config_mtimes = get_config_mtimes()
+        try:
+            deployments = await asyncio.to_thread(load_configured_deployments)
+        except Exception as exc:
+            logger.error(f"Failed to load config, keeping previous one: {exc}")
+            return
+        before = set(DEPLOYMENTS)
+        replace_deployments(deployments)
+        prepared = await asyncio.to_thread(state.get_prepared_idents)
+        pending = await asyncio.to_thread(load_pending_changes)
+        logger.info(f"Config loaded: {len(deployments)} demos, {len(pending)} changes")
+        # new demos are due right away (as are all on start)
+        for ident in deployments:
+            self.schedules.setdefault(ident, Schedule())
+        self.schedule(
+            (deployments.keys() - before)
+            | (prepared - deployments.keys())
+            | pending.keys()
+        )
+
+    async def config_loop(self):
+        fetched_on = -float(OFFSPOT_DEMO_CONFIG_INTERVAL)
+        while not self.stopping.is_set():
+            if time.monotonic() - fetched_on >= OFFSPOT_DEMO_CONFIG_INTERVAL:
+                fetched_on = time.monotonic()
+                await self.timed("config", check_and_record)
+            if get_config_mtimes() != self.config_mtimes:
+                await self.reload_config()
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(
+                    self.config_requested.wait(), timeout=CONFIG_WATCH_INTERVAL
+                )
+            # triggered: fetch right away
+            if self.config_requested.is_set():
+                self.config_requested.clear()
+                fetched_on = -float(OFFSPOT_DEMO_CONFIG_INTERVAL)
+
+    async def reconcile(self, ident: str):
+        async with self.slots:
+            outcome = await self.timed(f"demo:{ident}", reconcile_demo, ident)
+
+        self.running.discard(ident)
+        schedule = self.schedules[ident]
+        if ident in self.requested:
+            self.requested.discard(ident)
+            schedule.next_on = time.monotonic()
+        elif ident not in DEPLOYMENTS and outcome is not None:
+            # undeployed (or never deployed)
+            del self.schedules[ident]
+            self.wakeup.set()
+            return
+        else:
+            schedule.after(outcome, time.monotonic())
+        await asyncio.to_thread(
+            state.schedule_loop,
+            f"demo:{ident}",
+            time.time() + schedule.next_on - time.monotonic(),
+        )
+        self.wakeup.set()
+
+    async def demos_loop(self):
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for ident, schedule in list(self.schedules.items()):
+                if schedule.next_on <= now and ident not in self.running:
+                    self.running.add(ident)
+                    task = asyncio.create_task(self.reconcile(ident))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+            next_on = min(
+                (
+                    schedule.next_on
+                    for ident, schedule in self.schedules.items()
+                    if ident not in self.running
+                ),
+                default=now + OFFSPOT_DEMO_RECONCILE_INTERVAL,
+            )
+            self.wakeup.clear()
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(
+                    self.wakeup.wait(), timeout=max(next_on - now, 0.1)
+                )
+
+    async def hibernation_loop(self):
+        if not OFFSPOT_DEMO_IDLE_TIMEOUT:
+            return
+        while not self.stopping.is_set():
+            await self.sleep(HIBERNATION_INTERVAL)
+            # demos being reconciled are left alone
+            idents = [ident for ident in DEPLOYMENTS if ident not in self.running]
+            self.running.update(idents)
+            try:
+                await self.timed(
+                    "hibernation",
+                    hibernate_idle,
+                    [refreshed(DEPLOYMENTS[ident]) for ident in idents],
+                )
+            finally:
+                self.running.difference_update(idents)
+                self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+
+        loops = [
+            asyncio.create_task(coro)
+            for coro in (self.config_loop(), self.demos_loop(), self.hibernation_loop())
+        ]
+        server = None
+        if OFFSPOT_DEMO_TRIGGER_TOKEN:
+            server = await serve_triggers(
+                self.on_trigger,
+                host=OFFSPOT_DEMO_TRIGGER_HOST,
+                port=OFFSPOT_DEMO_TRIGGER_PORT,
+                token=OFFSPOT_DEMO_TRIGGER_TOKEN,
+            )
+            logger.info(
+                f"Triggers on {OFFSPOT_DEMO_TRIGGER_HOST}:{OFFSPOT_DEMO_TRIGGER_PORT}"
+            )
+        else:
+            logger.info("No OFFSPOT_DEMO_TRIGGER_TOKEN: triggers disabled")
+
+        await self.stopping.wait()
+        if server:
+            server.close()
+        for task in loops:
+            task.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+        if self.tasks:
+            logger.info(f"Waiting for {len(self.tasks)} running reconciliations")
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-reconciler",
+        description="Continuously deploy, update and undeploy demos per config",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="debug",
+        default=False,
+        help="Activate debug logs",
+    )
+
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    if not is_root():
+        sys.exit(fail("must be root", 1))
+
+    try:
+        asyncio.run(Reconciler().run())
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
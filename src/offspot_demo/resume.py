@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""Resume all demos after a host reboot
+
+Loop-devices and mounts don't survive a reboot. Instead of redeploying each demo,
+those which image and prepared compose are still on disk are re-attached and
+mounted (in parallel) then started off their prepared compose (concurrently),
+multi-proxy being refreshed once all are up. Others are left to update-watcher.
+
+Hibernated demos and those in maintenance are mounted but not started.
+Runs once on boot (demo-resume.service), before demo-reconciler."""
+
+import argparse
+import functools
+import logging
+import sys
+import time
+from collections.abc import Iterable
+
+from offspot_demo import logger
+from offspot_demo.constants import Mode
+from offspot_demo.toggle import toggle_demo
+from offspot_demo.utils import fail, is_root
+from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
+from offspot_demo.utils.image import attach_image, get_mount_points, mount_on
+from offspot_demo.utils.locks import (
+    LOOP_DEVICES,
+    RESOURCE_LOCK_TIMEOUT,
+    lock,
+    locking_demo,
+)
+from offspot_demo.utils.migration import migrate_legacy_layouts
+from offspot_demo.utils.multiproxy import reconfigure_multiproxy
+from offspot_demo.utils.scheduler import Job, run_jobs
+
+
+def get_unresumable_reason(deployment: Deployment) -> str:
+    """why deployment can't be resumed (empty if it can)"""
+    if not deployment.is_already_prepared:
+        return "not prepared"
+    if not deployment.image_path.exists():
+        return "no image on disk"
+    if not all(
+        replica.image_compose_path.exists()
+        for replica in deployment.replica_deployments
+    ):
+        return "no prepared compose"
+    return ""
+
+
+def remount(deployment: Deployment) -> int:
+    """attach deployment's image to a free loop-device and mount its data partition
+
+    not limited by the mount stage: attaching is atomic (see attach_image) and
+    only holds the loop-devices lock (against deploys' find-then-attach) briefly"""
+    try:
+        with lock(LOOP_DEVICES, timeout=RESOURCE_LOCK_TIMEOUT, purpose=str(deployment)):
+            loop_dev = attach_image(deployment.image_path)
+    except Exception as exc:
+        logger.debug(exc)
+        return fail(f"Failed to attach {deployment.image_path}: {exc}")
+
+    deployment.target_dir.mkdir(parents=True, exist_ok=True)
+    if not mount_on(
+        dev_path=f"{loop_dev}p3", mount_point=deployment.target_dir, filesystem="ext4"
+    ):
+        return fail(f"Failed to mount {loop_dev}p3 to {deployment.target_dir}")
+    logger.info(f"[{deployment}] {deployment.image_path.name} mounted off {loop_dev}")
+    return 0
+
+
+@locking_demo
+def resume_for(deployment: Deployment, *, mounted: bool) -> int:
+    """mount deployment's image (unless mounted) and start its prepared compose"""
+    if not mounted and (rc := remount(deployment)):
+        return rc
+    if deployment.is_hibernated or deployment.is_in_maintenance:
+        logger.info(f"[{deployment}] stopped on purpose, not starting")
+        return 0
+    return toggle_demo(deployment, mode=Mode.IMAGE)
+
+
+def resume_all(deployments: Iterable[Deployment]) -> int:
+    """resume all resumable deployments at once ; 0 if all were"""
+    started_on = time.monotonic()
+    mount_points = get_mount_points()
+    jobs: list[Job] = []
+    for deployment in deployments:
+        if reason := get_unresumable_reason(deployment):
+            logger.warning(f"[{deployment}] {reason}: left to update-watcher")
+            continue
+        jobs.append(
+            Job(
+                name=f"resume {deployment.ident}",
+                func=functools.partial(
+                    resume_for,
+                    deployment,
+                    mounted=deployment.target_dir in mount_points,
+                ),
+            )
+        )
+
+    run_jobs(jobs, max_parallel=len(jobs))
+    if jobs:
+        reconfigure_multiproxy()
+
+    resumed = [job for job in jobs if job.succeeded]
+    logger.info(
+        f"Resumed {len(resumed)}/{len(jobs)} demos "
+        f"in {time.monotonic() - started_on:.1f}s"
+    )
+    return 0 if len(resumed) == len(jobs) else 1
+
+
+def resume(idents: list[str]) -> int:
+    if not is_root():
+        return fail("must be root", 1)
+
+    if unknown := [ident for ident in idents if ident not in DEPLOYMENTS]:
+        return fail(f"Unknown demos: {', '.join(unknown)}")
+    # those are left to update-watcher, once in the blue slot
+    migrate_legacy_layouts()
+    return resume_all(
+        deployment
+        for ident, deployment in DEPLOYMENTS.items()
+        if not idents or ident in idents
+    )
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-resume",
+        description="Mount and start all demos off their prepared images (on boot)",
+    )
+    parser.add_argument(dest="idents", nargs="*", help="Demos to resume (all if none)")
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="debug",
+        default=False,
+        help="Activate debug logs",
+    )
+
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    try:
+        sys.exit(resume(args.idents))
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""Rollback a demo to the previous version kept in its other slot
+
+The image rolled back from is not redeployed by update-watcher (nor
+demo-reconciler) until a different one is published (or demo-deploy is run)"""
+
+import argparse
+import logging
+import sys
+
+from offspot_demo import logger
+from offspot_demo.deploy import rollback_for
+from offspot_demo.utils.deployment import DEPLOYMENTS
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-rollback",
+        description="Restart the previous version of a demo and switch to it",
+    )
+    parser.add_argument(dest="ident", help="Deployment/image identifier")
+
+    args = parser.parse_args()
+    logger.setLevel(logging.DEBUG)
+
+    try:
+        sys.exit(rollback_for(DEPLOYMENTS[args.ident]))
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""Report the state of deployments (or demo-reconciler's loops, or locks held)
+
+Answers from the state store only: neither docker nor the filesystem (mounted
+images, compose files) are queried so it is instant, even mid-deploy."""
+
+import argparse
+import dataclasses
+import json
+import sys
+import time
+
+from offspot_demo import logger
+from offspot_demo.utils import state
+from offspot_demo.utils.locks import get_holders
+
+
+def format_age(timestamp: float | None, now: float) -> str:
+    if timestamp is None:
+        return "-"
+    seconds = int(now - timestamp)
+    if seconds < 60:  # noqa: PLR2004
+        return f"{seconds}s"
+    if seconds < 3600:  # noqa: PLR2004
+        return f"{seconds // 60}m"
+    if seconds < 86400:  # noqa: PLR2004
+        return f"{seconds // 3600}h"
+    return f"{seconds // 86400}d"
+
+
+def get_flags(slot: state.SlotState) -> list[str]:
+    return [
+        flag
+        for flag in ("prepared", "verified", "hibernated", "maintenance")
+        if getattr(slot, flag)
+    ]
+
+
+def format_demo(demo: state.DemoState, now: float) -> list[str]:
+    lines = [f"{demo.ident} (active: {demo.active_slot or '-'})"]
+    if demo.last_image_url:
+        lines.append(f"  serving {demo.last_image_url}")
+    if demo.rolled_back_from:
+        lines.append(f"  rolled back from {demo.rolled_back_from}")
+    for slot in demo.slots.values():
+        marker = "*" if slot.slot == demo.active_slot else " "
+        duration = f" deployed in {slot.duration:.0f}s" if slot.duration else ""
+        lines.append(
+            f" {marker}{slot.slot}: {slot.phase or 'unknown'} "
+            f"for {format_age(slot.phase_since, now)}{duration} "
+            f"[{','.join(get_flags(slot))}]"
+        )
+        lines.append(
+            f"    ports: {slot.http_ports or '-'} "
+            f"(captive: {slot.captive_http_port or '-'}) "
+            f"subdomains: {slot.subdomains or '-'}"
+        )
+        if slot.image_url:
+            lines.append(f"    image: {slot.image_url} (etag: {slot.image_etag})")
+        if slot.last_error:
+            lines.append(f"    error: {slot.last_error}")
+    return lines
+
+
+def format_loop(loop: state.LoopState, now: float) -> str:
+    next_run = (
+        f", next in {format_age(now, loop.next_run_on)}"
+        if loop.next_run_on and loop.next_run_on > now
+        else ""
+    )
+    line = (
+        f"{loop.name}: {loop.runs} runs ({loop.failures} failed), "
+        f"last {format_age(loop.last_started_on, now)} ago "
+        f"in {loop.last_duration or 0:.1f}s, "
+        f"average {loop.average_duration:.1f}s{next_run}"
+    )
+    if loop.last_error:
+        line += f" [error: {loop.last_error}]"
+    return line
+
+
+def report_loops(*, as_json: bool) -> int:
+    loops = state.get_loops()
+    if as_json:
+        sys.stdout.write(
+            json.dumps([dataclasses.asdict(loop) for loop in loops], indent=2) + "\n"
+        )
+        return 0
+    if not loops:
+        sys.stdout.write("No demo-reconciler loop recorded\n")
+    now = time.time()
+    for loop in loops:
+        sys.stdout.write(format_loop(loop, now) + "\n")
+    return 0
+
+
+def report_locks(*, as_json: bool) -> int:
+    holders = get_holders()
+    if as_json:
+        sys.stdout.write(
+            json.dumps([dataclasses.asdict(holder) for holder in holders], indent=2)
+            + "\n"
+        )
+        return 0
+    if not holders:
+        sys.stdout.write("No lock held\n")
+    for holder in holders:
+        sys.stdout.write(f"{holder.name}: {holder}\n")
+    return 0
+
+
+def report_status(idents: list[str], *, as_json: bool) -> int:
+    demos = [demo for demo in state.get_demos() if not idents or demo.ident in idents]
+    if as_json:
+        sys.stdout.write(
+            json.dumps([dataclasses.asdict(demo) for demo in demos], indent=2) + "\n"
+        )
+        return 0
+
+    if not demos:
+        sys.stdout.write("No deployment recorded\n")
+    now = time.time()
+    for demo in demos:
+        sys.stdout.write("\n".join(format_demo(demo, now)) + "\n")
+    return 0
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-status",
+        description="Show recorded state of deployments (phase, ports, image, error)",
+    )
+    parser.add_argument(
+        dest="idents", nargs="*", help="Only show those demos. Defaults to all"
+    )
+    parser.add_argument(
+        "--loops",
+        dest="loops",
+        action="store_true",
+        default=False,
+        help="Show demo-reconciler's loops timings instead",
+    )
+    parser.add_argument(
+        "--locks",
+        dest="locks",
+        action="store_true",
+        default=False,
+        help="Show locks held on demos and resources (and by whom) instead",
+    )
+    parser.add_argument(
+        "--json",
+        dest="as_json",
+        action="store_true",
+        default=False,
+        help="Output as JSON",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        if args.loops:
+            sys.exit(report_loops(as_json=args.as_json))
+        if args.locks:
+            sys.exit(report_locks(as_json=args.as_json))
+        sys.exit(report_status(args.idents, as_json=args.as_json))
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
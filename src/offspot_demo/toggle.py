@@ -2,83 +2,79 @@
 
 import argparse
 import logging
+import shutil
 import sys
-from time import sleep
+import time
 
 from offspot_demo import logger
-from offspot_demo.constants import (
-    JINJA_ENV,
-    SRC_PATH,
-    STARTUP_DURATION,
-    Mode,
-)
+from offspot_demo.constants import STARTUP_DURATION, Mode
 from offspot_demo.utils import fail
-from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
-from offspot_demo.utils.docker import is_demo_healthy, start_demo, stop_demo
-
-
-def write_maint_compose(deployment: Deployment):
-    """Render the maintenance docker-compose to customize local stuff"""
-    logger.info("Rendering maintenance docker-compose")
-    deployment.maint_compose_path.parent.mkdir(parents=True, exist_ok=True)
-    deployment.maint_compose_path.write_text(
-        JINJA_ENV.from_string(
-            """
-services:
-  maint:
-    build: {{ src_path }}/maint-compose/
-    environment:
-      - FQDN={{ fqdn }}
-    ports:
-      - {{ http_port }}:80
-
-"""
-        ).render(
-            src_path=SRC_PATH, fqdn=deployment.fqdn, http_port=deployment.http_port
-        )
-    )
+from offspot_demo.utils.compose_plan import start_demos
+from offspot_demo.utils.deployment import DEPLOYMENTS, MAX_REPLICAS, Deployment
+from offspot_demo.utils.docker import stop_compose, stop_demo
+from offspot_demo.utils.locks import locking_demo
+from offspot_demo.utils.multiproxy import reconfigure_multiproxy
+from offspot_demo.utils.process import CommandError
+from offspot_demo.utils.readiness import wait_until_replicas_ready
 
 
+@locking_demo
 def toggle_demo(deployment: Deployment, mode: Mode) -> int:
     logger.info(f"toggle-demo {deployment!s} {mode=}")
 
-    if not deployment.maint_compose_installed:
-        write_maint_compose(deployment=deployment)
-
-    logger.info("Stopping compose")
-    stop_demo(deployment)
+    if mode == Mode.MAINT:
+        # multi-proxy answers for the demo before it stops
+        logger.info("Flagging demo in maintenance")
+        deployment.set_maintenance()
+        reconfigure_multiproxy()
+        logger.info("Stopping compose")
+        stop_demo(deployment)
+        return 0
+
+    replicas = deployment.replica_deployments
+    for replica in range(len(replicas), MAX_REPLICAS):
+        stale = deployment.in_replica(replica)
+        if stale.compose_dir.exists():
+            logger.info(f"Removing {stale}")
+            stop_compose(stale)
+            shutil.rmtree(stale.compose_dir)
 
     logger.info("Updating symlink")
-
-    deployment.compose_path.unlink(missing_ok=True)
-    if mode == Mode.IMAGE:
-        deployment.compose_path.symlink_to(deployment.image_compose_path)
-    else:
-        deployment.compose_path.symlink_to(deployment.maint_compose_path)
+    for replica in replicas:
+        replica.compose_path.unlink(missing_ok=True)
+        replica.compose_path.symlink_to(replica.image_compose_path)
 
     logger.info("Starting compose")
-    start_demo(deployment)
+    started_on = time.time()
+    try:
+        start_demos(replicas)
+    except CommandError as exc:
+        return fail(f"Failed to start compose: {exc}")
 
-    logger.info(
-        f"Sleeping {STARTUP_DURATION} seconds to check system status still ok after a"
-        " while"
+    logger.info(f"Waiting up to {STARTUP_DURATION} seconds for demo to be ready")
+    readiness = wait_until_replicas_ready(
+        replicas, since=started_on, timeout=STARTUP_DURATION
     )
-    sleep(STARTUP_DURATION)
-
-    logger.info("Checking compose is still running")
-    if not is_demo_healthy(deployment):
-        return fail("Compose is not properly running")
-
+    if not readiness.ready:
+        return fail(f"Compose is not properly running: {readiness.reason}")
+
+    logger.info(f"> ready in {readiness.duration:.1f}s")
+    # explicitly started: not hibernated anymore
+    deployment.set_hibernated(hibernated=False)
+    if deployment.is_in_maintenance:
+        logger.info("Removing maintenance flag")
+        deployment.set_maintenance(maintenance=False)
+        reconfigure_multiproxy()
     return 0
 
 
 def get_mode(deployment: Deployment) -> Mode:
-    """modes currently active"""
+    """mode currently active"""
     # WARN: symlink doesn't tell whether compose is running or not
-    # and if it was launched with a different one
     return (
         Mode.IMAGE
-        if deployment.compose_path.resolve() == deployment.image_compose_path
+        if not deployment.is_in_maintenance
+        and deployment.compose_path.resolve() == deployment.image_compose_path
         else Mode.MAINT
     )
 
@@ -102,7 +98,7 @@ def entrypoint():
 
     try:
         mode = Mode[args.mode.upper()]
-        sys.exit(toggle_demo(deployment=DEPLOYMENTS[args.ident], mode=mode))
+        sys.exit(toggle_demo(DEPLOYMENTS[args.ident], mode=mode))
     except Exception as exc:
         logger.exception(exc)
         logger.critical(str(exc))
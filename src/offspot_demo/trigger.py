@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""Ask demo-reconciler to reconcile demos (or config) right away"""
+
+import argparse
+import logging
+import sys
+from http import HTTPStatus
+
+import requests
+
+from offspot_demo import logger
+from offspot_demo.constants import (
+    DEFAULT_HTTP_TIMEOUT_SECONDS,
+    OFFSPOT_DEMO_TRIGGER_HOST,
+    OFFSPOT_DEMO_TRIGGER_PORT,
+    OFFSPOT_DEMO_TRIGGER_TOKEN,
+)
+from offspot_demo.utils import fail
+from offspot_demo.utils.trigger import CONFIG, IMAGE
+
+
+def trigger(kind: str, idents: list[str]) -> int:
+    if not OFFSPOT_DEMO_TRIGGER_TOKEN:
+        return fail("OFFSPOT_DEMO_TRIGGER_TOKEN is not set")
+    if kind == IMAGE and not idents:
+        return fail("No demo to trigger")
+
+    path = "/config" if kind == CONFIG else f"/images/{','.join(idents)}"
+    resp = requests.post(
+        f"http://{OFFSPOT_DEMO_TRIGGER_HOST}:{OFFSPOT_DEMO_TRIGGER_PORT}{path}",
+        headers={"Authorization": f"Bearer {OFFSPOT_DEMO_TRIGGER_TOKEN}"},
+        timeout=DEFAULT_HTTP_TIMEOUT_SECONDS,
+    )
+    if resp.status_code != HTTPStatus.ACCEPTED:
+        return fail(f"Trigger refused ({resp.status_code}): {resp.text.strip()}")
+    logger.info(f"Triggered: {resp.json()}")
+    return 0
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-trigger",
+        description="Reconcile demos (updated image) or config right away",
+    )
+    parser.add_argument(
+        dest="kind",
+        choices=[IMAGE, CONFIG],
+        help="`image` for demos which image was updated, `config` if it changed",
+    )
+    parser.add_argument(dest="idents", nargs="*", help="Demos to reconcile (image)")
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="debug",
+        default=False,
+        help="Activate debug logs",
+    )
+
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    try:
+        sys.exit(trigger(args.kind, args.idents))
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
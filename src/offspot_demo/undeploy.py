@@ -17,11 +17,17 @@ import requests.exceptions
 
 from offspot_demo import logger
 from offspot_demo.deploy import unmount_detach_release
-from offspot_demo.utils import fail, is_root
-from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
+from offspot_demo.utils import fail, is_root, state
+from offspot_demo.utils.deployment import (
+    DEPLOYMENTS,
+    SLOTS,
+    Deployment,
+)
 from offspot_demo.utils.docker import stop_demo
+from offspot_demo.utils.locks import locking_demo
 
 
+@locking_demo
 def undeploy_for(deployment: Deployment, *, keep_image: bool):
     try:
         deployment.download_url  # noqa: B018
@@ -36,21 +42,25 @@ def undeploy_for(deployment: Deployment, *, keep_image: bool):
     if not is_root():
         return fail("must be root", 1)
 
-    logger.info("> stopping compose")
-    stop_demo(deployment)
+    for slot in SLOTS:
+        slot_deployment = deployment.in_slot(slot)
+        logger.info(f"> stopping {slot} compose")
+        stop_demo(slot_deployment)
 
-    rc = unmount_detach_release(deployment)
-    if rc:
-        return fail("Unable to release image", rc)
+        rc = unmount_detach_release(slot_deployment)
+        if rc:
+            return fail("Unable to release image", rc)
 
-    if not keep_image:
-        logger.info("> removing image file")
-        deployment.image_path.unlink(missing_ok=True)
-        logger.info("> removing temp image file")
-        deployment.tmp_image_path.unlink(missing_ok=True)
+        if not keep_image:
+            logger.info(f"> removing {slot} image file")
+            slot_deployment.image_path.unlink(missing_ok=True)
+            logger.info(f"> removing {slot} temp image file")
+            slot_deployment.tmp_image_path.unlink(missing_ok=True)
 
-    logger.info("> removing data dir")
-    shutil.rmtree(deployment.target_dir, ignore_errors=True)
+        logger.info(f"> removing {slot} data dir")
+        shutil.rmtree(slot_deployment.target_dir, ignore_errors=True)
+    shutil.rmtree(deployment.target_dir.parent, ignore_errors=True)
+    state.remove_demo(deployment.ident)
 
 
 def entrypoint():
@@ -71,7 +81,7 @@ def entrypoint():
     logger.setLevel(logging.DEBUG)
 
     try:
-        sys.exit(undeploy_for(deployment=DEPLOYMENTS[args.ident], keep_image=args.keep))
+        sys.exit(undeploy_for(DEPLOYMENTS[args.ident], keep_image=args.keep))
     except Exception as exc:
         logger.exception(exc)
         logger.critical(str(exc))
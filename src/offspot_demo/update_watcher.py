@@ -1,68 +1,118 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import logging
 import sys
 
 from offspot_demo import logger
-from offspot_demo.constants import OFFSPOT_DEMO_TARGET_ROOT_DIR
-from offspot_demo.deploy import deploy_for, reconfigure_multiproxy
+from offspot_demo.deploy import deploy_for, reprepare_for
+from offspot_demo.heal import heal_for
+from offspot_demo.resume import get_unresumable_reason, resume_for
 from offspot_demo.undeploy import undeploy_for
 from offspot_demo.utils import fail, is_root
+from offspot_demo.utils.config_diff import clear_change, load_pending_changes
 from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
-from offspot_demo.utils.docker import is_demo_healthy
-
-
-def check_and_deploy():
-    """Check if a new image has to be deployed, and deploy it"""
-    if not is_root():
+from offspot_demo.utils.hibernation import hibernate_idle
+from offspot_demo.utils.migration import migrate_legacy_layouts
+from offspot_demo.utils.multiproxy import reconfigure_multiproxy
+from offspot_demo.utils.planner import (
+    DEPLOY,
+    HEAL,
+    REDEPLOY,
+    REPREPARE,
+    RESUME,
+    UNDEPLOY,
+    Action,
+    Plan,
+    make_plan,
+)
+from offspot_demo.utils.scheduler import Job, run_jobs
+
+
+def apply_action(deployment: Deployment, action: Action) -> int:
+    """run a planned action on deployment ; 0 once it's done"""
+    logger.info(f"[{deployment}] {action.kind}: {action.reason}")
+    if action.kind == UNDEPLOY:
+        return undeploy_for(deployment, keep_image=False) or 0
+    if action.kind == REPREPARE:
+        return reprepare_for(deployment)
+    if action.kind == HEAL:
+        return heal_for(deployment)
+    if action.kind == RESUME:
+        if not (reason := get_unresumable_reason(deployment)):
+            return resume_for(deployment, mounted=False)
+        logger.info(f"[{deployment}] Can't resume ({reason}). redeploying")
+
+    rc = deploy_for(
+        deployment, reuse_image=action.kind in (REDEPLOY, RESUME), force_prepare=True
+    )
+    if rc:
+        logger.error(f"[{deployment}] Failed to deploy. Skipping")
+        return rc
+    # redeploys restart the image on disk (may be one rolled back to)
+    if action.kind == DEPLOY:
+        logger.info(f"[{deployment}] Deploy OK, persisting last image url")
+        deployment.write_last_image_url()
+    return 0
+
+
+def execute_plan(plan: Plan, deployments: dict[str, Deployment]) -> set[str]:
+    """run plan's actions concurrently then refresh multi-proxy ; idents failed
+
+    a failure only affects its demo"""
+    jobs = {
+        action.ident: Job(
+            name=f"{action.kind} {action.ident}",
+            func=functools.partial(
+                apply_action,
+                deployments.get(action.ident) or Deployment.using(ident=action.ident),
+                action,
+            ),
+        )
+        for action in plan.actions
+    }
+    run_jobs(list(jobs.values()))
+    if plan.refresh_proxy:
+        logger.info("Refreshing multi-proxy")
+        reconfigure_multiproxy()
+    return {ident for ident, job in jobs.items() if not job.succeeded}
+
+
+def check_and_deploy(*, dry_run: bool = False):
+    """Plan what's needed to bring demos up to date, and do it (or print it)"""
+    if not dry_run and not is_root():
         return fail("must be root", 1)
 
-    reconfigure_multiproxy()
+    # demos deployed before slots are redeployed in the blue one
+    if not dry_run:
+        migrate_legacy_layouts()
 
-    # existing deployments (assumed to be running but we dont check that)
-    # are tested for the prepared.ok file which is created near end of deployment
-    # this allows maint-mode to be enabled without the script overwritting the depl
-    existing_idents: list[str] = [
-        fpath.parent.name for fpath in OFFSPOT_DEMO_TARGET_ROOT_DIR.rglob("prepared.ok")
-    ]
+    # changes to demos config recorded by config-watcher. Those handled are cleared
+    changes = load_pending_changes()
+
+    plan = make_plan(DEPLOYMENTS.values(), changes)
+    if dry_run:
+        sys.stdout.write("".join(f"{line}\n" for line in plan.describe()))
+        return 0
 
-    for ident in [
-        ident for ident in existing_idents if ident not in DEPLOYMENTS.keys()
-    ]:
-        logger.info(f"Undeploying previous deployment {ident}")
-        undeploy_for(Deployment.using(ident=ident), keep_image=False)
+    failed = execute_plan(plan, DEPLOYMENTS)
+    # one by one: changes recorded meanwhile are kept
+    for change in changes.values():
+        if change.ident not in failed | plan.deferred:
+            clear_change(change)
 
     if not DEPLOYMENTS:
         logger.info("No deployment in config")
         return 0
 
-    for deployment in DEPLOYMENTS.values():
-        logger.info(f"[{deployment}] Checking…")
-        is_healthy = is_demo_healthy(deployment)
-        has_new_image = deployment.has_new_image
-        if is_healthy and not has_new_image:
-            logger.info("> image has not been updated")
-            continue
-
-        if is_healthy:
-            logger.info(f"[{deployment}] Image has been updated. re-deploying")
-        else:
-            logger.info(f"[{deployment}] Deployment is not running. deploying")
-
-        if (
-            deploy_for(
-                deployment,
-                reuse_image=deployment.image_path.exists() and not has_new_image,
-                force_prepare=True,
-            )
-            == 0
-        ):
-            logger.info("> Deploy OK, persisting last image url")
-            deployment.write_last_image_url()
-        else:
-            logger.error("Failed to deploy. Skipping")
-        continue
+    # stop demos without recent request ; demo-waker starts them on request
+    # (those just started are not, as they were not running when planned)
+    hibernate_idle(
+        DEPLOYMENTS.values(),
+        {ident: actual.running for ident, actual in plan.actual.items()},
+    )
+    return 0
 
 
 def entrypoint():
@@ -71,6 +121,13 @@ def entrypoint():
         description="Watch offspot demo Image URL updates and trigger deployments",
     )
 
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        dest="dry_run",
+        default=False,
+        help="Print what would be done, without doing it",
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -84,7 +141,7 @@ def entrypoint():
         logger.setLevel(logging.DEBUG)
 
     try:
-        sys.exit(check_and_deploy())
+        sys.exit(check_and_deploy(dry_run=args.dry_run))
     except Exception as exc:
         logger.exception(exc)
         logger.critical(str(exc))
@@ -1,16 +1,41 @@
+import contextlib
 import os
 import platform
+import threading
+from collections.abc import Iterator
 
 from offspot_demo import logger
 from offspot_demo.constants import DEBUG
 
+# failure messages recorded in this thread (see recording_failures)
+_failures = threading.local()
+
 
 def fail(message: str = "An error occured", code: int = 1) -> int:
     """shortcut to log an error message and return an error code"""
     logger.error(message)
+    for messages in getattr(_failures, "recorders", []):
+        messages.append(message)
     return code
 
 
+@contextlib.contextmanager
+def recording_failures() -> Iterator[list[str]]:
+    """messages of fail() calls made by this thread within the block"""
+    messages: list[str] = []
+    recorders: list[list[str]] = _failures.__dict__.setdefault("recorders", [])
+    recorders.append(messages)
+    try:
+        yield messages
+    finally:
+        recorders.remove(messages)
+
+
+def describe_failures(messages: list[str]) -> str:
+    """outermost failure first, with its causes: `failed to x: failed to y`"""
+    return ": ".join(reversed(messages))
+
+
 def get_environ() -> dict[str, str]:
     """current environment variable with langs set to C to control cli output"""
     environ = os.environ.copy()
@@ -0,0 +1,98 @@
+"""Cache of prepare_for's output
+
+What prepare_for produces (image-compose, subdomains and rewritten dashboard) only
+depends on the image's content and on a few deployment parameters. It is stored
+per-deployment under a key combining those so it can be restored as-is on the
+(frequent) re-prepare of an unchanged image."""
+
+import dataclasses
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from offspot_demo import logger
+from offspot_demo.__about__ import __version__
+from offspot_demo.constants import OFFSPOT_DEMO_TLS_EMAIL
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.rules import get_compose_rules
+
+# nb of entries kept per deployment ; older ones are removed on store
+PREPARE_CACHE_MAX_ENTRIES = 3
+COMPOSE_NAME = "image-compose.yaml"
+DASHBOARD_NAME = "dashboard.yaml"
+SUBDOMAINS_NAME = "subdomains"
+
+
+def get_prepare_cache_key(deployment: Deployment, image_yaml: str) -> str:
+    """cache key for prepare_for's output for deployment using this image.yaml"""
+    params = {
+        "version": __version__,
+        "ident": deployment.ident,
+        "alias": deployment.alias,
+        "fqdn": deployment.fqdn,
+        "http_port": deployment.http_port,
+        "captive_http_port": deployment.captive_http_port,
+        "tls_email": OFFSPOT_DEMO_TLS_EMAIL,
+        "rules": get_compose_rules().digest,
+        "resources": dataclasses.asdict(deployment.resources),
+        "image_etag": deployment.image_etag,
+        "image_yaml": hashlib.sha256(image_yaml.encode("utf-8")).hexdigest(),
+    }
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def restore_prepared(deployment: Deployment, key: str) -> bool:
+    """whether output cached for key was found and restored into deployment"""
+    entry = deployment.prepare_cache_dir.joinpath(key)
+    if not all(
+        entry.joinpath(name).exists()
+        for name in (COMPOSE_NAME, DASHBOARD_NAME, SUBDOMAINS_NAME)
+    ):
+        return False
+
+    deployment.backup_dashboard()
+    # shared cache outlives the slot's compose dir (removed on teardown)
+    deployment.compose_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(entry / DASHBOARD_NAME, deployment.dashboard_path)
+    shutil.copyfile(entry / COMPOSE_NAME, deployment.image_compose_path)
+    deployment.subdomains = [
+        subdomain
+        for subdomain in entry.joinpath(SUBDOMAINS_NAME).read_text().split(",")
+        if subdomain
+    ]
+    deployment.log_dir.mkdir(parents=True, exist_ok=True)
+
+    # mtime is used to find least-recently used entries
+    entry.touch()
+    return True
+
+
+def store_prepared(deployment: Deployment, key: str):
+    """record deployment's current prepare output in cache under key"""
+    deployment.prepare_cache_dir.mkdir(parents=True, exist_ok=True)
+    entry = deployment.prepare_cache_dir.joinpath(key)
+
+    # write into a temp folder then rename so an entry is never partial
+    with TemporaryDirectory(
+        dir=deployment.prepare_cache_dir, ignore_cleanup_errors=True
+    ) as tmpdir:
+        tmp_entry = Path(tmpdir).joinpath("entry")
+        tmp_entry.mkdir()
+        shutil.copyfile(deployment.image_compose_path, tmp_entry / COMPOSE_NAME)
+        shutil.copyfile(deployment.dashboard_path, tmp_entry / DASHBOARD_NAME)
+        tmp_entry.joinpath(SUBDOMAINS_NAME).write_text(",".join(deployment.subdomains))
+        shutil.rmtree(entry, ignore_errors=True)
+        tmp_entry.rename(entry)
+
+    entries = sorted(
+        (fpath for fpath in deployment.prepare_cache_dir.iterdir() if fpath.is_dir()),
+        key=lambda fpath: fpath.stat().st_mtime,
+        reverse=True,
+    )
+    for outdated in entries[PREPARE_CACHE_MAX_ENTRIES:]:
+        logger.debug(f"> removing outdated prepare cache {outdated.name}")
+        shutil.rmtree(outdated, ignore_errors=True)
@@ -0,0 +1,145 @@
+"""Minimal set of compose operations to start a deployment
+
+Starting a compose used to be an unconditional down, pull, build then up --build.
+Instead, the current state of the compose project (its containers) and of local
+images is compared with the target compose to only run the steps it requires:
+
+- down: only when the project has containers of services not in target compose
+  (services removed from the image's compose)
+- pull: only services with no build and which image is missing locally. Images are
+  pulled with a versionned tag at prepare time so local ones are current.
+- build: only services with a build which image is missing locally
+- up: always (recreates containers which configuration changed)
+"""
+
+import contextlib
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.docker import (
+    get_local_images,
+    get_project_services,
+    normalize_image_name,
+)
+from offspot_demo.utils.process import run_commands
+from offspot_demo.utils.scheduler import stage
+from offspot_demo.utils.yaml import yaml_load
+
+# in order of execution
+STEPS = ("down", "pull", "build", "up")
+# steps holding a slot of the docker stage
+HEAVY_STEPS = ("pull", "build")
+
+
+@dataclass
+class ComposeStep:
+    name: str
+    args: list[str]
+    reason: str = ""
+
+    def __str__(self) -> str:
+        return f"{self.name} ({self.reason})" if self.reason else self.name
+
+
+@dataclass
+class ComposePlan:
+    deployment: Deployment
+    steps: list[ComposeStep] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return ", ".join(str(step) for step in self.steps)
+
+    def command_for(self, step: ComposeStep) -> list[str]:
+        return [
+            "docker",
+            "compose",
+            "-f",
+            str(self.deployment.compose_path),
+            *step.args,
+        ]
+
+    def run(self):
+        """run all steps, logging their duration"""
+        run_plans([self])
+
+
+def run_plans(plans: list[ComposePlan]):
+    """run plans concurrently, step by step: each step of all plans at once
+
+    raises CommandError once a step failed (in any plan)"""
+    for plan in plans:
+        logger.info(f"> compose plan for {plan.deployment}: {plan}")
+    for name in STEPS:
+        commands = [
+            plan.command_for(step)
+            for plan in plans
+            for step in plan.steps
+            if step.name == name
+        ]
+        if not commands:
+            continue
+        started_on = time.monotonic()
+        # only pulls and builds are heavy: many projects can go up at once
+        with stage("docker") if name in HEAVY_STEPS else contextlib.nullcontext():
+            run_commands(commands)
+        logger.info(
+            f">> {name} ({len(commands)} projects) "
+            f"took {time.monotonic() - started_on:.1f}s"
+        )
+
+
+def plan_start(deployment: Deployment) -> ComposePlan:
+    """steps required to start deployment's current compose"""
+    compose: dict[str, Any] = yaml_load(deployment.compose_path.read_text()) or {}
+    services: dict[str, dict[str, Any]] = compose.get("services") or {}
+    plan = ComposePlan(deployment=deployment)
+
+    if orphans := get_project_services(deployment.compose_project) - services.keys():
+        plan.steps.append(
+            ComposeStep(
+                name="down",
+                args=["down", "--remove-orphans", "--volumes"],
+                reason=f"orphans: {','.join(sorted(orphans))}",
+            )
+        )
+
+    local_images = get_local_images()
+
+    def is_missing(service: dict[str, Any]) -> bool:
+        return (
+            not service.get("image")
+            or normalize_image_name(str(service["image"])) not in local_images
+        )
+
+    if to_pull := [
+        svcname
+        for svcname, service in services.items()
+        if "build" not in service
+        and service.get("pull_policy") not in ("never", "build")
+        and is_missing(service)
+    ]:
+        plan.steps.append(
+            ComposeStep(name="pull", args=["pull", *to_pull], reason=",".join(to_pull))
+        )
+
+    if to_build := [
+        svcname
+        for svcname, service in services.items()
+        if "build" in service and is_missing(service)
+    ]:
+        plan.steps.append(
+            ComposeStep(
+                name="build", args=["build", *to_build], reason=",".join(to_build)
+            )
+        )
+
+    plan.steps.append(ComposeStep(name="up", args=["up", "-d", "--remove-orphans"]))
+    return plan
+
+
+def start_demos(deployments: list[Deployment]):
+    """start deployments' (replicas) current composes concurrently"""
+    run_plans([plan_start(deployment) for deployment in deployments])
@@ -0,0 +1,143 @@
+"""Per-demo changes between two versions of the demos config
+
+config-watcher records the changes it detects as pending ; update-watcher then
+applies the minimal action for each (instead of ignoring healthy demos) and only
+clears changes it handled successfully."""
+
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.constants import OFFSPOT_DEMO_STATE_DIR
+from offspot_demo.utils.locks import PENDING_CHANGES, RESOURCE_LOCK_TIMEOUT, lock
+
+PENDING_CHANGES_PATH = OFFSPOT_DEMO_STATE_DIR / "demos-changes.json"
+
+# demo entered the config: deploy
+ADDED = "added"
+# demo left the config: undeploy
+REMOVED = "removed"
+# a setting requiring a full redeploy changed
+IMAGE = "image"
+# only alias (or other prepare-only setting) changed: re-prepare and restart
+ALIAS = "alias"
+# only name changed: refresh multi-proxy
+NAME = "name"
+# from least to most involved ; a merge of changes keeps the most involved
+KINDS = (NAME, ALIAS, IMAGE, ADDED, REMOVED)
+
+# settings that only affect prepare's output
+PREPARE_KEYS = ("alias", "profile", "resources", "replicas")
+
+
+@dataclass
+class DemoChange:
+    ident: str
+    kind: str
+    fields: list[str] = field(default_factory=list)
+
+    def merged_with(self, newer: "DemoChange") -> "DemoChange | None":
+        """single change equivalent to this one followed by newer (None if void)"""
+        fields = sorted(set(self.fields) | set(newer.fields))
+        if self.kind == ADDED and newer.kind == REMOVED:
+            return None
+        if self.kind == REMOVED and newer.kind == ADDED:
+            return DemoChange(ident=self.ident, kind=IMAGE, fields=fields)
+        if self.kind == ADDED and newer.kind != REMOVED:
+            return DemoChange(ident=self.ident, kind=ADDED, fields=fields)
+        kind = max(self.kind, newer.kind, key=KINDS.index)
+        return DemoChange(ident=self.ident, kind=kind, fields=fields)
+
+
+def normalize(demo: dict[str, Any]) -> dict[str, Any]:
+    """demo config entry with defaults applied (alias and name default to ident)"""
+    normalized = dict(demo)
+    normalized["alias"] = demo.get("alias") or demo["ident"]
+    normalized["name"] = demo.get("name") or demo["ident"]
+    return normalized
+
+
+def diff_demos(
+    previous: list[dict[str, Any]], current: list[dict[str, Any]]
+) -> dict[str, DemoChange]:
+    """changes (by ident) from previous to current demos config entries"""
+    before = {str(demo["ident"]): normalize(demo) for demo in previous}
+    after = {str(demo["ident"]): normalize(demo) for demo in current}
+
+    changes: dict[str, DemoChange] = {}
+    for ident in before.keys() - after.keys():
+        changes[ident] = DemoChange(ident=ident, kind=REMOVED)
+    for ident in after.keys() - before.keys():
+        changes[ident] = DemoChange(ident=ident, kind=ADDED)
+
+    for ident in before.keys() & after.keys():
+        fields = sorted(
+            key
+            for key in before[ident].keys() | after[ident].keys()
+            if before[ident].get(key) != after[ident].get(key)
+        )
+        if not fields:
+            continue
+        if set(fields) <= {"name"}:
+            kind = NAME
+        elif set(fields) <= {"name", *PREPARE_KEYS}:
+            kind = ALIAS
+        else:
+            kind = IMAGE
+        changes[ident] = DemoChange(ident=ident, kind=kind, fields=fields)
+    return changes
+
+
+def load_pending_changes(fpath: Path = PENDING_CHANGES_PATH) -> dict[str, DemoChange]:
+    """changes recorded by config-watcher and not yet handled"""
+    try:
+        payload = json.loads(fpath.read_text())
+    except FileNotFoundError:
+        return {}
+    except Exception as exc:
+        logger.warning(f"Ignoring unreadable pending changes at {fpath}: {exc}")
+        return {}
+    return {entry["ident"]: DemoChange(**entry) for entry in payload}
+
+
+def save_pending_changes(
+    changes: dict[str, DemoChange], fpath: Path = PENDING_CHANGES_PATH
+):
+    """write changes to fpath, atomically so readers never get a partial file"""
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = fpath.with_name(f".{fpath.name}.tmp")
+    tmp_path.write_text(json.dumps([asdict(change) for change in changes.values()]))
+    tmp_path.rename(fpath)
+
+
+def record_changes(
+    changes: dict[str, DemoChange], fpath: Path = PENDING_CHANGES_PATH
+) -> dict[str, DemoChange]:
+    """merge changes into pending ones, returning all pending changes
+
+    config-watcher records them while update-watcher or demo-reconciler (threads)
+    clear them, possibly from other processes: hence the inter-process lock"""
+    with lock(PENDING_CHANGES, timeout=RESOURCE_LOCK_TIMEOUT):
+        pending = load_pending_changes(fpath)
+        for ident, change in changes.items():
+            if ident not in pending:
+                pending[ident] = change
+                continue
+            merged = pending[ident].merged_with(change)
+            if merged:
+                pending[ident] = merged
+            else:
+                del pending[ident]
+        save_pending_changes(pending, fpath)
+    return pending
+
+
+def clear_change(change: DemoChange, fpath: Path = PENDING_CHANGES_PATH):
+    """remove a handled change from pending ones, unless a newer one superseded it"""
+    with lock(PENDING_CHANGES, timeout=RESOURCE_LOCK_TIMEOUT):
+        pending = load_pending_changes(fpath)
+        if pending.get(change.ident) == change:
+            del pending[change.ident]
+            save_pending_changes(pending, fpath)
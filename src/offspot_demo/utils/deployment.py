@@ -1,27 +1,53 @@
+import dataclasses
+import shutil
+from collections.abc import Iterable
 from dataclasses import dataclass, field
 from pathlib import Path
-
-import requests
+from typing import Any
 
 from offspot_demo import logger
 from offspot_demo.constants import (
-    DEFAULT_HTTP_TIMEOUT_SECONDS,
-    IMAGER_SERVICE_API_PASSWORD,
-    IMAGER_SERVICE_API_USERNAME,
     OFFSPOT_DEMO_COMPOSE_ROOT_DIR,
     OFFSPOT_DEMO_IMAGES_ROOT_DIR,
     OFFSPOT_DEMO_MAIN_FQDN,
     OFFSPOT_DEMO_TARGET_ROOT_DIR,
+    OFFSPOT_DEMOS_CONFIG_PATH,
     OFFSPOT_DEMOS_LIST,
 )
+from offspot_demo.utils import state
+from offspot_demo.utils.imager import get_imager_client
+from offspot_demo.utils.resources import ResourceLimits, get_resource_limits
+from offspot_demo.utils.yaml import yaml_load
+
+# each demo has two slots: the active one serves while the other gets staged
+SLOTS = ("blue", "green")
+# ports of a slot are offset from the demo's base port
+SLOT_PORT_OFFSETS = {"blue": 0, "green": 30000}
+
+
+# extra replicas of a demo (see `replicas` setting) use blocks of ports above
+# those of slots and captive portals: blocks are as wide as base ports range
+REPLICAS_PORT_OFFSET = 15000
+REPLICAS_PORT_BLOCK = 5000
+MAX_REPLICAS = 4
+
 
+def port_from(ident: str, slot: str = SLOTS[0], replica: int = 0) -> int:
+    port = 1024 + sum([ord(char) for char in ident.strip().lower()])
+    port += SLOT_PORT_OFFSETS[slot]
+    if replica:
+        port += REPLICAS_PORT_OFFSET + (replica - 1) * REPLICAS_PORT_BLOCK
+    return port
 
-def port_from(ident: str) -> int:
-    return 1024 + sum([ord(char) for char in ident.strip().lower()])
 
+def captive_port_from(ident: str, slot: str = SLOTS[0]) -> int:
+    return 10000 + port_from(ident, slot)
 
-def captive_port_from(ident: str) -> int:
-    return 10000 + port_from(ident)
+
+def get_active_slot(ident: str) -> str:
+    """slot currently serving ident (first one if never deployed)"""
+    slot = state.get_demo(ident.strip()).active_slot
+    return slot if slot in SLOTS else SLOTS[0]
 
 
 @dataclass
@@ -31,6 +57,12 @@ class Deployment:
     name: str
     http_port: int
     captive_http_port: int
+    # blue or green: which set of paths and ports is used
+    slot: str = SLOTS[0]
+    # index of this replica: 0 is the primary one (only with captive portal)
+    replica: int = 0
+    # extra settings from demos config (profile, resources, replicas)
+    settings: dict[str, Any] = field(default_factory=dict)
     _download_url: str = ""
     _subdomains: list[str] = field(default_factory=list)
 
@@ -39,62 +71,102 @@ class Deployment:
             raise ValueError(f"Invalid Deployment data: {self.ident=}, {self.alias=}")
 
     @classmethod
-    def using(cls, ident: str, alias: str = "", name: str = "") -> "Deployment":
-        http_port = port_from(ident)
+    def using(
+        cls,
+        ident: str,
+        alias: str = "",
+        name: str = "",
+        settings: dict[str, Any] | None = None,
+        slot: str | None = None,
+    ) -> "Deployment":
+        """deployment for ident, in its active slot unless specified"""
+        slot = slot or get_active_slot(ident)
         return Deployment(
             ident=ident.strip(),
             alias=alias.strip() or ident.strip(),
             name=name.strip() or ident.strip(),
-            http_port=http_port,
-            captive_http_port=10000 + http_port,
+            http_port=port_from(ident, slot),
+            captive_http_port=captive_port_from(ident, slot),
+            slot=slot,
+            settings=settings or {},
+        )
+
+    def in_slot(self, slot: str) -> "Deployment":
+        """same deployment, in another slot"""
+        return dataclasses.replace(
+            self,
+            slot=slot,
+            http_port=port_from(self.ident, slot, self.replica),
+            captive_http_port=captive_port_from(self.ident, slot),
+            _subdomains=[],
+        )
+
+    def in_replica(self, replica: int) -> "Deployment":
+        """same deployment (same mounted image), as another replica"""
+        return dataclasses.replace(
+            self,
+            replica=replica,
+            http_port=port_from(self.ident, self.slot, replica),
         )
 
+    @property
+    def replicas(self) -> int:
+        """number of replicas to run, from settings"""
+        try:
+            replicas = int(self.settings.get("replicas") or 1)
+        except (TypeError, ValueError):
+            replicas = 1
+        return min(max(replicas, 1), MAX_REPLICAS)
+
+    @property
+    def replica_deployments(self) -> list["Deployment"]:
+        """all replicas to run, primary one first"""
+        return [self.in_replica(replica) for replica in range(self.replicas)]
+
+    @property
+    def other_slot(self) -> str:
+        return SLOTS[1 - SLOTS.index(self.slot)]
+
+    @property
+    def is_active(self) -> bool:
+        return get_active_slot(self.ident) == self.slot
+
+    def activate(self):
+        """record this deployment's slot as the one serving the demo"""
+        state.update_demo(self.ident, active_slot=self.slot)
+
     @property
     def fqdn(self) -> str:
         return f"{self.alias}.{OFFSPOT_DEMO_MAIN_FQDN}"
 
+    @property
+    def resources(self) -> ResourceLimits:
+        return get_resource_limits(
+            profile=self.settings.get("profile"),
+            overrides=self.settings.get("resources"),
+        )
+
     @property
     def image_url(self) -> str:
-        return f"https://api.imager.kiwix.org/auto-images/{self.ident}/json"
+        return get_imager_client().auto_image_url(self.ident)
 
     def get_download_url(self) -> str:
-        imager_service_api_url = "https://api.imager.kiwix.org"
-
-        def _get_imager_api_token(url: str, username: str, password: str) -> str:
-            resp = requests.post(
-                url=f"{url}/auth/authorize",
-                headers={
-                    "username": username,
-                    "password": password,
-                    "Content-type": "application/json",
-                },
-                timeout=DEFAULT_HTTP_TIMEOUT_SECONDS,
-            )
-            resp.raise_for_status()
-            return resp.json()["access_token"]
-
-        headers = {"Content-type": "application/json"}
-        if self.image_url.startswith(imager_service_api_url):
-            headers.update(
-                {
-                    "token": _get_imager_api_token(
-                        url=imager_service_api_url,
-                        username=IMAGER_SERVICE_API_USERNAME,
-                        password=IMAGER_SERVICE_API_PASSWORD,
-                    ),
-                }
-            )
-
-        resp = requests.get(
-            self.image_url, headers=headers, timeout=DEFAULT_HTTP_TIMEOUT_SECONDS
+        return get_imager_client().get_download_url(self.ident)
+
+    @staticmethod
+    def resolve_download_urls(deployments: Iterable["Deployment"]) -> dict[str, str]:
+        """look download URL of deployments up concurrently, caching it on each
+
+        those which failed are missing from the returned URLs (by ident) and are
+        looked up again (and fail) when accessed"""
+        deployments = list(deployments)
+        urls = get_imager_client().resolve_all(
+            deployment.ident for deployment in deployments
         )
-        resp.raise_for_status()
-        payload = resp.json()
-        if not payload.get("http_url"):
-            logger.warning(f"'http_url' not found in response from {self.image_url}")
-            logger.debug(resp.text)
-            raise Exception("Unexpected response from image provider")
-        return payload["http_url"]
+        for deployment in deployments:
+            if deployment.ident in urls:
+                deployment._download_url = urls[deployment.ident]
+        return urls
 
     @property
     def download_url(self) -> str:
@@ -104,11 +176,22 @@ class Deployment:
 
     @property
     def target_dir(self) -> Path:
-        return OFFSPOT_DEMO_TARGET_ROOT_DIR.joinpath(self.ident)
+        return OFFSPOT_DEMO_TARGET_ROOT_DIR.joinpath(self.ident, self.slot)
+
+    @property
+    def compose_project(self) -> str:
+        """compose project name, unique to this slot and replica"""
+        return f"offspot_{self.ident}_{self.slot}{self.replica_suffix}"
+
+    @property
+    def replica_suffix(self) -> str:
+        return f"_r{self.replica}" if self.replica else ""
 
     @property
     def compose_dir(self) -> Path:
-        return OFFSPOT_DEMO_COMPOSE_ROOT_DIR.joinpath(self.ident)
+        return OFFSPOT_DEMO_COMPOSE_ROOT_DIR.joinpath(
+            self.ident, f"{self.slot}{self.replica_suffix}"
+        )
 
     @property
     def compose_path(self) -> Path:
@@ -119,75 +202,196 @@ class Deployment:
     def image_compose_path(self) -> Path:
         return self.compose_dir.joinpath("image-compose.yaml")
 
-    @property
-    def maint_compose_path(self) -> Path:
-        return self.compose_dir.joinpath("maint-compose.yaml")
-
-    @property
-    def maint_compose_installed(self) -> bool:
-        return self.maint_compose_path.exists()
-
     @property
     def image_path(self) -> Path:
-        return OFFSPOT_DEMO_IMAGES_ROOT_DIR / self.ident / "image.img"
+        return OFFSPOT_DEMO_IMAGES_ROOT_DIR / self.ident / self.slot / "image.img"
 
     @property
     def tmp_image_path(self) -> Path:
         return self.image_path.with_suffix(".img.tmp")
 
     @property
-    def last_image_url_path(self) -> Path:
-        return self.image_path.with_name("last_image")
+    def state(self) -> state.SlotState:
+        """recorded state of this deployment's slot"""
+        return state.get_slot(self.ident, self.slot)
+
+    def update_state(self, **values: Any):
+        state.update_slot(self.ident, self.slot, **values)
+
+    def set_phase(self, phase: str, error: str = ""):
+        """record slot's deployment phase (and the ports it uses)"""
+        values: dict[str, Any] = {
+            "http_ports": "|".join(
+                str(replica.http_port) for replica in self.replica_deployments
+            ),
+            "captive_http_port": self.captive_http_port,
+        }
+        if error:
+            values["last_error"] = error
+        state.set_phase(self.ident, self.slot, phase, **values)
 
     @property
     def last_image_url(self) -> str:
-        try:
-            return self.last_image_url_path.read_text()
-        except Exception:
-            return ""
+        """URL of the image serving the demo (whichever the slot)"""
+        return state.get_demo(self.ident).last_image_url
+
+    def write_last_image_url(self, url: str | None = None):
+        """record image URL now serving (deployed: not rolled back from anymore)"""
+        state.update_demo(
+            self.ident, last_image_url=url or self.download_url, rolled_back_from=""
+        )
 
-    def write_last_image_url(self):
-        self.last_image_url_path.parent.mkdir(parents=True, exist_ok=True)
-        self.last_image_url_path.write_text(self.download_url)
+    def record_rollback(self, url: str, rejected_url: str):
+        """record image URL serving after a rollback from rejected_url"""
+        state.update_demo(self.ident, last_image_url=url, rolled_back_from=rejected_url)
 
     @property
-    def prepared_ok_path(self) -> Path:
-        return self.target_dir.joinpath("prepared.ok")
+    def image_etag(self) -> str:
+        """ETag of the image file as advertised by its host when downloaded"""
+        return self.state.image_etag
+
+    @property
+    def image_download_url(self) -> str:
+        """URL this slot's image was downloaded from"""
+        return self.state.image_url
+
+    def record_image(self, etag: str):
+        """record the image just downloaded into this slot (not prepared yet)"""
+        self.update_state(
+            image_url=self.download_url,
+            image_etag=etag,
+            prepared=False,
+            verified=False,
+        )
+
+    @property
+    def is_verified(self) -> bool:
+        """whether slot served successfully through multi-proxy"""
+        return self.state.verified
+
+    def mark_verified(self, *, verified: bool = True):
+        self.update_state(verified=verified)
+
+    @property
+    def can_rollback(self) -> bool:
+        """whether this slot holds a verified version that can be restarted"""
+        return (
+            self.is_verified
+            and self.image_path.exists()
+            and self.image_compose_path.exists()
+        )
+
+    @property
+    def image_yaml_path(self) -> Path:
+        return self.target_dir.joinpath("image.yaml")
+
+    @property
+    def dashboard_path(self) -> Path:
+        return self.target_dir.joinpath("contents", "dashboard.yaml")
+
+    @property
+    def dashboard_orig_path(self) -> Path:
+        """pristine copy of the image's dashboard, before any FQDN rewriting"""
+        return self.target_dir.joinpath("dashboard.orig.yaml")
+
+    def backup_dashboard(self):
+        """keep a pristine copy of the dashboard before it gets rewritten"""
+        if not self.dashboard_orig_path.exists():
+            shutil.copy2(self.dashboard_path, self.dashboard_orig_path)
+
+    @property
+    def log_dir(self) -> Path:
+        """shared by replicas so the primary's metrics sees all requests"""
+        return Path(f"/var/log/offspot-demo_{self.ident}_{self.slot}")
+
+    @property
+    def prepare_cache_dir(self) -> Path:
+        # shared by slots ; ports are part of the cache key
+        return OFFSPOT_DEMO_COMPOSE_ROOT_DIR.joinpath(self.ident, "prepare-cache")
+
+    @property
+    def is_hibernated(self) -> bool:
+        """whether demo is stopped for being idle, to be woken up on request"""
+        return self.state.hibernated
+
+    def set_hibernated(self, *, hibernated: bool = True):
+        self.update_state(hibernated=hibernated)
+
+    @property
+    def is_in_maintenance(self) -> bool:
+        """whether demo is stopped, multi-proxy answering for it"""
+        return self.state.maintenance
+
+    def set_maintenance(self, *, maintenance: bool = True):
+        self.update_state(maintenance=maintenance)
 
     @property
     def is_already_prepared(self) -> bool:
-        return self.prepared_ok_path.exists()
+        return self.state.prepared
+
+    def mark_prepared(self):
+        self.update_state(prepared=True)
 
     @property
     def has_new_image(self) -> bool:
-        return self.get_download_url() != self.last_image_url
+        return self.download_url != self.last_image_url
 
     @property
     def subdomains(self) -> list[str]:
         if not self._subdomains:
-            try:
-                self._subdomains = self.subdomains_path.read_text().split(",")
-            except Exception:
-                ...
+            self._subdomains = [
+                subdomain for subdomain in self.state.subdomains.split(",") if subdomain
+            ]
         return self._subdomains
 
     @subdomains.setter
     def subdomains(self, subdomains: list[str]):
-        self.subdomains_path.write_text(",".join(subdomains))
-
-    @property
-    def subdomains_path(self) -> Path:
-        return self.target_dir.joinpath("subdomains")
+        self._subdomains = subdomains
+        self.update_state(subdomains=",".join(subdomains))
 
     def __str__(self) -> str:
-        return self.ident
+        return f"{self.ident}@{self.slot}" + (
+            f"#{self.replica}" if self.replica else ""
+        )
 
 
-DEPLOYMENTS: dict[str, Deployment] = {
-    entry.split(":", 3)[0]: Deployment.using(
-        ident=entry.split(":", 3)[0],
-        alias=(entry.split(":", 3)[1] or entry.split(":", 3)[0]),
-        name=(entry.split(":", 3)[2] or entry.split(":", 3)[0]),
-    )
-    for entry in OFFSPOT_DEMOS_LIST
-}
+def load_demos_settings(fpath: Path = OFFSPOT_DEMOS_CONFIG_PATH) -> dict[str, Any]:
+    """per-ident demo entries from the local copy of the demos config"""
+    try:
+        payload = yaml_load(fpath.read_text()) or {}
+    except FileNotFoundError:
+        return {}
+    except Exception as exc:
+        logger.warning(f"Unable to read demos config at {fpath}: {exc}")
+        return {}
+    demos: list[dict[str, Any]] = payload.get("demos") or []
+    return {str(demo["ident"]): demo for demo in demos if demo.get("ident")}
+
+
+def load_deployments(
+    entries: list[str], settings: dict[str, Any] | None = None
+) -> dict[str, Deployment]:
+    """deployments (by ident) from ident:alias:name entries of OFFSPOT_DEMOS_LIST"""
+    deployments: dict[str, Deployment] = {}
+    for entry in entries:
+        ident, alias, name = [*entry.split(":", 3), "", ""][:3]
+        deployments[ident] = Deployment.using(
+            ident=ident,
+            alias=alias or ident,
+            name=name or ident,
+            settings=(settings or {}).get(ident),
+        )
+    return deployments
+
+
+def replace_deployments(deployments: dict[str, Deployment]):
+    """update DEPLOYMENTS in place (never empty in between) from a new config"""
+    DEPLOYMENTS.update(deployments)
+    for ident in DEPLOYMENTS.keys() - deployments.keys():
+        DEPLOYMENTS.pop(ident, None)
+
+
+DEMOS_SETTINGS = load_demos_settings()
+DEPLOYMENTS: dict[str, Deployment] = load_deployments(
+    OFFSPOT_DEMOS_LIST, DEMOS_SETTINGS
+)
@@ -1,61 +1,242 @@
-import json
+import collections
+import re
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any, cast
 
 from offspot_demo import logger
-from offspot_demo.utils.deployment import Deployment
-from offspot_demo.utils.process import run_command
+from offspot_demo.constants import OFFSPOT_DEMO_COMPOSE_ROOT_DIR
+from offspot_demo.utils.deployment import MAX_REPLICAS, Deployment
+from offspot_demo.utils.docker_api import DockerAPIError, get_docker_client
+from offspot_demo.utils.process import run_command, run_commands
+from offspot_demo.utils.yaml import yaml_load
 
-
-def start_demo(deployment: Deployment):
-    stop_demo(deployment=deployment)
-    run_command(["docker", "compose", "-f", str(deployment.compose_path), "pull"])
-    run_command(["docker", "compose", "-f", str(deployment.compose_path), "build"])
-    run_command(
-        ["docker", "compose", "-f", str(deployment.compose_path), "up", "--build", "-d"]
-    )
+COMPOSE_PROJECT_LABEL = "com.docker.compose.project"
+COMPOSE_SERVICE_LABEL = "com.docker.compose.service"
 
 
 def stop_demo(deployment: Deployment):
-    run_command(
+    """stop all replicas of deployment (including those not configured anymore)"""
+    run_commands(
         [
-            "docker",
-            "compose",
-            "-f",
-            str(deployment.compose_path),
-            "down",
-            "--remove-orphans",
-            "--volumes",
+            get_down_command(replica)
+            for replica in map(deployment.in_replica, range(MAX_REPLICAS))
+            if replica.compose_dir.exists() and replica.compose_path.exists()
         ],
         failsafe=True,
     )
 
 
-def is_demo_healthy(deployment: Deployment) -> bool:
-    ps = run_command(
-        [
-            "docker",
-            "compose",
-            "-f",
-            str(deployment.compose_path),
-            "ps",
-            "--all",
-            "--format",
-            "json",
-        ],
-        failsafe=True,
+def stop_compose(deployment: Deployment):
+    if not deployment.compose_dir.exists() or not deployment.compose_path.exists():
+        return
+    run_command(get_down_command(deployment), failsafe=True)
+
+
+def get_down_command(deployment: Deployment) -> list[str]:
+    return [
+        "docker",
+        "compose",
+        "-f",
+        str(deployment.compose_path),
+        "down",
+        "--remove-orphans",
+        "--volumes",
+    ]
+
+
+def remove_stopped_containers(project: str) -> int:
+    """remove containers of a compose project which are not running ; nb removed"""
+    client = get_docker_client()
+    removed = 0
+    try:
+        containers = client.containers(
+            filters={
+                "label": [f"{COMPOSE_PROJECT_LABEL}={project}"],
+                "status": ["created", "exited", "dead"],
+            }
+        )
+        for container in containers:
+            client.remove_container(container["Id"])
+            removed += 1
+    except DockerAPIError as exc:
+        logger.warning(f"Failed to remove stopped containers of {project}: {exc}")
+    return removed
+
+
+def get_compose_images(compose_path: Path) -> set[str]:
+    """normalized names of images used by services of a compose file"""
+    try:
+        compose: dict[str, Any] = yaml_load(compose_path.read_text()) or {}
+    except FileNotFoundError:
+        return set()
+    services: dict[str, dict[str, Any]] = compose.get("services") or {}
+    return {
+        normalize_image_name(str(service["image"]))
+        for service in services.values()
+        if service.get("image")
+    }
+
+
+def remove_unused_images(candidates: Iterable[str]) -> int:
+    """remove those images unless a container or compose uses them ; bytes reclaimed
+
+    composes of all deployments (including slots kept for rollback) are checked"""
+    client = get_docker_client()
+    in_use: set[str] = set()
+    for compose_path in OFFSPOT_DEMO_COMPOSE_ROOT_DIR.glob("*/*/image-compose.yaml"):
+        in_use |= get_compose_images(compose_path)
+    try:
+        in_use |= {
+            normalize_image_name(str(container.get("Image", "")))
+            for container in client.containers()
+        }
+    except DockerAPIError as exc:
+        logger.warning(f"Failed to list containers: {exc}")
+        return 0
+
+    reclaimed = 0
+    for name in set(candidates) - in_use:
+        try:
+            image = client.inspect_image(name)
+            if not image:
+                continue
+            client.remove_image(name)
+        except DockerAPIError as exc:
+            logger.warning(f"Failed to remove image {name}: {exc}")
+            continue
+        logger.debug(f"Removed image {name}")
+        reclaimed += int(image.get("Size") or 0)
+    return reclaimed
+
+
+def get_project_containers(project: str) -> list[dict[str, Any]]:
+    """containers (in any state) of a compose project, as listed by the API"""
+    return get_docker_client().containers(
+        filters={"label": [f"{COMPOSE_PROJECT_LABEL}={project}"]}
     )
-    if ps.returncode != 0:
-        return False
-    if not ps.stdout.strip():
-        return False
+
+
+def get_project_services(project: str) -> set[str]:
+    """names of services with a container (in any state) in a compose project"""
     try:
-        for line in ps.stdout.splitlines():
-            payload = json.loads(line.strip())
-            if payload.get("State") not in ("running",):
-                logger.error(
-                    f"{deployment} container {payload['Name']} "
-                    f"not running: {payload['State']}"
-                )
-                return False
-    except Exception:
+        containers = get_project_containers(project)
+    except DockerAPIError as exc:
+        logger.error(f"Failed to list containers of {project}: {exc}")
+        return set()
+    return {
+        container["Labels"][COMPOSE_SERVICE_LABEL]
+        for container in containers
+        if container.get("Labels", {}).get(COMPOSE_SERVICE_LABEL)
+    }
+
+
+def normalize_image_name(name: str) -> str:
+    """image reference as listed by docker image ls (repository:tag)"""
+    for prefix in ("docker.io/library/", "docker.io/"):
+        if name.startswith(prefix):
+            name = name[len(prefix) :]
+            break
+    if "@" not in name and ":" not in name.rsplit("/", 1)[-1]:
+        name = f"{name}:latest"
+    return name
+
+
+def get_local_images() -> set[str]:
+    """repository:tag of all images present locally"""
+    try:
+        images = get_docker_client().images()
+    except DockerAPIError as exc:
+        logger.error(f"Failed to list images: {exc}")
+        return set()
+    return {
+        normalize_image_name(tag)
+        for image in images
+        for tag in cast(list[str], image.get("RepoTags") or [])
+        if tag != "<none>:<none>"
+    }
+
+
+def get_health_from(status: str) -> str:
+    """healthcheck status from a container's status (Up 2 minutes (healthy))"""
+    if match := re.search(r"\((?:health: )?(healthy|unhealthy|starting)\)$", status):
+        return match.group(1)
+    return ""
+
+
+def get_exit_code_from(status: str) -> int:
+    """exit code from an exited container's status (Exited (1) 3 seconds ago)"""
+    if match := re.match(r"Exited \((-?\d+)\)", status):
+        return int(match.group(1))
+    return 0
+
+
+def get_compose_state(container: dict[str, Any]) -> dict[str, Any]:
+    """compose ps-like entry for a container listed by the API"""
+    return {
+        "ID": container.get("Id", ""),
+        "Name": next(iter(container.get("Names") or []), "").lstrip("/"),
+        "Service": container.get("Labels", {}).get(COMPOSE_SERVICE_LABEL, ""),
+        "State": container.get("State", ""),
+        "Status": container.get("Status", ""),
+        "Health": get_health_from(container.get("Status", "")),
+        "ExitCode": get_exit_code_from(container.get("Status", "")),
+    }
+
+
+def get_compose_states(deployment: Deployment) -> list[dict[str, Any]] | None:
+    """compose ps-like entries for deployment's containers (None if unavailable)"""
+    try:
+        containers = get_project_containers(deployment.compose_project)
+    except DockerAPIError as exc:
+        logger.error(f"Failed to list containers of {deployment}: {exc}")
+        return None
+    return [get_compose_state(container) for container in containers]
+
+
+def are_states_healthy(deployment: Deployment, states: list[dict[str, Any]]) -> bool:
+    """whether deployment has containers and all are running"""
+    if not states:
         return False
+    for payload in states:
+        if payload.get("State") not in ("running",):
+            logger.error(
+                f"{deployment} container {payload.get('Name')} "
+                f"not running: {payload.get('State')}"
+            )
+            return False
     return True
+
+
+def is_demo_healthy(deployment: Deployment) -> bool:
+    """whether all of deployment's replicas are running"""
+    return all(
+        are_states_healthy(replica, get_compose_states(replica) or [])
+        for replica in deployment.replica_deployments
+    )
+
+
+def get_fleet_health(deployments: Iterable[Deployment]) -> dict[str, bool]:
+    """health of each deployment (by ident) from a single containers listing
+
+    a deployment is healthy if all of its replicas are"""
+    deployments = list(deployments)
+    try:
+        containers = get_docker_client().containers(
+            filters={"label": [COMPOSE_PROJECT_LABEL]}
+        )
+    except DockerAPIError as exc:
+        logger.error(f"Failed to list containers: {exc}")
+        return {deployment.ident: False for deployment in deployments}
+
+    states: dict[str, list[dict[str, Any]]] = collections.defaultdict(list)
+    for container in containers:
+        project = container.get("Labels", {}).get(COMPOSE_PROJECT_LABEL)
+        states[project].append(get_compose_state(container))
+    return {
+        deployment.ident: all(
+            are_states_healthy(replica, states.get(replica.compose_project, []))
+            for replica in deployment.replica_deployments
+        )
+        for deployment in deployments
+    }
@@ -0,0 +1,379 @@
+"""Docker Engine API client over the daemon's unix socket
+
+Talks HTTP/1.1 to the daemon on a single persistent connection instead of forking
+a docker CLI process (and connecting anew) for every call. Streaming endpoints
+(events, exec output) use their own short-lived connection.
+
+Only the subset of the API we use is implemented. Compose operations (up, down)
+and builds still go through the docker CLI."""
+
+import functools
+import http.client
+import json
+import socket
+import threading
+import urllib.parse
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.constants import DOCKER_SOCKET_PATH
+
+DOCKER_API_VERSION = "1.41"
+# seconds without data before a (non-streaming) request is considered failed
+DOCKER_API_TIMEOUT_SECONDS = 300
+
+Filters = dict[str, list[str]]
+
+
+class DockerAPIError(Exception):
+    """Docker API responded with an error (or could not be reached: status 0)"""
+
+    def __init__(self, status: int, message: str, *args: object) -> None:
+        self.status = status
+        self.message = message
+        super().__init__(f"Docker API error {status}: {message}", *args)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket"""
+
+    def __init__(self, socket_path: str, timeout: float | None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class EventStream:
+    """Iterable of decoded JSON messages from a streaming response ; closeable"""
+
+    def __init__(self, conn: UnixHTTPConnection, resp: http.client.HTTPResponse):
+        self.conn = conn
+        self.resp = resp
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        try:
+            while line := self.resp.readline():
+                if line.strip():
+                    yield json.loads(line)
+        except (OSError, ValueError, http.client.HTTPException):
+            # closed from another thread or connection lost
+            return
+
+    def close(self):
+        try:
+            if self.conn.sock:
+                self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            ...
+        self.conn.close()
+
+
+def split_image_name(name: str) -> tuple[str, str]:
+    """(repository, tag-or-digest) for an image reference. tag defaults to latest"""
+    if "@" in name:
+        repository, digest = name.split("@", 1)
+        return repository, digest
+    repository, _, tag = name.rpartition(":")
+    # colon was part of registry's host:port
+    if not repository or "/" in tag:
+        return name, "latest"
+    return repository, tag
+
+
+class DockerClient:
+    """Docker Engine API client. Thread-safe (requests are serialized)"""
+
+    def __init__(
+        self,
+        socket_path: str | Path = DOCKER_SOCKET_PATH,
+        timeout: float = DOCKER_API_TIMEOUT_SECONDS,
+    ):
+        self.socket_path = str(socket_path)
+        self.timeout = timeout
+        self._conn: UnixHTTPConnection | None = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def url_for(self, path: str, params: dict[str, Any] | None = None) -> str:
+        query = urllib.parse.urlencode(
+            {
+                key: json.dumps(value) if isinstance(value, dict) else value
+                for key, value in (params or {}).items()
+                if value is not None
+            }
+        )
+        return f"/v{DOCKER_API_VERSION}{path}" + (f"?{query}" if query else "")
+
+    def _send(
+        self,
+        conn: UnixHTTPConnection,
+        method: str,
+        url: str,
+        body: Any,
+        headers: dict[str, str],
+    ) -> http.client.HTTPResponse:
+        conn.request(method, url, body=body, headers=headers)
+        return conn.getresponse()
+
+    def _roundtrip(
+        self, method: str, url: str, body: Any, headers: dict[str, str]
+    ) -> tuple[http.client.HTTPResponse, bytes]:
+        """response and its payload, on the persistent connection"""
+        if self._conn is None:
+            self._conn = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            resp = self._send(self._conn, method, url, body, headers)
+            return resp, resp.read()
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._conn = None
+            raise
+
+    def _check(self, resp: http.client.HTTPResponse, payload: bytes):
+        if resp.status < 400:  # noqa: PLR2004
+            return
+        try:
+            message = json.loads(payload).get("message", "")
+        except ValueError:
+            message = payload.decode("utf-8", errors="replace")
+        raise DockerAPIError(resp.status, message)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: dict[str, Any] | None = None,
+        body: Any = None,
+        headers: dict[str, str] | None = None,
+    ) -> Any:
+        """decoded JSON response (or None if empty) on the persistent connection"""
+        url = self.url_for(path, params)
+        headers = headers or {}
+        if isinstance(body, dict | list):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        with self._lock:
+            try:
+                resp, payload = self._roundtrip(method, url, body, headers)
+            except (OSError, http.client.HTTPException) as exc:
+                # daemon closed our idle connection: retry once on a new one
+                if not isinstance(exc, ConnectionError) or hasattr(body, "read"):
+                    raise DockerAPIError(0, str(exc)) from exc
+                try:
+                    resp, payload = self._roundtrip(method, url, body, headers)
+                except (OSError, http.client.HTTPException) as exc:
+                    raise DockerAPIError(0, str(exc)) from exc
+
+        self._check(resp, payload)
+        if not payload.strip():
+            return None
+        try:
+            return json.loads(payload)
+        except ValueError:
+            # some endpoints return streamed JSON messages (one per line)
+            return [json.loads(line) for line in payload.splitlines() if line.strip()]
+
+    def stream(
+        self,
+        method: str,
+        path: str,
+        params: dict[str, Any] | None = None,
+        body: Any = None,
+        timeout: float | None = None,
+    ) -> EventStream:
+        """streamed JSON messages, on a dedicated connection"""
+        headers: dict[str, str] = {}
+        if isinstance(body, dict):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        conn = UnixHTTPConnection(self.socket_path, timeout)
+        try:
+            resp = self._send(conn, method, self.url_for(path, params), body, headers)
+        except (OSError, http.client.HTTPException) as exc:
+            conn.close()
+            raise DockerAPIError(0, str(exc)) from exc
+        if resp.status >= 400:  # noqa: PLR2004
+            payload = resp.read()
+            conn.close()
+            self._check(resp, payload)
+        return EventStream(conn, resp)
+
+    # containers
+
+    def containers(
+        self, filters: Filters | None = None, *, all_: bool = True
+    ) -> list[dict[str, Any]]:
+        """containers matching filters (as in docker container ls)"""
+        return self.request(
+            "GET",
+            "/containers/json",
+            params={"all": int(all_), "filters": filters},
+        )
+
+    def inspect_container(self, ident: str) -> dict[str, Any]:
+        return self.request("GET", f"/containers/{urllib.parse.quote(ident)}/json")
+
+    def restart_container(self, ident: str, timeout: int = 10):
+        self.request(
+            "POST",
+            f"/containers/{urllib.parse.quote(ident)}/restart",
+            params={"t": timeout},
+        )
+
+    def exec(self, container: str, command: list[str]) -> tuple[int, str]:
+        """exit code and (merged) output of command run inside container"""
+        created = self.request(
+            "POST",
+            f"/containers/{urllib.parse.quote(container)}/exec",
+            body={
+                "AttachStdout": True,
+                "AttachStderr": True,
+                "Tty": True,
+                "Cmd": command,
+            },
+        )
+        exec_id = urllib.parse.quote(created["Id"])
+        # daemon hijacks the connection for output so use a dedicated one
+        conn = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            resp = self._send(
+                conn,
+                "POST",
+                self.url_for(f"/exec/{exec_id}/start"),
+                json.dumps({"Detach": False, "Tty": True}),
+                {"Content-Type": "application/json"},
+            )
+            output = resp.read()
+        except (OSError, http.client.HTTPException) as exc:
+            raise DockerAPIError(0, str(exc)) from exc
+        finally:
+            conn.close()
+        self._check(resp, output)
+        inspected = self.request("GET", f"/exec/{exec_id}/json")
+        return int(inspected.get("ExitCode") or 0), output.decode(
+            "utf-8", errors="replace"
+        )
+
+    def remove_container(self, ident: str, *, force: bool = False):
+        """remove a container and its anonymous volumes"""
+        self.request(
+            "DELETE",
+            f"/containers/{urllib.parse.quote(ident)}",
+            params={"v": 1, "force": int(force)},
+        )
+
+    def prune_containers(self, filters: Filters | None = None) -> dict[str, Any]:
+        """remove stopped containers ; ContainersDeleted and SpaceReclaimed"""
+        return self.request("POST", "/containers/prune", params={"filters": filters})
+
+    # images
+
+    def images(self, filters: Filters | None = None) -> list[dict[str, Any]]:
+        return self.request("GET", "/images/json", params={"filters": filters})
+
+    def inspect_image(self, name: str) -> dict[str, Any] | None:
+        """image details, None if not present"""
+        try:
+            return self.request("GET", f"/images/{urllib.parse.quote(name)}/json")
+        except DockerAPIError as exc:
+            if exc.status == http.HTTPStatus.NOT_FOUND:
+                return None
+            raise
+
+    def remove_image(self, name: str, *, force: bool = False) -> list[dict[str, Any]]:
+        return self.request(
+            "DELETE",
+            f"/images/{urllib.parse.quote(name)}",
+            params={"force": int(force)},
+        )
+
+    def pull(self, name: str, platform: str | None = None):
+        """pull an image (tag defaults to latest)
+
+        on a dedicated connection: other requests don't wait for the download"""
+        repository, tag = split_image_name(name)
+        messages = self.stream(
+            "POST",
+            "/images/create",
+            params={"fromImage": repository, "tag": tag, "platform": platform},
+            timeout=self.timeout,
+        )
+        try:
+            for message in messages:
+                if message.get("error"):
+                    raise DockerAPIError(500, str(message["error"]))
+        finally:
+            messages.close()
+        logger.debug(f"Pulled {name}")
+
+    def load(self, fpath: Path):
+        """load images from a tar archive (as docker image save)"""
+        with open(fpath, "rb") as fh:
+            messages: list[dict[str, Any]] = (
+                self.request(
+                    "POST",
+                    "/images/load",
+                    params={"quiet": 1},
+                    body=fh,
+                    headers={
+                        "Content-Type": "application/x-tar",
+                        "Content-Length": str(fpath.stat().st_size),
+                    },
+                )
+                or []
+            )
+        if isinstance(messages, dict):
+            messages = [messages]
+        for message in messages:
+            if message.get("error"):
+                raise DockerAPIError(500, str(message["error"]))
+
+    def prune_images(
+        self, filters: Filters | None = None, *, dangling_only: bool = True
+    ) -> dict[str, Any]:
+        """remove unused images ; ImagesDeleted and SpaceReclaimed"""
+        filters = dict(filters or {})
+        filters["dangling"] = [str(dangling_only).lower()]
+        return self.request("POST", "/images/prune", params={"filters": filters})
+
+    def prune_build_cache(self) -> dict[str, Any]:
+        """remove unused build cache ; SpaceReclaimed"""
+        return self.request("POST", "/build/prune")
+
+    # system
+
+    def events(
+        self,
+        filters: Filters | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> EventStream:
+        """stream of daemon events (endless unless until is set)"""
+        return self.stream(
+            "GET",
+            "/events",
+            params={
+                "filters": filters,
+                "since": None if since is None else str(int(since)),
+                "until": None if until is None else str(int(until)),
+            },
+        )
+
+
+@functools.cache
+def get_docker_client() -> DockerClient:
+    """process-wide client, sharing its persistent connection"""
+    return DockerClient()
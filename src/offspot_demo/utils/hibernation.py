@@ -0,0 +1,80 @@
+"""Hibernation of idle demos
+
+Demos without request (as logged by their reverse-proxy) for OFFSPOT_DEMO_IDLE_TIMEOUT
+seconds are stopped while staying mounted and prepared. multi-proxy then holds
+requests to them until demo-waker has started them back."""
+
+import contextlib
+import os
+import time
+from collections.abc import Iterable
+
+from offspot_demo import logger
+from offspot_demo.constants import OFFSPOT_DEMO_IDLE_TIMEOUT
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.docker import get_fleet_health, stop_demo
+from offspot_demo.utils.locks import LockTimeoutError, demo_lock
+from offspot_demo.utils.multiproxy import reconfigure_multiproxy
+
+
+def get_last_activity(deployment: Deployment) -> float:
+    """timestamp of last request to demo (or of its last start)"""
+    timestamps = [
+        fpath.stat().st_mtime
+        for fpath in deployment.log_dir.rglob("*")
+        if fpath.is_file()
+    ]
+    # compose symlink is recreated on start (touched on wake up)
+    with contextlib.suppress(FileNotFoundError):
+        timestamps.append(deployment.compose_path.lstat().st_mtime)
+    return max(timestamps, default=0.0)
+
+
+def record_activity(deployment: Deployment):
+    os.utime(deployment.compose_path, follow_symlinks=False)
+
+
+def is_idle(deployment: Deployment, timeout: int = OFFSPOT_DEMO_IDLE_TIMEOUT) -> bool:
+    """whether demo received no request for timeout seconds (never if 0)"""
+    return bool(timeout) and time.time() - get_last_activity(deployment) > timeout
+
+
+def hibernate_idle(
+    deployments: Iterable[Deployment], fleet_health: dict[str, bool] | None = None
+) -> list[Deployment]:
+    """hibernate running deployments without recent request ; those hibernated
+
+    they are flagged and multi-proxy reconfigured before they are stopped so that
+    requests to them are held (for demo-waker to start them) rather than failing"""
+    deployments = list(deployments)
+    if not OFFSPOT_DEMO_IDLE_TIMEOUT or not deployments:
+        return []
+    if fleet_health is None:
+        fleet_health = get_fleet_health(deployments)
+    idle: list[Deployment] = []
+    with contextlib.ExitStack() as stack:
+        for deployment in deployments:
+            if (
+                not fleet_health.get(deployment.ident)
+                or deployment.is_hibernated
+                or not is_idle(deployment)
+            ):
+                continue
+            # demos being worked on (by another process) are left alone
+            try:
+                stack.enter_context(
+                    demo_lock(deployment, purpose="hibernate", timeout=0)
+                )
+            except LockTimeoutError as exc:
+                logger.info(f"Not hibernating {deployment}: {exc}")
+                continue
+            deployment.set_hibernated()
+            idle.append(deployment)
+        if not idle:
+            return []
+
+        reconfigure_multiproxy()
+        for deployment in idle:
+            logger.info(f"Hibernating {deployment}")
+            stop_demo(deployment)
+    return idle
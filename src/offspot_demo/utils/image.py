@@ -90,8 +90,27 @@ def attach_to_device(img_fpath: pathlib.Path, loop_dev: str):
         text=True,
         env=get_environ(),
     )
+    create_partition_nodes(loop_dev)
 
-    # create nodes for partitions if not present (typically when run in docker)
+
+def attach_image(img_fpath: pathlib.Path) -> str:
+    """attach a device image to a free loop-device, returning its path
+
+    finding and attaching is a single (atomic) losetup call: safe to run
+    concurrently, unlike get_loopdev() then attach_to_device()"""
+    loop_dev = subprocess.run(
+        ["/usr/bin/env", "losetup", "--find", "--show", "--partscan", str(img_fpath)],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=get_environ(),
+    ).stdout.strip()
+    create_partition_nodes(loop_dev)
+    return loop_dev
+
+
+def create_partition_nodes(loop_dev: str):
+    """create nodes for partitions if not present (typically when run in docker)"""
     if not pathlib.Path(f"{loop_dev}p1").exists():
         logger.debug(f"Missing {loop_dev}p1 on fs")
         loop_name = get_loop_name(loop_dev)
@@ -172,3 +191,14 @@ def is_mounted(mount_point: pathlib.Path) -> bool:
         ).returncode
         == 0
     )
+
+
+def get_mount_points() -> set[pathlib.Path]:
+    """all current mount points, from a single read of the mount table"""
+    with open("/proc/self/mounts") as fh:
+        return {
+            # spaces and the like are octal-escaped (\040)
+            pathlib.Path(line.split()[1].encode().decode("unicode_escape"))
+            for line in fh
+            if line.strip()
+        }
@@ -0,0 +1,179 @@
+"""imager-service API client
+
+Resolves demos' auto-images into their current download URL. A single client
+(pooled HTTPS connections) is shared by the process: its access token is reused
+until it expires and lookups are conditional (If-None-Match) so unchanged
+auto-images are answered with a bodyless 304."""
+
+import base64
+import binascii
+import functools
+import json
+import threading
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from offspot_demo import logger
+from offspot_demo.constants import (
+    DEFAULT_HTTP_TIMEOUT_SECONDS,
+    IMAGER_SERVICE_API_PASSWORD,
+    IMAGER_SERVICE_API_URL,
+    IMAGER_SERVICE_API_USERNAME,
+)
+
+# concurrent lookups (and pooled connections)
+IMAGER_MAX_WORKERS = 8
+# token is renewed this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60
+# lifetime assumed for tokens which don't tell (not a JWT or no exp claim)
+TOKEN_DEFAULT_LIFETIME = 300
+
+
+class ImagerAPIError(Exception):
+    """imager-service responded with something unexpected"""
+
+
+def get_token_expiry(token: str) -> float | None:
+    """exp claim (timestamp) of a JWT, None if it has none"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError, binascii.Error):
+        return None
+
+
+class ImagerClient:
+    """imager-service API client. Thread-safe"""
+
+    def __init__(
+        self,
+        api_url: str = IMAGER_SERVICE_API_URL,
+        username: str = IMAGER_SERVICE_API_USERNAME,
+        password: str = IMAGER_SERVICE_API_PASSWORD,
+        timeout: float = DEFAULT_HTTP_TIMEOUT_SECONDS,
+        max_workers: int = IMAGER_MAX_WORKERS,
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._token = ""
+        self._token_expires_on = 0.0
+        self._token_lock = threading.Lock()
+        # ETag and payload of last response, per lookup URL
+        self._responses: dict[str, tuple[str, dict[str, Any]]] = {}
+        self._responses_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def auto_image_url(self, ident: str) -> str:
+        return f"{self.api_url}/auto-images/{ident}/json"
+
+    def get_token(self, *, renew: bool = False) -> str:
+        """access token, from cache unless it expires soon (or renew)"""
+        with self._token_lock:
+            if (
+                renew
+                or not self._token
+                or time.time() >= self._token_expires_on - TOKEN_EXPIRY_MARGIN
+            ):
+                resp = self.session.post(
+                    url=f"{self.api_url}/auth/authorize",
+                    headers={
+                        "username": self.username,
+                        "password": self.password,
+                        "Content-type": "application/json",
+                    },
+                    timeout=self.timeout,
+                )
+                resp.raise_for_status()
+                self._token = resp.json()["access_token"]
+                self._token_expires_on = get_token_expiry(self._token) or (
+                    time.time() + TOKEN_DEFAULT_LIFETIME
+                )
+                logger.debug("Got a new imager-service token")
+            return self._token
+
+    def lookup(self, url: str) -> dict[str, Any]:
+        """JSON payload at url, authenticated if on the API"""
+        with self._responses_lock:
+            etag, cached = self._responses.get(url, ("", {}))
+        headers = {"Content-type": "application/json"}
+        if etag:
+            headers["If-None-Match"] = etag
+        on_api = url.startswith(self.api_url)
+
+        if on_api:
+            headers["token"] = self.get_token()
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        # token revoked or expired early
+        if on_api and resp.status_code == HTTPStatus.UNAUTHORIZED:
+            headers["token"] = self.get_token(renew=True)
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if resp.status_code == HTTPStatus.NOT_MODIFIED and cached:
+            return cached
+        resp.raise_for_status()
+        payload: dict[str, Any] = resp.json()
+        if resp.headers.get("ETag"):
+            with self._responses_lock:
+                self._responses[url] = (resp.headers["ETag"], payload)
+        return payload
+
+    def get_download_url(self, ident: str) -> str:
+        """current download URL of ident's auto-image"""
+        url = self.auto_image_url(ident)
+        payload = self.lookup(url)
+        if not payload.get("http_url"):
+            logger.warning(f"'http_url' not found in response from {url}")
+            logger.debug(json.dumps(payload))
+            raise ImagerAPIError("Unexpected response from image provider")
+        return payload["http_url"]
+
+    def resolve_all(self, idents: Iterable[str]) -> dict[str, str]:
+        """download URL of each ident, looked up concurrently
+
+        failed lookups are logged and left out"""
+        idents = list(dict.fromkeys(idents))
+        if not idents:
+            return {}
+        # single login, before lookups
+        try:
+            self.get_token()
+        except Exception as exc:
+            logger.warning(f"Failed to get an imager-service token: {exc}")
+            return {}
+
+        def resolve(ident: str) -> tuple[str, str | None]:
+            try:
+                return ident, self.get_download_url(ident)
+            except Exception as exc:
+                logger.warning(f"Failed to resolve image URL of {ident}: {exc}")
+                return ident, None
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(idents)),
+            thread_name_prefix="imager",
+        ) as executor:
+            return {ident: url for ident, url in executor.map(resolve, idents) if url}
+
+
+@functools.cache
+def get_imager_client() -> ImagerClient:
+    """process-wide client, sharing its token and connections"""
+    return ImagerClient()
@@ -0,0 +1,187 @@
+"""Inter-process locks on demos and shared host resources
+
+So that manual operations (demo-deploy, demo-toggle…) can run alongside
+update-watcher or demo-reconciler, each operation on a demo holds its
+`demo:{ident}` lock and short operations on a shared resource (loop-devices,
+multi-proxy, pending changes) hold that resource's lock. Operations on different
+demos run in parallel ; those on the same demo wait for one another (up to a
+timeout).
+
+Locks are flock()s on files in OFFSPOT_DEMO_STATE_DIR/locks, released by the
+kernel if their holder dies. Holder (process, command, operation, since) is
+written in the file so that a timeout (or demo-status --locks) tells who has it.
+They are re-entrant per thread: an operation calling another (deploy calling
+toggle) doesn't wait on itself, while other threads do."""
+
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Concatenate, ParamSpec, TypeVar
+
+from offspot_demo import logger
+from offspot_demo.constants import OFFSPOT_DEMO_LOCK_TIMEOUT, OFFSPOT_DEMO_STATE_DIR
+from offspot_demo.utils.deployment import Deployment
+
+LOCKS_DIR = OFFSPOT_DEMO_STATE_DIR / "locks"
+# seconds to wait for a shared resource (held briefly)
+RESOURCE_LOCK_TIMEOUT = 120
+# first and max delays (seconds) between attempts
+BACKOFF_MIN_DELAY = 0.05
+BACKOFF_MAX_DELAY = 1.0
+
+LOOP_DEVICES = "loop-devices"
+MULTI_PROXY = "multi-proxy"
+PENDING_CHANGES = "pending-changes"
+
+_local = threading.local()
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+@dataclass
+class LockHolder:
+    name: str
+    pid: int
+    command: str
+    purpose: str
+    since: float
+
+    def __str__(self) -> str:
+        return (
+            f"pid {self.pid} ({self.command}: {self.purpose or '-'}) "
+            f"for {time.time() - self.since:.0f}s"
+        )
+
+
+class LockTimeoutError(Exception):
+    """a lock could not be acquired in time"""
+
+    def __init__(self, name: str, timeout: float, holder: LockHolder | None):
+        self.holder = holder
+        super().__init__(
+            f"{name} lock not acquired within {timeout:.0f}s: "
+            f"held by {holder or 'unknown'}"
+        )
+
+
+def get_lock_path(name: str) -> Path:
+    return LOCKS_DIR / f"{name.replace('/', '_')}.lock"
+
+
+def read_holder(fh: int) -> LockHolder | None:
+    """holder recorded in an open lock file (None if unreadable)"""
+    try:
+        payload = json.loads(os.pread(fh, 4096, 0) or b"null")
+        return LockHolder(**payload) if payload else None
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def try_flock(fh: int, operation: int) -> bool:
+    try:
+        fcntl.flock(fh, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def lock(
+    name: str, timeout: float = OFFSPOT_DEMO_LOCK_TIMEOUT, purpose: str = ""
+) -> Iterator[None]:
+    """hold lock `name` for the duration of the block
+
+    waits up to timeout seconds (0 to only try) then raises LockTimeoutError"""
+    held: set[str] = _local.__dict__.setdefault("held", set())
+    if name in held:
+        yield
+        return
+
+    path = get_lock_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fh = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        deadline = time.monotonic() + timeout
+        delay = BACKOFF_MIN_DELAY
+        waited = False
+        while not try_flock(fh, fcntl.LOCK_EX):
+            if time.monotonic() + delay > deadline:
+                raise LockTimeoutError(name, timeout, read_holder(fh))
+            if not waited:
+                logger.info(f"Waiting for {name} lock, held by {read_holder(fh)}")
+                waited = True
+            time.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX_DELAY)
+
+        holder = LockHolder(
+            name=name,
+            pid=os.getpid(),
+            command=" ".join([Path(sys.argv[0]).name, *sys.argv[1:]]),
+            purpose=purpose,
+            since=time.time(),
+        )
+        os.ftruncate(fh, 0)
+        os.pwrite(fh, json.dumps(asdict(holder)).encode(), 0)
+        held.add(name)
+        try:
+            yield
+        finally:
+            held.discard(name)
+            os.ftruncate(fh, 0)
+            fcntl.flock(fh, fcntl.LOCK_UN)
+    finally:
+        os.close(fh)
+
+
+def get_holders() -> list[LockHolder]:
+    """holders of all locks currently held"""
+    holders: list[LockHolder] = []
+    for path in sorted(LOCKS_DIR.glob("*.lock")):
+        try:
+            fh = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            if try_flock(fh, fcntl.LOCK_SH):
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                continue
+            holders.append(
+                read_holder(fh)
+                or LockHolder(
+                    name=path.stem, pid=0, command="unknown", purpose="", since=0
+                )
+            )
+        finally:
+            os.close(fh)
+    return holders
+
+
+def demo_lock(deployment: Deployment, purpose: str, timeout: float | None = None):
+    """lock on a demo (whichever its slot or replica)"""
+    return lock(
+        f"demo:{deployment.ident}",
+        timeout=OFFSPOT_DEMO_LOCK_TIMEOUT if timeout is None else timeout,
+        purpose=purpose,
+    )
+
+
+def locking_demo(
+    func: Callable[Concatenate[Deployment, P], R],
+) -> Callable[Concatenate[Deployment, P], R]:
+    """decorated operation holds its deployment's demo lock while it runs"""
+
+    @functools.wraps(func)
+    def wrapper(deployment: Deployment, *args: P.args, **kwargs: P.kwargs) -> R:
+        with demo_lock(deployment, purpose=func.__name__):
+            return func(deployment, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,113 @@
+"""Migration of demos deployed before slots (blue/green)
+
+Those had their image, mount point and compose right in the demo's folders
+(images/<ident>/image.img, target/<ident>, compose/<ident>/compose.yaml) and ran
+as compose project offspot_<ident>. Such a demo is stopped, unmounted and its
+image moved into the blue slot. The planner then redeploys it off that image
+(not downloaded again) as it is neither mounted nor prepared."""
+
+import shutil
+from pathlib import Path
+
+from offspot_demo import logger
+from offspot_demo.constants import (
+    OFFSPOT_DEMO_COMPOSE_ROOT_DIR,
+    OFFSPOT_DEMO_IMAGES_ROOT_DIR,
+    OFFSPOT_DEMO_TARGET_ROOT_DIR,
+)
+from offspot_demo.utils import state
+from offspot_demo.utils.deployment import SLOTS, Deployment
+from offspot_demo.utils.image import (
+    detach_device,
+    get_loopdev_used_by,
+    is_mounted,
+    unmount,
+)
+from offspot_demo.utils.locks import demo_lock
+from offspot_demo.utils.process import run_command
+
+# files of the single compose dir, replaced by the slots' ones
+LEGACY_COMPOSE_FILES = ("compose.yaml", "image-compose.yaml", "maint-compose.yaml")
+
+
+def get_legacy_image_path(ident: str) -> Path:
+    return OFFSPOT_DEMO_IMAGES_ROOT_DIR / ident / "image.img"
+
+
+def get_legacy_idents() -> list[str]:
+    """demos still deployed off the pre-slots layout"""
+    if not OFFSPOT_DEMO_IMAGES_ROOT_DIR.exists():
+        return []
+    return sorted(
+        fpath.parent.name for fpath in OFFSPOT_DEMO_IMAGES_ROOT_DIR.glob("*/image.img")
+    )
+
+
+def stop_legacy_compose(ident: str):
+    """stop demo's pre-slots compose project (if any)"""
+    compose_path = OFFSPOT_DEMO_COMPOSE_ROOT_DIR / ident / "compose.yaml"
+    command = ["docker", "compose", "-p", f"offspot_{ident}"]
+    if compose_path.exists():
+        command += ["-f", str(compose_path)]
+    run_command([*command, "down", "--remove-orphans", "--volumes"], failsafe=True)
+
+
+def release_legacy_image(ident: str) -> bool:
+    """unmount demo's pre-slots image and release its loop-device"""
+    target_dir = OFFSPOT_DEMO_TARGET_ROOT_DIR / ident
+    if is_mounted(target_dir) and not unmount(target_dir):
+        logger.error(f"[{ident}] Failed to unmount {target_dir}")
+        return False
+    if loop_dev := get_loopdev_used_by(get_legacy_image_path(ident)):
+        return detach_device(loop_dev=loop_dev, failsafe=True)
+    return True
+
+
+def migrate_legacy_layout(ident: str) -> bool:
+    """move a pre-slots deployment of ident into its blue slot ; whether it was"""
+    legacy_image_path = get_legacy_image_path(ident)
+    if not legacy_image_path.exists():
+        return False
+
+    deployment = Deployment.using(ident, slot=SLOTS[0])
+    with demo_lock(deployment, purpose="migrate_legacy_layout"):
+        # migrated by another process meanwhile
+        if not legacy_image_path.exists():
+            return False
+        logger.info(f"[{ident}] moving pre-slots deployment into {deployment.slot}")
+        stop_legacy_compose(ident)
+        if not release_legacy_image(ident):
+            return False
+
+        deployment.image_path.parent.mkdir(parents=True, exist_ok=True)
+        etag_path = legacy_image_path.with_name("image.etag")
+        image_etag = state.read_legacy_file(etag_path)
+        legacy_image_path.rename(deployment.image_path)
+        etag_path.unlink(missing_ok=True)
+
+        compose_dir = OFFSPOT_DEMO_COMPOSE_ROOT_DIR / ident
+        for name in LEGACY_COMPOSE_FILES:
+            compose_dir.joinpath(name).unlink(missing_ok=True)
+        # entries were keyed on the pre-slots files
+        shutil.rmtree(deployment.prepare_cache_dir, ignore_errors=True)
+        deployment.activate()
+        deployment.update_state(
+            image_url=state.get_demo(ident).last_image_url,
+            image_etag=image_etag,
+            verified=True,
+            prepared=False,
+        )
+    return True
+
+
+def migrate_legacy_layouts() -> list[str]:
+    """move all pre-slots deployments into their blue slot ; idents migrated"""
+    migrated: list[str] = []
+    for ident in get_legacy_idents():
+        try:
+            if migrate_legacy_layout(ident):
+                migrated.append(ident)
+        except Exception as exc:
+            logger.exception(exc)
+            logger.error(f"[{ident}] Failed to migrate to slots: {exc}")
+    return migrated
@@ -0,0 +1,56 @@
+"""multi-proxy (Caddy) configuration from current deployments
+
+multi-proxy routes each demo's domains to its replicas. It also answers on behalf
+of demos which are not running: those in maintenance (503) and hibernated ones
+(started by demo-waker first)."""
+
+import threading
+from collections.abc import Iterable
+
+from offspot_demo import logger
+from offspot_demo.utils.deployment import DEPLOYMENTS, Deployment
+from offspot_demo.utils.docker_api import DockerAPIError, get_docker_client
+from offspot_demo.utils.locks import MULTI_PROXY, RESOURCE_LOCK_TIMEOUT, lock
+
+MULTI_PROXY_CONTAINER = "multi-proxy"
+# deployments switch concurrently: configuration is regenerated one at a time
+RECONFIGURE_LOCK = threading.Lock()
+
+
+def get_flags(deployment: Deployment) -> list[str]:
+    """multi-proxy flags for a deployment"""
+    if deployment.is_in_maintenance:
+        return ["maintenance"]
+    return ["hibernated"] if deployment.is_hibernated else []
+
+
+def get_demos_string(deployments: Iterable[Deployment]) -> str:
+    """gen-server's --demos value for those deployments"""
+    return ",".join(
+        f"{depl.ident}:{depl.alias}:{depl.name}:{'|'.join(depl.subdomains)}"
+        f":{'|'.join(str(replica.http_port) for replica in depl.replica_deployments)}"
+        f":{depl.captive_http_port}:{'|'.join(get_flags(depl))}"
+        for depl in deployments
+    )
+
+
+def reconfigure_multiproxy(deployments: Iterable[Deployment] | None = None):
+    """request multi-proxy to regenerate+refresh its Caddy configuration and homepage
+    based on current list of deployments"""
+    # (also across processes: manual operations run alongside the watcher)
+    with RECONFIGURE_LOCK, lock(MULTI_PROXY, timeout=RESOURCE_LOCK_TIMEOUT):
+        demos_str = get_demos_string(
+            list(DEPLOYMENTS.values()) if deployments is None else deployments
+        )
+        client = get_docker_client()
+        for command in (["gen-server", "--demos", demos_str], ["caddy-reload"]):
+            try:
+                exit_code, output = client.exec(MULTI_PROXY_CONTAINER, command)
+            except DockerAPIError as exc:
+                logger.error(f"Failed to run {command[0]} in multi-proxy: {exc}")
+                continue
+            if exit_code:
+                logger.error(
+                    f"{command[0]} in multi-proxy failed with code {exit_code}\n"
+                    f"{output}"
+                )
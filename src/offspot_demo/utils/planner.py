@@ -0,0 +1,218 @@
+"""Reconciliation plans: what to do to bring demos to their desired state
+
+Desired state (demos config, pending config changes and imager-service lookups)
+and actual state (state store, loop-devices, mounts, compose projects and images
+on disk) are gathered in a single pass, each source queried once for all demos.
+The plan is the minimal set of actions bridging them, one per demo at most:
+
+- undeploy: deployed but not configured anymore
+- deploy: new image (but the one rolled back from) or none on disk, to download
+- redeploy: deploy again off the image on disk (config changed, not mounted…)
+- re-prepare: only prepare-relevant settings (alias) changed
+- resume: prepared but not mounted (host rebooted): remounted and started as is
+- heal: mounted and prepared but not running (and not stopped on purpose)
+
+plus a single multi-proxy refresh if names changed, or demos were undeployed or
+resumed.
+
+Planning has no side effect: a plan can be printed (demo-watcher --dry-run)
+or executed."""
+
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+
+from offspot_demo.utils import state
+from offspot_demo.utils.config_diff import ADDED, ALIAS, IMAGE, NAME, DemoChange
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.docker import get_fleet_health
+from offspot_demo.utils.image import get_losetup, get_mount_points
+
+UNDEPLOY = "undeploy"
+DEPLOY = "deploy"
+REDEPLOY = "redeploy"
+REPREPARE = "re-prepare"
+RESUME = "resume"
+HEAL = "heal"
+
+
+@dataclass
+class DesiredDemo:
+    ident: str
+    # None if image lookup failed (assumed not updated)
+    download_url: str | None = None
+    change: DemoChange | None = None
+
+
+@dataclass
+class ActualDemo:
+    ident: str
+    last_image_url: str = ""
+    rolled_back_from: str = ""
+    image_present: bool = False
+    mounted: bool = False
+    prepared: bool = False
+    running: bool = False
+    hibernated: bool = False
+    maintenance: bool = False
+
+
+@dataclass
+class Action:
+    ident: str
+    kind: str
+    reason: str
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.ident}: {self.reason}"
+
+
+@dataclass
+class Plan:
+    actions: list[Action] = field(default_factory=list)
+    refresh_proxy: bool = False
+    # demos planned for (configured or deployed), with their actual state
+    actual: dict[str, ActualDemo] = field(default_factory=dict)
+    # demos which change is to be kept pending (applied once out of maintenance)
+    deferred: set[str] = field(default_factory=set)
+
+    def __bool__(self) -> bool:
+        return bool(self.actions) or self.refresh_proxy
+
+    def describe(self) -> list[str]:
+        """human-readable lines, one per action"""
+        lines = [str(action) for action in self.actions]
+        lines += [f"defer {ident}: in maintenance" for ident in sorted(self.deferred)]
+        if self.refresh_proxy:
+            lines.append("refresh multi-proxy")
+        return lines or ["nothing to do"]
+
+
+def plan_demo(desired: DesiredDemo, actual: ActualDemo) -> Action | None:
+    """action bringing a configured demo to its desired state (None if it is)"""
+    ident = desired.ident
+    kind = desired.change.kind if desired.change else None
+    if desired.download_url and desired.download_url not in (
+        actual.last_image_url,
+        actual.rolled_back_from,
+    ):
+        return Action(ident, DEPLOY, "new image")
+    if not actual.image_present:
+        return Action(ident, DEPLOY, "no image on disk")
+    if kind in (IMAGE, ADDED) and desired.change:
+        fields = ", ".join(desired.change.fields) or kind
+        return Action(ident, REDEPLOY, f"config changed ({fields})")
+    # maintenance is left to operator (re-prepare is deferred, see compute_plan)
+    if actual.maintenance:
+        return None
+    if not actual.mounted and kind != ALIAS and actual.prepared:
+        return Action(ident, RESUME, "image not mounted")
+    if not actual.mounted:
+        return Action(ident, REDEPLOY, "image not mounted")
+    if kind == ALIAS:
+        return Action(ident, REPREPARE, "alias changed")
+    # hibernated demos are started on request by demo-waker
+    if not actual.running and not actual.hibernated:
+        if actual.prepared:
+            return Action(ident, HEAL, "not running")
+        return Action(ident, REDEPLOY, "not prepared")
+    return None
+
+
+def compute_plan(
+    desired: dict[str, DesiredDemo], actual: dict[str, ActualDemo]
+) -> Plan:
+    """plan for configured demos (desired) and deployed ones (actual)"""
+    plan = Plan(actual=actual)
+    for ident in sorted(actual.keys() - desired.keys()):
+        plan.actions.append(Action(ident, UNDEPLOY, "not in config anymore"))
+    for ident in sorted(desired):
+        demo = desired[ident]
+        demo_actual = actual.get(ident) or ActualDemo(ident=ident)
+        action = plan_demo(demo, demo_actual)
+        if action:
+            plan.actions.append(action)
+        elif demo.change and demo.change.kind == ALIAS and demo_actual.maintenance:
+            plan.deferred.add(ident)
+        # names are only applied to multi-proxy by (re)deploys and re-prepares
+        if (
+            demo.change
+            and demo.change.kind == NAME
+            and (not action or action.kind not in (DEPLOY, REDEPLOY, REPREPARE))
+        ):
+            plan.refresh_proxy = True
+    if any(action.kind in (UNDEPLOY, RESUME) for action in plan.actions):
+        plan.refresh_proxy = True
+    return plan
+
+
+def gather_desired(
+    deployments: Iterable[Deployment], changes: dict[str, DemoChange]
+) -> dict[str, DesiredDemo]:
+    """desired state of configured demos, looking images up concurrently"""
+    deployments = list(deployments)
+    urls = Deployment.resolve_download_urls(deployments)
+    return {
+        deployment.ident: DesiredDemo(
+            ident=deployment.ident,
+            download_url=urls.get(deployment.ident),
+            change=changes.get(deployment.ident),
+        )
+        for deployment in deployments
+    }
+
+
+def gather_actual(
+    deployments: Iterable[Deployment], idents: set[str] | None = None
+) -> dict[str, ActualDemo]:
+    """actual state of deployments and other deployed demos (among idents if set)
+
+    deployed demos are those with a slot prepared, near end of deployment"""
+    deployments = list(deployments)
+    demos = {
+        demo.ident: demo
+        for demo in state.get_demos()
+        if idents is None or demo.ident in idents
+    }
+    attached = {str(device["back-file"]) for device in get_losetup()}
+    mount_points = get_mount_points()
+    health = get_fleet_health(deployments)
+
+    actual = {
+        ident: ActualDemo(
+            ident=ident,
+            last_image_url=demo.last_image_url,
+            rolled_back_from=demo.rolled_back_from,
+        )
+        for ident, demo in demos.items()
+        if any(slot.prepared for slot in demo.slots.values())
+    }
+    for deployment in deployments:
+        demo = demos.get(deployment.ident) or state.DemoState(ident=deployment.ident)
+        slot = demo.slots.get(deployment.slot) or state.SlotState(
+            ident=deployment.ident, slot=deployment.slot
+        )
+        actual[deployment.ident] = ActualDemo(
+            ident=deployment.ident,
+            last_image_url=demo.last_image_url,
+            rolled_back_from=demo.rolled_back_from,
+            image_present=deployment.image_path.exists(),
+            mounted=str(deployment.image_path.resolve()) in attached
+            and deployment.target_dir in mount_points,
+            prepared=slot.prepared,
+            running=health[deployment.ident],
+            hibernated=slot.hibernated,
+            maintenance=slot.maintenance,
+        )
+    return actual
+
+
+def make_plan(
+    deployments: Iterable[Deployment],
+    changes: dict[str, DemoChange],
+    idents: set[str] | None = None,
+) -> Plan:
+    """plan for configured deployments and deployed demos (among idents if set)"""
+    deployments = list(deployments)
+    return compute_plan(
+        gather_desired(deployments, changes), gather_actual(deployments, idents)
+    )
@@ -1,37 +1,207 @@
+"""External commands, run as asyncio subprocesses
+
+- output is streamed line by line to the logger (debug if quiet) and only its
+  tail is kept in the result
+- each call has a timeout, after which its command is terminated (then killed)
+- cancelling a call (or its event loop) kills its command
+- run_commands() fans a batch of commands out, up to max_parallel at once
+
+Failures raise CommandError (holding the CommandResult) instead of exiting the
+process, so that concurrent callers (jobs, threads) only fail their own work.
+
+Synchronous run_command() and run_commands() run their own event loop: they
+must not be called from a coroutine (use the _async variants there)."""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import shlex
 import subprocess
-import sys
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass
 
 from offspot_demo import logger
+from offspot_demo.constants import OFFSPOT_DEMO_COMMAND_TIMEOUT
 
+# lines of output kept in results
+OUTPUT_TAIL_LINES = 200
+# bytes a single line of output can be
+MAX_LINE_SIZE = 2**20
+# seconds a terminated command has to exit before being killed
+TERMINATE_GRACE_SECONDS = 10
 
-def run_command(
+
+@dataclass
+class CommandResult:
+    command: list[str]
+    returncode: int
+    # tail of stdout and stderr, interleaved
+    stdout: str
+    duration: float
+    timed_out: bool = False
+
+
+class CommandError(Exception):
+    """a command failed or timed out"""
+
+    def __init__(self, result: CommandResult):
+        self.result = result
+        reason = (
+            f"timed out after {result.duration:.0f}s"
+            if result.timed_out
+            else f"failed with code {result.returncode}"
+        )
+        super().__init__(f"`{shlex.join(result.command)}` {reason}")
+
+
+async def stream_output(
+    stream: asyncio.StreamReader, lines: collections.deque[str], level: int
+):
+    async for raw in stream:
+        line = raw.decode(errors="replace").rstrip()
+        lines.append(line)
+        logger.log(level, f">> {line}")
+
+
+async def terminate(process: asyncio.subprocess.Process):
+    """terminate process, killing it if it doesn't exit in time"""
+    if process.returncode is not None:
+        return
+    with contextlib.suppress(ProcessLookupError):
+        process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), timeout=TERMINATE_GRACE_SECONDS)
+    except TimeoutError:
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        await process.wait()
+
+
+async def run_command_async(
     command: list[str],
     ok_return_codes: list[int] | None = None,
     *,
+    timeout: float | None = OFFSPOT_DEMO_COMMAND_TIMEOUT,
     quiet: bool = True,
     failsafe: bool = False,
-) -> subprocess.CompletedProcess[str]:
-    """Run a shell command and check return code
+) -> CommandResult:
+    """Run a command, raising CommandError if it fails or times out
 
     A list of return codes which have to be considered as ok can be passed, by default
-    only the 0 return code is considered as ok.
+    only the 0 return code is considered as ok. failsafe returns failed results.
     """
     if not ok_return_codes:
         ok_return_codes = [0]
 
-    process = subprocess.run(
-        ["/usr/bin/env", *command],
-        check=False,
-        text=True,
-        stderr=subprocess.STDOUT if quiet else None,
-        stdout=subprocess.PIPE if quiet else None,
+    started_on = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        "/usr/bin/env",
+        *command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        limit=MAX_LINE_SIZE,
     )
-    if process.returncode not in ok_return_codes:
-        logger.error(
-            f"Running command failed with code {process.returncode}\n"
-            f"Command was: {command}\n"
-            f"Stdout/Stderr is:\n{process.stdout}"
+    lines: collections.deque[str] = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    timed_out = False
+    try:
+        if process.stdout is None:
+            raise OSError("No output stream")
+        await asyncio.wait_for(
+            asyncio.gather(
+                stream_output(
+                    process.stdout, lines, logging.DEBUG if quiet else logging.INFO
+                ),
+                process.wait(),
+            ),
+            timeout=timeout,
         )
+    except TimeoutError:
+        timed_out = True
+        await terminate(process)
+    except BaseException:
+        # cancelled (or failed reading): command must not outlive us
+        await terminate(process)
+        raise
+
+    result = CommandResult(
+        command=command,
+        returncode=process.returncode if process.returncode is not None else -1,
+        stdout="\n".join(lines),
+        duration=time.monotonic() - started_on,
+        timed_out=timed_out,
+    )
+    if timed_out or result.returncode not in ok_return_codes:
+        error = CommandError(result)
+        logger.error(f"{error}\nOutput tail:\n{result.stdout}")
         if not failsafe:
-            sys.exit(1)
-    return process
+            raise error
+    return result
+
+
+async def run_commands_async(
+    commands: Sequence[list[str]],
+    *,
+    max_parallel: int | None = None,
+    timeout: float | None = OFFSPOT_DEMO_COMMAND_TIMEOUT,
+    quiet: bool = True,
+    failsafe: bool = False,
+) -> list[CommandResult]:
+    """run commands concurrently (up to max_parallel, all if None)
+
+    all run to completion ; first failure is then raised (unless failsafe)"""
+    semaphore = asyncio.Semaphore(max(max_parallel or len(commands), 1))
+
+    async def run(command: list[str]) -> CommandResult:
+        async with semaphore:
+            return await run_command_async(
+                command, timeout=timeout, quiet=quiet, failsafe=failsafe
+            )
+
+    results = await asyncio.gather(
+        *(run(command) for command in commands), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return [result for result in results if isinstance(result, CommandResult)]
+
+
+def run_command(
+    command: list[str],
+    ok_return_codes: list[int] | None = None,
+    *,
+    timeout: float | None = OFFSPOT_DEMO_COMMAND_TIMEOUT,
+    quiet: bool = True,
+    failsafe: bool = False,
+) -> CommandResult:
+    """Run a command and check return code (see run_command_async)"""
+    return asyncio.run(
+        run_command_async(
+            command, ok_return_codes, timeout=timeout, quiet=quiet, failsafe=failsafe
+        )
+    )
+
+
+def run_commands(
+    commands: Sequence[list[str]],
+    *,
+    max_parallel: int | None = None,
+    timeout: float | None = OFFSPOT_DEMO_COMMAND_TIMEOUT,
+    quiet: bool = True,
+    failsafe: bool = False,
+) -> list[CommandResult]:
+    """run commands concurrently (see run_commands_async)"""
+    if not commands:
+        return []
+    return asyncio.run(
+        run_commands_async(
+            commands,
+            max_parallel=max_parallel,
+            timeout=timeout,
+            quiet=quiet,
+            failsafe=failsafe,
+        )
+    )
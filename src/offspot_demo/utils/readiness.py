@@ -0,0 +1,213 @@
+"""Readiness of a freshly (re)started demo
+
+Instead of sleeping a fixed duration, follow the compose project's docker events
+(noticing crashes as they happen) and containers states (including healthchecks)
+then probe the demo's HTTP port with backoff until it answers or deadline passes.
+"""
+
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Any
+
+import requests
+
+from offspot_demo import logger
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.docker import (
+    COMPOSE_PROJECT_LABEL,
+    get_compose_states,
+    is_demo_healthy,
+)
+from offspot_demo.utils.docker_api import DockerAPIError, EventStream, get_docker_client
+
+# first and max delays (seconds) between checks when no event arrives
+BACKOFF_MIN_DELAY = 0.1
+BACKOFF_MAX_DELAY = 2.0
+PROBE_TIMEOUT_SECONDS = 2
+# multi-proxy, as reached from the host
+MULTI_PROXY_URL = "http://127.0.0.1:80"
+# max duration for a switched demo to be served through multi-proxy
+POST_SWITCH_TIMEOUT_SECONDS = 30
+# containers states considered crashed
+FAILED_STATES = ("exited", "dead")
+
+
+@dataclass
+class Readiness:
+    ready: bool
+    # seconds since the demo was started
+    duration: float
+    reason: str = ""
+
+
+class ComposeEvents:
+    """docker events of a compose project's containers, read from a thread"""
+
+    def __init__(self, project: str, since: float):
+        self.queue: queue.Queue[dict[str, Any]] = queue.Queue()
+        self.stream: EventStream | None = None
+        try:
+            self.stream = get_docker_client().events(
+                filters={
+                    "type": ["container"],
+                    "label": [f"{COMPOSE_PROJECT_LABEL}={project}"],
+                },
+                since=since,
+            )
+        except DockerAPIError as exc:
+            # states are still polled, only slower to notice crashes
+            logger.warning(f"Unable to follow docker events: {exc}")
+            return
+        threading.Thread(target=self._read, args=(self.stream,), daemon=True).start()
+
+    def _read(self, stream: EventStream):
+        for event in stream:
+            self.queue.put(event)
+
+    def get(self, timeout: float) -> list[dict[str, Any]]:
+        """events received so far, waiting up to timeout for a first one"""
+        events: list[dict[str, Any]] = []
+        try:
+            if timeout > 0:
+                events.append(self.queue.get(timeout=timeout))
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            ...
+        return events
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+
+
+def is_completed(state: dict[str, Any]) -> bool:
+    """whether container ran to completion (one-off tasks exit 0)"""
+    return state.get("State") == "exited" and state.get("ExitCode") == 0
+
+
+def is_failed(state: dict[str, Any]) -> bool:
+    """whether container crashed or is unhealthy"""
+    return (state.get("State") in FAILED_STATES and not is_completed(state)) or (
+        state.get("Health") == "unhealthy"
+    )
+
+
+def probe_http(deployment: Deployment, *, via_proxy: bool = False) -> bool:
+    """whether demo answers on its HTTP port (or through multi-proxy)"""
+    try:
+        resp = requests.get(
+            (
+                f"{MULTI_PROXY_URL}/"
+                if via_proxy
+                else f"http://127.0.0.1:{deployment.http_port}/"
+            ),
+            headers={"Host": deployment.fqdn},
+            timeout=PROBE_TIMEOUT_SECONDS,
+            allow_redirects=False,
+        )
+    except requests.RequestException:
+        return False
+    return resp.status_code < HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+def wait_until_ready(deployment: Deployment, since: float, timeout: float) -> Readiness:
+    """wait for deployment (started at since) to serve, until since+timeout
+
+    Returns as soon as it serves or as soon as a container crashes (exits with
+    a non-zero code or runs out of memory)"""
+    deadline = since + timeout
+    events = ComposeEvents(deployment.compose_project, since=since)
+    # containers started since `since`, so we don't consider previous ones dying
+    started: set[str] = set()
+    containers_ready = False
+    delay = BACKOFF_MIN_DELAY
+    batch = events.get(timeout=0)
+
+    def not_ready(reason: str) -> Readiness:
+        return Readiness(ready=False, duration=time.time() - since, reason=reason)
+
+    try:
+        while True:
+            for event in batch:
+                action = str(event.get("Action") or event.get("status") or "")
+                attributes = event.get("Actor", {}).get("Attributes", {})
+                name = attributes.get("com.docker.compose.service", event.get("id"))
+                logger.debug(f"> event: {name} {action}")
+                if action == "start":
+                    started.add(str(event.get("id")))
+                elif event.get("id") in started and (
+                    action == "oom"
+                    or (action == "die" and str(attributes.get("exitCode")) != "0")
+                ):
+                    return not_ready(
+                        f"{name} {action} (exit code {attributes.get('exitCode')})"
+                    )
+                elif action == "health_status: unhealthy":
+                    return not_ready(f"{name} is unhealthy")
+
+            if batch or not containers_ready:
+                states = get_compose_states(deployment) or []
+                for state in states:
+                    if is_failed(state):
+                        return not_ready(
+                            f"{state.get('Service')} is {state.get('State')} "
+                            f"{state.get('Health') or ''}".strip()
+                        )
+                containers_ready = bool(states) and all(
+                    is_completed(state)
+                    or (
+                        state.get("State") == "running"
+                        and state.get("Health") != "starting"
+                    )
+                    for state in states
+                )
+
+            if containers_ready and probe_http(deployment):
+                return Readiness(ready=True, duration=time.time() - since)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return not_ready(
+                    f"not serving after {timeout}s"
+                    if containers_ready
+                    else f"containers not ready after {timeout}s"
+                )
+            batch = events.get(timeout=min(delay, remaining))
+            delay = min(delay * 2, BACKOFF_MAX_DELAY)
+    finally:
+        events.close()
+
+
+def wait_until_replicas_ready(
+    deployments: list[Deployment], since: float, timeout: float
+) -> Readiness:
+    """wait for all replicas (started at since) to serve ; first failure if any"""
+    readiness = Readiness(ready=False, duration=0.0, reason="no replica")
+    for deployment in deployments:
+        readiness = wait_until_ready(deployment, since=since, timeout=timeout)
+        if not readiness.ready:
+            return readiness
+    return readiness
+
+
+def wait_until_served(
+    deployment: Deployment, timeout: float = POST_SWITCH_TIMEOUT_SECONDS
+) -> Readiness:
+    """wait for multi-proxy to serve deployment (after switching to it)"""
+    started_on = time.time()
+    delay = BACKOFF_MIN_DELAY
+    while True:
+        if is_demo_healthy(deployment) and probe_http(deployment, via_proxy=True):
+            return Readiness(ready=True, duration=time.time() - started_on)
+        if time.time() + delay > started_on + timeout:
+            return Readiness(
+                ready=False,
+                duration=time.time() - started_on,
+                reason=f"not served by multi-proxy after {timeout}s",
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, BACKOFF_MAX_DELAY)
@@ -0,0 +1,125 @@
+"""Per-demo resource limits
+
+All demos share the host so each demo's compose is given a budget (CPU, memory,
+PIDs and block I/O weight) according to the demo's profile, optionally overridden
+in the demos config. CPU, memory and PIDs are split evenly among the compose's
+services while the I/O weight (relative) applies to each. Extra replicas run
+their own compose hence get the same budget.
+
+```yaml
+demos:
+  - ident: wikipedia-en
+    profile: large
+    resources:
+      mem_limit: 3g
+```
+"""
+
+import dataclasses
+from collections.abc import Callable
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.constants import OFFSPOT_DEMO_RESOURCE_PROFILE
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceLimits:
+    """budget of a demo's compose"""
+
+    cpus: float
+    mem_limit: str
+    pids_limit: int
+    # relative I/O weight (10-1000) against other containers
+    blkio_weight: int
+
+    def to_compose(self) -> dict[str, Any]:
+        """compose service keys for those limits"""
+        return {
+            "cpus": self.cpus,
+            "mem_limit": self.mem_limit,
+            "pids_limit": self.pids_limit,
+            "blkio_config": {"weight": self.blkio_weight},
+        }
+
+    def split(self, count: int) -> "ResourceLimits":
+        """share of those limits for each of count services"""
+        if count < 2:  # noqa: PLR2004
+            return self
+        mem_mib = parse_bytes(self.mem_limit) // count // MiB
+        return dataclasses.replace(
+            self,
+            cpus=max(round(self.cpus / count, 2), MIN_CPUS),
+            mem_limit=f"{max(mem_mib, MIN_MEM_MIB)}m",
+            pids_limit=max(self.pids_limit // count, MIN_PIDS),
+        )
+
+
+RESOURCE_PROFILES: dict[str, ResourceLimits] = {
+    "small": ResourceLimits(
+        cpus=0.5, mem_limit="512m", pids_limit=256, blkio_weight=100
+    ),
+    "default": ResourceLimits(
+        cpus=1.0, mem_limit="1g", pids_limit=512, blkio_weight=300
+    ),
+    "large": ResourceLimits(
+        cpus=2.0, mem_limit="2g", pids_limit=1024, blkio_weight=500
+    ),
+}
+# floors of a service's share (docker refuses less than 6MiB of memory)
+MIN_CPUS = 0.01
+MIN_MEM_MIB = 6
+MIN_PIDS = 16
+MiB = 2**20
+UNITS = {"b": 1, "k": 2**10, "m": MiB, "g": 2**30}
+OVERRIDABLE: dict[str, Callable[[Any], Any]] = {
+    "cpus": float,
+    "mem_limit": str,
+    "pids_limit": int,
+    "blkio_weight": int,
+}
+
+
+def parse_bytes(value: str) -> int:
+    """bytes in a compose byte value (`512m`, `1g`, `1024`…)"""
+    text = value.strip().lower().removesuffix("b") or "0"
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def get_resource_limits(
+    profile: str | None = None, overrides: dict[str, Any] | None = None
+) -> ResourceLimits:
+    """limits for a profile name, with overrides from demos config"""
+    profile = profile or OFFSPOT_DEMO_RESOURCE_PROFILE
+    if profile not in RESOURCE_PROFILES:
+        logger.warning(f"Unknown resources profile “{profile}”, using default")
+        profile = "default"
+    limits = RESOURCE_PROFILES[profile]
+
+    if not overrides:
+        return limits
+
+    changes: dict[str, Any] = {}
+    for key, value in overrides.items():
+        if key not in OVERRIDABLE:
+            logger.warning(f"Ignoring unknown resources override “{key}”")
+            continue
+        try:
+            converted = OVERRIDABLE[key](value)
+            if key == "mem_limit":
+                parse_bytes(converted)
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid resources override {key}={value!r}")
+        else:
+            changes[key] = converted
+    return dataclasses.replace(limits, **changes)
+
+
+def apply_resource_limits(compose: dict[str, Any], limits: ResourceLimits):
+    """split limits among services of compose (in place)"""
+    services: dict[str, dict[str, Any]] = compose.get("services", {})
+    share = limits.split(len(services)).to_compose()
+    for service in services.values():
+        service.update(share)
@@ -0,0 +1,352 @@
+"""Declarative rewrite rules for image composes
+
+Rules are read once from a YAML file (see compose-rules.yaml) and compiled into
+a RuleSet indexing them by service name so that, in a single pass over the
+services, each one only runs through the rules that concern it."""
+
+import functools
+import hashlib
+from collections.abc import Callable, Mapping
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, NamedTuple, cast
+
+from offspot_demo import logger
+from offspot_demo.constants import COMPOSE_RULES_PATH
+from offspot_demo.utils.yaml import yaml_load
+
+Context = Mapping[str, Any]
+Renderer = Callable[[Context], Any]
+RULE_KEYS = (
+    "name",
+    "services",
+    "images",
+    "remove",
+    "set",
+    "replace",
+    "volumes",
+    "replace_fqdn",
+    "environment",
+    "subdomains_from",
+    "primary_only",
+)
+
+
+def compile_value(value: Any) -> Renderer:
+    """renderer of value: a fresh copy with strings formatted using context"""
+    if isinstance(value, str):
+        text = value
+        if "{" not in text:
+            return lambda _: text
+        return lambda context: text.format_map(context)
+    if isinstance(value, dict):
+        items = [
+            (key, compile_value(item))
+            for key, item in cast(dict[str, Any], value).items()
+        ]
+        return lambda context: {key: render(context) for key, render in items}
+    if isinstance(value, list):
+        renderers = [compile_value(item) for item in cast(list[Any], value)]
+        return lambda context: [render(context) for render in renderers]
+    return lambda _: value
+
+
+class RuleTouch(NamedTuple):
+    """a field of a service modified by a rule"""
+
+    rule: str
+    service: str
+    field: str
+
+
+@dataclass
+class RulesResult:
+    subdomains: list[str] = field(default_factory=list)
+    touches: list[RuleTouch] = field(default_factory=list)
+
+    def touched(self, rule: str, service: str, field: str):
+        logger.debug(f"> [{rule}] {service}: {field}")
+        self.touches.append(RuleTouch(rule=rule, service=service, field=field))
+
+
+@dataclass(frozen=True)
+class VolumeAllowance:
+    """a volume source allowed on the host, and where it should point to"""
+
+    source: Path
+    to: Renderer
+    nested: bool
+    mkdir: bool
+
+    def rewrite(self, source: str, context: Context) -> str | None:
+        """rewritten source if allowed"""
+        path = Path(source)
+        if not path.is_relative_to(self.source) or (
+            not self.nested and path != self.source
+        ):
+            return None
+        rewritten = Path(self.to(context)) / path.relative_to(self.source)
+        if self.mkdir:
+            rewritten.mkdir(parents=True, exist_ok=True)
+        return str(rewritten)
+
+
+@dataclass(frozen=True)
+class Replacement:
+    path: tuple[str, ...]
+    orig: Any
+    to: Renderer
+
+
+@dataclass(frozen=True)
+class Rule:
+    index: int
+    name: str
+    services: frozenset[str]
+    images: tuple[str, ...]
+    remove: tuple[str, ...] = ()
+    set: tuple[tuple[str, Renderer], ...] = ()
+    replace: tuple[Replacement, ...] = ()
+    volumes: tuple[VolumeAllowance, ...] = ()
+    replace_fqdn: bool = False
+    fqdn_except: frozenset[str] = frozenset()
+    environment: tuple[tuple[str, Renderer], ...] = ()
+    subdomains_from: tuple[str, ...] = ()
+    primary_only: bool = False
+
+    @classmethod
+    def parse(cls, index: int, payload: dict[str, Any]) -> "Rule":
+        """compiled Rule from its YAML definition"""
+        name = str(payload.get("name") or f"rule#{index}")
+        if unknown := set(payload.keys()) - set(RULE_KEYS):
+            raise ValueError(f"Unknown key(s) in rule {name}: {sorted(unknown)}")
+
+        fqdn_options: Any = payload.get("replace_fqdn")
+        fqdn_except: list[str] = []
+        if isinstance(fqdn_options, dict):
+            fqdn_except = cast(dict[str, list[str]], fqdn_options).get("except", [])
+
+        try:
+            return cls(
+                index=index,
+                name=name,
+                services=frozenset(payload.get("services", [])),
+                images=tuple(payload.get("images", [])),
+                remove=tuple(payload.get("remove", [])),
+                set=tuple(
+                    (key, compile_value(value))
+                    for key, value in payload.get("set", {}).items()
+                ),
+                replace=tuple(
+                    Replacement(
+                        path=tuple(entry["path"].split(".")),
+                        orig=entry["from"],
+                        to=compile_value(entry["to"]),
+                    )
+                    for entry in payload.get("replace", [])
+                ),
+                volumes=tuple(
+                    VolumeAllowance(
+                        source=Path(entry["source"]),
+                        to=compile_value(entry["to"]),
+                        nested=bool(entry.get("nested", False)),
+                        mkdir=bool(entry.get("mkdir", False)),
+                    )
+                    for entry in payload.get("volumes", [])
+                ),
+                replace_fqdn=bool(payload.get("replace_fqdn")),
+                fqdn_except=frozenset(fqdn_except),
+                environment=tuple(
+                    (key, compile_value(value))
+                    for key, value in payload.get("environment", {}).items()
+                ),
+                subdomains_from=tuple(payload.get("subdomains_from", [])),
+                primary_only=bool(payload.get("primary_only")),
+            )
+        except (KeyError, AttributeError, TypeError) as exc:
+            raise ValueError(f"Invalid rule {name}: {exc!r}") from exc
+
+    def matches(self, svcname: str, image: str) -> bool:
+        return (not self.services or svcname in self.services) and (
+            not self.images or image.startswith(self.images)
+        )
+
+    def apply(
+        self,
+        svcname: str,
+        service: dict[str, Any],
+        context: Context,
+        result: RulesResult,
+    ):
+        """apply this rule's actions (but volumes) onto service"""
+        for key in self.remove:
+            if key in service:
+                del service[key]
+                result.touched(self.name, svcname, f"-{key}")
+
+        for key, render in self.set:
+            service[key] = render(context)
+            result.touched(self.name, svcname, key)
+
+        for replacement in self.replace:
+            parent: dict[str, Any] | None = service
+            for part in replacement.path[:-1]:
+                child = parent.get(part) if parent is not None else None
+                parent = (
+                    cast(dict[str, Any], child) if isinstance(child, dict) else None
+                )
+            if (
+                parent is not None
+                and parent.get(replacement.path[-1]) == replacement.orig
+            ):
+                parent[replacement.path[-1]] = replacement.to(context)
+                result.touched(self.name, svcname, ".".join(replacement.path))
+
+        if not self.replace_fqdn and not self.environment and not self.subdomains_from:
+            return
+
+        environment = environ_of(service)
+
+        if self.replace_fqdn:
+            for key, value in list(environment.items()):
+                if key in self.fqdn_except or not isinstance(value, str):
+                    continue
+                replaced = value.replace(context["orig_fqdn"], context["fqdn"])
+                if replaced != value:
+                    environment[key] = replaced
+                    result.touched(self.name, svcname, f"environment.{key}")
+
+        for key, render in self.environment:
+            environment[key] = render(context)
+            result.touched(self.name, svcname, f"environment.{key}")
+        if self.environment:
+            service["environment"] = environment
+
+        for key in self.subdomains_from:
+            result.subdomains += [
+                entry.split(":")[0]
+                for entry in str(environment.get(key) or "").split(",")
+                if entry.split(":")[0]
+            ]
+
+
+def environ_of(service: dict[str, Any]) -> dict[str, Any]:
+    """service's environment as a mapping (converted from list if needed)"""
+    environment = service.get("environment")
+    if isinstance(environment, dict):
+        return cast(dict[str, Any], environment)
+    mapping: dict[str, Any] = {}
+    if isinstance(environment, list):
+        for entry in cast(list[Any], environment):
+            key, _, value = str(entry).partition("=")
+            mapping[key] = value
+        service["environment"] = mapping
+    return mapping
+
+
+class RuleSet:
+    """Compiled rules, indexed by service name"""
+
+    def __init__(self, rules: list[Rule], digest: str = ""):
+        self.rules = rules
+        self.digest = digest
+        self._wildcard: list[Rule] = [rule for rule in rules if not rule.services]
+        self._by_service: dict[str, list[Rule]] = {}
+        for rule in rules:
+            for svcname in rule.services:
+                self._by_service.setdefault(svcname, []).append(rule)
+
+    @classmethod
+    def from_yaml(cls, text: str) -> "RuleSet":
+        payload = yaml_load(text) or {}
+        return cls(
+            rules=[
+                Rule.parse(index, entry)
+                for index, entry in enumerate(payload.get("rules") or [])
+            ],
+            digest=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        )
+
+    def rules_for(self, svcname: str, image: str) -> list[Rule]:
+        """rules matching that service, in definition order"""
+        return [
+            rule
+            for rule in sorted(
+                self._wildcard + self._by_service.get(svcname, []),
+                key=lambda rule: rule.index,
+            )
+            if rule.matches(svcname, image)
+        ]
+
+    def apply(self, compose: dict[str, Any], context: Context) -> RulesResult:
+        """rewrite all compose services in place"""
+        result = RulesResult()
+        if context.get("replica"):
+            self.remove_primary_only(compose, result)
+        for svcname, service in compose.get("services", {}).items():
+            self.apply_to(svcname, service, context, result)
+        return result
+
+    def remove_primary_only(self, compose: dict[str, Any], result: RulesResult):
+        """remove services which must only run in the primary replica"""
+        services: dict[str, dict[str, Any]] = compose.get("services", {})
+        removed = {
+            svcname
+            for svcname, service in services.items()
+            if any(
+                rule.primary_only
+                for rule in self.rules_for(svcname, str(service.get("image", "")))
+            )
+        }
+        for svcname in removed:
+            del services[svcname]
+            result.touched("primary_only", svcname, "-service")
+
+        # and dependencies on those
+        for service in services.values():
+            depends_on: Any = service.get("depends_on")
+            if isinstance(depends_on, list | dict):
+                for svcname in removed & set(cast(list[str], depends_on)):
+                    if isinstance(depends_on, list):
+                        cast(list[str], depends_on).remove(svcname)
+                    else:
+                        del cast(dict[str, Any], depends_on)[svcname]
+                if not depends_on:
+                    del service["depends_on"]
+
+    def apply_to(
+        self,
+        svcname: str,
+        service: dict[str, Any],
+        context: Context,
+        result: RulesResult,
+    ):
+        rules = self.rules_for(svcname, str(service.get("image", "")))
+
+        # only volumes allowed by one of the matching rules are kept
+        orig_volumes = list(service.get("volumes", []))
+        volumes: list[Any] = []
+        service["volumes"] = volumes
+        for volume in orig_volumes:
+            for rule in rules:
+                for allowance in rule.volumes:
+                    source = allowance.rewrite(volume["source"], context)
+                    if source is not None:
+                        volume["source"] = source
+                        volumes.append(volume)
+                        result.touched(rule.name, svcname, f"volumes:{source}")
+                        break
+                else:
+                    continue
+                break
+            else:
+                result.touched("volumes", svcname, f"-volumes:{volume['source']}")
+
+        for rule in rules:
+            rule.apply(svcname, service, context, result)
+
+
+@functools.cache
+def get_compose_rules(path: Path = COMPOSE_RULES_PATH) -> RuleSet:
+    """compiled rule set from a rules file, loaded once"""
+    return RuleSet.from_yaml(path.read_text())
@@ -0,0 +1,172 @@
+"""Concurrent deployments with per-stage resource limits
+
+update-watcher runs demos' jobs (deploys, undeploys, re-prepares) in parallel, up
+to OFFSPOT_DEMO_MAX_PARALLEL_JOBS. Stages using a shared resource hold one of its
+slots (OFFSPOT_DEMO_STAGE_LIMITS) while they run:
+
+- network: image downloads
+- disk: checksums and image moves
+- mount: loop devices and mounts
+- docker: image pulls and builds
+
+so that a long download doesn't block other demos, while the host's resources are
+not overcommitted. Each job's time is recorded per stage (waiting for a slot and
+running) so the run's critical path (its longest job) can be reported."""
+
+import contextlib
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from offspot_demo import logger
+from offspot_demo.constants import (
+    OFFSPOT_DEMO_MAX_PARALLEL_JOBS,
+    OFFSPOT_DEMO_STAGE_LIMITS,
+)
+
+STAGES = ("network", "disk", "mount", "docker")
+DEFAULT_STAGE_LIMITS = {"network": 2, "disk": 1, "mount": 1, "docker": 2}
+
+
+def parse_stage_limits(text: str) -> dict[str, int]:
+    """limits per stage from a `stage=limit,…` string ; defaults for missing ones"""
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for entry in text.split(","):
+        if not entry.strip():
+            continue
+        name, _, limit = entry.partition("=")
+        if name.strip() not in STAGES:
+            raise ValueError(f"Unknown stage in limits: {name}")
+        limits[name.strip()] = max(int(limit), 1)
+    return limits
+
+
+STAGE_SEMAPHORES = {
+    name: threading.BoundedSemaphore(limit)
+    for name, limit in parse_stage_limits(OFFSPOT_DEMO_STAGE_LIMITS).items()
+}
+_local = threading.local()
+
+
+@dataclass
+class StageTiming:
+    stage: str
+    # seconds waiting for a slot, then holding it
+    waited: float
+    ran: float
+
+
+@dataclass
+class Job:
+    name: str
+    func: Callable[[], int | None]
+    rc: int | None = None
+    timings: list[StageTiming] = field(default_factory=list)
+    submitted_on: float = 0.0
+    started_on: float = 0.0
+    ended_on: float = 0.0
+
+    @property
+    def duration(self) -> float:
+        """seconds from submission to completion"""
+        return self.ended_on - self.submitted_on
+
+    @property
+    def succeeded(self) -> bool:
+        return self.rc == 0
+
+    def breakdown(self) -> str:
+        """time spent per stage (and outside stages)"""
+        ran: dict[str, float] = {}
+        waited: dict[str, float] = {}
+        for timing in self.timings:
+            ran[timing.stage] = ran.get(timing.stage, 0.0) + timing.ran
+            waited[timing.stage] = waited.get(timing.stage, 0.0) + timing.waited
+        parts = [f"queued {self.started_on - self.submitted_on:.1f}s"]
+        for name in STAGES:
+            if name in ran:
+                parts.append(f"{name} {ran[name]:.1f}s (+{waited[name]:.1f}s waiting)")
+        other = (
+            self.ended_on - self.started_on - sum(ran.values()) - sum(waited.values())
+        )
+        parts.append(f"other {max(other, 0.0):.1f}s")
+        return ", ".join(parts)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """hold a slot of that stage's resource for the duration of the block
+
+    re-entrant: nested blocks of a stage already held don't take another slot"""
+    held: set[str] = _local.__dict__.setdefault("held", set())
+    if name in held:
+        yield
+        return
+
+    requested_on = time.monotonic()
+    with STAGE_SEMAPHORES[name]:
+        acquired_on = time.monotonic()
+        held.add(name)
+        try:
+            yield
+        finally:
+            held.discard(name)
+            job: Job | None = getattr(_local, "job", None)
+            if job is not None:
+                job.timings.append(
+                    StageTiming(
+                        stage=name,
+                        waited=acquired_on - requested_on,
+                        ran=time.monotonic() - acquired_on,
+                    )
+                )
+
+
+def run_job(job: Job):
+    """run a job, recording its timings ; failures don't propagate"""
+    _local.job = job
+    job.started_on = time.monotonic()
+    try:
+        job.rc = job.func() or 0
+    except Exception as exc:
+        logger.exception(exc)
+        logger.error(f"[{job.name}] failed: {exc}")
+        job.rc = 1
+    except SystemExit as exc:
+        # code paths meant for CLIs may still exit: that only ends this job
+        logger.error(f"[{job.name}] exited: {exc.code}")
+        job.rc = exc.code if isinstance(exc.code, int) and exc.code else 1
+    finally:
+        job.ended_on = time.monotonic()
+        _local.job = None
+
+
+def run_jobs(jobs: list[Job], max_parallel: int = OFFSPOT_DEMO_MAX_PARALLEL_JOBS):
+    """run all jobs concurrently, returning once all completed"""
+    if not jobs:
+        return
+    submitted_on = time.monotonic()
+    for job in jobs:
+        job.submitted_on = submitted_on
+    with ThreadPoolExecutor(
+        max_workers=max(max_parallel, 1), thread_name_prefix="job"
+    ) as executor:
+        for _ in executor.map(run_job, jobs):
+            ...
+    report(jobs)
+
+
+def report(jobs: list[Job]):
+    """log outcome of each job and the run's critical path"""
+    for job in jobs:
+        logger.info(
+            f"[{job.name}] {'OK' if job.succeeded else f'failed ({job.rc})'} "
+            f"in {job.duration:.1f}s"
+        )
+    critical = max(jobs, key=lambda job: job.duration)
+    logger.info(
+        f"Critical path: {critical.name} ({critical.duration:.1f}s): "
+        f"{critical.breakdown()}"
+    )
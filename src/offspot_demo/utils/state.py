@@ -0,0 +1,452 @@
+"""Persistent state of deployments, in a SQLite database
+
+Records, per demo, its active slot, the URL of the image it serves (and of the
+one it was rolled back from, if any) and, per
+slot, its deployment phase, image URL and ETag, ports, subdomains, flags, timings
+and last error.
+
+Each operation is a transaction on its own connection so that concurrent writers
+(update-watcher's jobs, demo-waker, demo-toggle) are serialized by SQLite. Reads
+never create the database: until something got deployed, defaults are returned.
+Deployments recorded in sidecar files (before this store) are imported on creation.
+demo-reconciler also records timings of its loops here.
+demo-status only reads from here (no docker nor filesystem access)."""
+
+import contextlib
+import sqlite3
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Any
+
+from offspot_demo import logger
+from offspot_demo.constants import (
+    OFFSPOT_DEMO_COMPOSE_ROOT_DIR,
+    OFFSPOT_DEMO_IMAGES_ROOT_DIR,
+    OFFSPOT_DEMO_STATE_DIR,
+    OFFSPOT_DEMO_TARGET_ROOT_DIR,
+)
+
+STATE_DB_PATH = OFFSPOT_DEMO_STATE_DIR / "state.sqlite3"
+# seconds to wait for another process' transaction to complete
+STATE_DB_TIMEOUT = 30
+
+# phases of a slot, in deployment order
+DOWNLOADING = "downloading"
+PREPARING = "preparing"
+STARTING = "starting"
+SWITCHING = "switching"
+SERVING = "serving"
+# not serving anymore, kept for rollback
+RETIRED = "retired"
+FAILED = "failed"
+IN_PROGRESS_PHASES = (DOWNLOADING, PREPARING, STARTING, SWITCHING)
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS demos (
+        ident TEXT PRIMARY KEY,
+        active_slot TEXT,
+        last_image_url TEXT NOT NULL DEFAULT '',
+        rolled_back_from TEXT NOT NULL DEFAULT '',
+        updated_on REAL
+    )""",
+    """CREATE TABLE IF NOT EXISTS slots (
+        ident TEXT NOT NULL,
+        slot TEXT NOT NULL,
+        phase TEXT NOT NULL DEFAULT '',
+        image_url TEXT NOT NULL DEFAULT '',
+        image_etag TEXT NOT NULL DEFAULT '',
+        http_ports TEXT NOT NULL DEFAULT '',
+        captive_http_port INTEGER NOT NULL DEFAULT 0,
+        subdomains TEXT NOT NULL DEFAULT '',
+        prepared INTEGER NOT NULL DEFAULT 0,
+        verified INTEGER NOT NULL DEFAULT 0,
+        hibernated INTEGER NOT NULL DEFAULT 0,
+        maintenance INTEGER NOT NULL DEFAULT 0,
+        started_on REAL,
+        phase_since REAL,
+        duration REAL,
+        last_error TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (ident, slot)
+    )""",
+    """CREATE TABLE IF NOT EXISTS loops (
+        name TEXT PRIMARY KEY,
+        runs INTEGER NOT NULL DEFAULT 0,
+        failures INTEGER NOT NULL DEFAULT 0,
+        last_started_on REAL,
+        last_duration REAL,
+        total_duration REAL NOT NULL DEFAULT 0,
+        next_run_on REAL,
+        last_error TEXT NOT NULL DEFAULT ''
+    )""",
+)
+
+# columns added since tables creation: added to existing databases
+ADDED_COLUMNS = (("demos", "rolled_back_from", "TEXT NOT NULL DEFAULT ''"),)
+# databases which tables were created (or upgraded) by this process
+SCHEMA_READY: set[Path] = set()
+# user_version of a database which imported sidecar files (see import_legacy_files)
+LEGACY_IMPORTED_VERSION = 1
+# active slot of each demo, as a per-ident file (before this store)
+LEGACY_ACTIVE_SLOTS_DIR = OFFSPOT_DEMO_STATE_DIR / "slots"
+
+
+@dataclass
+class SlotState:
+    ident: str
+    slot: str
+    phase: str = ""
+    image_url: str = ""
+    image_etag: str = ""
+    # |-separated, one per replica
+    http_ports: str = ""
+    captive_http_port: int = 0
+    # ,-separated
+    subdomains: str = ""
+    prepared: bool = False
+    verified: bool = False
+    hibernated: bool = False
+    maintenance: bool = False
+    # timestamps of last deploy's start and of current phase's start
+    started_on: float | None = None
+    phase_since: float | None = None
+    # seconds last successful deploy took
+    duration: float | None = None
+    last_error: str = ""
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "SlotState":
+        values = {key: row[key] for key in row.keys()}
+        for key in ("prepared", "verified", "hibernated", "maintenance"):
+            values[key] = bool(values[key])
+        return cls(**values)
+
+
+SLOT_COLUMNS = tuple(fld.name for fld in fields(SlotState))[2:]
+
+
+@dataclass
+class DemoState:
+    ident: str
+    active_slot: str | None = None
+    last_image_url: str = ""
+    # image URL rolled back from: not redeployed until another one is published
+    rolled_back_from: str = ""
+    slots: dict[str, SlotState] = field(default_factory=dict)
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "DemoState":
+        return cls(
+            ident=row["ident"],
+            active_slot=row["active_slot"],
+            last_image_url=row["last_image_url"],
+            rolled_back_from=row["rolled_back_from"],
+        )
+
+    @property
+    def active(self) -> SlotState | None:
+        return self.slots.get(self.active_slot or "")
+
+
+@dataclass
+class LoopState:
+    """timings of a demo-reconciler loop (config, hibernation, demo:{ident})"""
+
+    name: str
+    runs: int = 0
+    failures: int = 0
+    last_started_on: float | None = None
+    last_duration: float | None = None
+    total_duration: float = 0.0
+    next_run_on: float | None = None
+    last_error: str = ""
+
+    @property
+    def average_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs else 0.0
+
+
+def connect() -> sqlite3.Connection:
+    STATE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(
+        STATE_DB_PATH, timeout=STATE_DB_TIMEOUT, isolation_level=None
+    )
+    conn.row_factory = sqlite3.Row
+    # once per process: create (or upgrade) tables
+    if STATE_DB_PATH not in SCHEMA_READY:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with transaction(conn, "BEGIN IMMEDIATE"):
+            for statement in SCHEMA:
+                conn.execute(statement)
+            add_missing_columns(conn)
+            if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                import_legacy_files(conn)
+                conn.execute(f"PRAGMA user_version = {LEGACY_IMPORTED_VERSION}")
+        SCHEMA_READY.add(STATE_DB_PATH)
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(conn: sqlite3.Connection, begin: str = "BEGIN") -> Iterator[None]:
+    conn.execute(begin)
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+@contextlib.contextmanager
+def reading() -> Iterator[sqlite3.Connection | None]:
+    """connection within a read transaction ; None if nothing was recorded yet"""
+    if not STATE_DB_PATH.exists() and not has_legacy_files():
+        yield None
+        return
+    conn = connect()
+    try:
+        with transaction(conn):
+            yield conn
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def writing() -> Iterator[sqlite3.Connection]:
+    """connection within a write transaction, creating database if needed"""
+    conn = connect()
+    try:
+        # takes the write lock right away (waiting for other writers)
+        with transaction(conn, "BEGIN IMMEDIATE"):
+            yield conn
+    finally:
+        conn.close()
+
+
+def add_missing_columns(conn: sqlite3.Connection):
+    """add columns introduced after the database was created"""
+    for table, column, definition in ADDED_COLUMNS:
+        columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def read_legacy_file(fpath: Path) -> str:
+    try:
+        return fpath.read_text().strip()
+    except OSError:
+        return ""
+
+
+def has_legacy_files() -> bool:
+    """whether deployments were made before this store (recorded in files)"""
+    return LEGACY_ACTIVE_SLOTS_DIR.exists() or any(
+        OFFSPOT_DEMO_IMAGES_ROOT_DIR.glob("*/last_image")
+    )
+
+
+def import_legacy_files(conn: sqlite3.Connection):
+    """seed a new database with the sidecar files of existing deployments
+
+    So that deployments made before this store are not considered unknown (never
+    undeployed) nor outdated (all redeployed at once)"""
+    if not OFFSPOT_DEMO_IMAGES_ROOT_DIR.exists():
+        return
+    for images_dir in sorted(OFFSPOT_DEMO_IMAGES_ROOT_DIR.iterdir()):
+        ident = images_dir.name
+        slots = sorted(fpath.parent.name for fpath in images_dir.glob("*/image.img"))
+        last_image_url = read_legacy_file(images_dir / "last_image")
+        if not slots and not last_image_url:
+            continue
+        active_slot = read_legacy_file(LEGACY_ACTIVE_SLOTS_DIR / ident) or None
+        upsert(
+            conn,
+            "demos",
+            {"ident": ident},
+            {
+                "active_slot": active_slot,
+                "last_image_url": last_image_url,
+                "updated_on": time.time(),
+            },
+        )
+        for slot in slots:
+            slot_images_dir = images_dir / slot
+            target_dir = OFFSPOT_DEMO_TARGET_ROOT_DIR / ident / slot
+            compose_dir = OFFSPOT_DEMO_COMPOSE_ROOT_DIR / ident / slot
+            is_active = slot == (active_slot or slots[0])
+            upsert(
+                conn,
+                "slots",
+                {"ident": ident, "slot": slot},
+                {
+                    "phase": SERVING if is_active else RETIRED,
+                    "phase_since": time.time(),
+                    "image_url": read_legacy_file(slot_images_dir / "image.url"),
+                    "image_etag": read_legacy_file(slot_images_dir / "image.etag"),
+                    "verified": slot_images_dir.joinpath("verified").exists(),
+                    "prepared": target_dir.joinpath("prepared.ok").exists(),
+                    "subdomains": read_legacy_file(target_dir / "subdomains"),
+                    "hibernated": compose_dir.joinpath("hibernated").exists(),
+                    "maintenance": compose_dir.joinpath("maintenance").exists(),
+                },
+            )
+        logger.info(f"Imported state of {ident} from its files")
+
+
+def upsert(
+    conn: sqlite3.Connection,
+    table: str,
+    keys: dict[str, Any],
+    values: dict[str, Any],
+):
+    """insert or update a row ; table and columns names are ours, not user input"""
+    columns = [*keys, *values]
+    conn.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) "  # noqa: S608
+        f"VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+        + ", ".join(f"{key} = excluded.{key}" for key in values),
+        (*keys.values(), *values.values()),
+    )
+
+
+def get_demo(ident: str) -> DemoState:
+    """state of a demo and its slots (defaults if unknown)"""
+    demo = DemoState(ident=ident)
+    with reading() as conn:
+        if conn is None:
+            return demo
+        if row := conn.execute(
+            "SELECT * FROM demos WHERE ident = ?", (ident,)
+        ).fetchone():
+            demo = DemoState.from_row(row)
+        for row in conn.execute("SELECT * FROM slots WHERE ident = ?", (ident,)):
+            demo.slots[row["slot"]] = SlotState.from_row(row)
+    return demo
+
+
+def get_demos() -> list[DemoState]:
+    """state of all known demos, by ident"""
+    demos: dict[str, DemoState] = {}
+    with reading() as conn:
+        if conn is None:
+            return []
+        for row in conn.execute("SELECT * FROM demos ORDER BY ident"):
+            demos[row["ident"]] = DemoState.from_row(row)
+        for row in conn.execute("SELECT * FROM slots ORDER BY ident, slot"):
+            demo = demos.setdefault(row["ident"], DemoState(ident=row["ident"]))
+            demo.slots[row["slot"]] = SlotState.from_row(row)
+    return sorted(demos.values(), key=lambda demo: demo.ident)
+
+
+def get_slot(ident: str, slot: str) -> SlotState:
+    """state of a demo's slot (defaults if unknown)"""
+    with reading() as conn:
+        if conn is not None and (
+            row := conn.execute(
+                "SELECT * FROM slots WHERE ident = ? AND slot = ?", (ident, slot)
+            ).fetchone()
+        ):
+            return SlotState.from_row(row)
+    return SlotState(ident=ident, slot=slot)
+
+
+def get_prepared_idents() -> set[str]:
+    """idents of demos with a prepared slot"""
+    with reading() as conn:
+        if conn is None:
+            return set()
+        return {
+            row["ident"]
+            for row in conn.execute("SELECT DISTINCT ident FROM slots WHERE prepared")
+        }
+
+
+def update_demo(ident: str, **values: Any):
+    """set some of a demo's values (active_slot, last_image_url, rolled_back_from)"""
+    if unknown := set(values) - {"active_slot", "last_image_url", "rolled_back_from"}:
+        raise KeyError(f"Unknown demo state keys: {sorted(unknown)}")
+    with writing() as conn:
+        upsert(conn, "demos", {"ident": ident}, {**values, "updated_on": time.time()})
+
+
+def update_slot(ident: str, slot: str, **values: Any):
+    """set some of a slot's values"""
+    if unknown := set(values) - set(SLOT_COLUMNS):
+        raise KeyError(f"Unknown slot state keys: {sorted(unknown)}")
+    if not values:
+        return
+    with writing() as conn:
+        upsert(conn, "slots", {"ident": ident, "slot": slot}, values)
+
+
+def set_phase(ident: str, slot: str, phase: str, **values: Any):
+    """move a slot to phase, recording timings (and resetting error on new deploy)"""
+    now = time.time()
+    values.update(phase=phase, phase_since=now)
+    if phase == DOWNLOADING:
+        values.update(started_on=now, duration=None, last_error="")
+    if phase == SERVING:
+        previous = get_slot(ident, slot)
+        # a deploy completed (not a restart)
+        if previous.phase == SWITCHING and previous.started_on:
+            values["duration"] = now - previous.started_on
+    update_slot(ident, slot, **values)
+
+
+def fail_in_progress(ident: str, error: str):
+    """mark demo's slot(s) in the middle of a deploy as failed with error"""
+    with writing() as conn:
+        for phase in IN_PROGRESS_PHASES:
+            conn.execute(
+                "UPDATE slots SET phase = ?, phase_since = ?, last_error = ? "
+                "WHERE ident = ? AND phase = ?",
+                (FAILED, time.time(), f"{error} (while {phase})", ident, phase),
+            )
+
+
+def clear_slot(ident: str, slot: str):
+    """forget a slot (torn down)"""
+    with writing() as conn:
+        conn.execute("DELETE FROM slots WHERE ident = ? AND slot = ?", (ident, slot))
+
+
+def remove_demo(ident: str):
+    """forget a demo (undeployed)"""
+    with writing() as conn:
+        conn.execute("DELETE FROM slots WHERE ident = ?", (ident,))
+        conn.execute("DELETE FROM demos WHERE ident = ?", (ident,))
+        conn.execute("DELETE FROM loops WHERE name = ?", (f"demo:{ident}",))
+
+
+def record_loop(name: str, started_on: float, duration: float, error: str = ""):
+    """account for a run of a loop"""
+    with writing() as conn:
+        conn.execute(
+            "INSERT INTO loops (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+            (name,),
+        )
+        conn.execute(
+            "UPDATE loops SET runs = runs + 1, failures = failures + ?, "
+            "last_started_on = ?, last_duration = ?, "
+            "total_duration = total_duration + ?, last_error = ? "
+            "WHERE name = ?",
+            (int(bool(error)), started_on, duration, duration, error, name),
+        )
+
+
+def schedule_loop(name: str, next_run_on: float | None):
+    """record when a loop runs next"""
+    with writing() as conn:
+        upsert(conn, "loops", {"name": name}, {"next_run_on": next_run_on})
+
+
+def get_loops() -> list[LoopState]:
+    with reading() as conn:
+        if conn is None:
+            return []
+        return [
+            LoopState(**{key: row[key] for key in row.keys()})
+            for row in conn.execute("SELECT * FROM loops ORDER BY name")
+        ]
@@ -1,6 +1,4 @@
-import subprocess
-
-from offspot_demo.utils.process import run_command
+from offspot_demo.utils.process import CommandResult, run_command
 
 
 class SystemdError(Exception):
@@ -32,7 +30,7 @@ def check_systemd_service(
     check_running: bool = False,
     check_waiting: bool = False,
     check_enabled: bool = False,
-) -> subprocess.CompletedProcess[str]:
+) -> CommandResult:
     """Check status of the systemd unit
 
     The minimal check consists in ensuring that the systemd unit is properly loaded (no
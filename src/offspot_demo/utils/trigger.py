@@ -0,0 +1,149 @@
+"""Push triggers for demo-reconciler
+
+imager-service webhooks or an operator (demo-trigger) notify demo-reconciler of
+updates over HTTP, authenticated by a bearer token (OFFSPOT_DEMO_TRIGGER_TOKEN):
+
+- POST /images/{ident}[,{ident}…]: those demos' images were updated
+- POST /config: demos config changed
+
+A trigger only schedules an immediate reconcile of affected demos: those already
+due are not queued twice and those running are reconciled once more after."""
+
+import asyncio
+import hmac
+import json
+import re
+from collections.abc import Callable
+from dataclasses import dataclass
+from http import HTTPStatus
+
+from offspot_demo import logger
+
+IMAGE = "image"
+CONFIG = "config"
+
+# bytes of a request line, header or body we accept
+MAX_LINE_SIZE = 8192
+MAX_BODY_SIZE = 65536
+MAX_HEADERS = 64
+# seconds a client has to send its request
+REQUEST_TIMEOUT = 10
+
+RE_IMAGES_PATH = re.compile(r"^/images/(?P<idents>[\w.,-]+)/?$")
+
+
+@dataclass
+class Trigger:
+    kind: str
+    idents: list[str]
+
+
+def parse_trigger(method: str, path: str) -> Trigger | None:
+    """trigger requested by a request, None if not a trigger"""
+    if method != "POST":
+        return None
+    path = path.split("?", 1)[0]
+    if path.rstrip("/") == "/config":
+        return Trigger(kind=CONFIG, idents=[])
+    if match := RE_IMAGES_PATH.match(path):
+        idents = [ident for ident in match.group("idents").split(",") if ident]
+        return Trigger(kind=IMAGE, idents=list(dict.fromkeys(idents)))
+    return None
+
+
+def is_authorized(headers: dict[str, str], token: str) -> bool:
+    """whether request bears the token (never if no token is set)"""
+    scheme, _, value = headers.get("authorization", "").partition(" ")
+    return (
+        bool(token)
+        and scheme.lower() == "bearer"
+        and hmac.compare_digest(value.strip().encode(), token.encode())
+    )
+
+
+# handles a trigger, returning idents scheduled (None if some are unknown)
+TriggerHandler = Callable[[Trigger], list[str] | None]
+
+
+async def respond(writer: asyncio.StreamWriter, status: HTTPStatus, payload: object):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+async def read_request(
+    reader: asyncio.StreamReader,
+) -> tuple[str, str, dict[str, str]]:
+    """method, path and (lowercased) headers of a request ; body is discarded"""
+    method, path, _ = (await reader.readuntil(b"\r\n")).decode().split(" ", 2)
+    headers: dict[str, str] = {}
+    for _ in range(MAX_HEADERS):
+        line = (await reader.readuntil(b"\r\n")).decode().strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise ValueError("Too many headers")
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY_SIZE:
+        raise ValueError("Body too large")
+    await reader.readexactly(length)
+    return method, path, headers
+
+
+async def handle_request(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    handler: TriggerHandler,
+    token: str,
+):
+    try:
+        try:
+            method, path, headers = await asyncio.wait_for(
+                read_request(reader), timeout=REQUEST_TIMEOUT
+            )
+        except (
+            TimeoutError,
+            ValueError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ) as exc:
+            logger.debug(f"Invalid trigger request: {exc}")
+            return await respond(writer, HTTPStatus.BAD_REQUEST, {"error": "invalid"})
+
+        if not is_authorized(headers, token):
+            return await respond(
+                writer, HTTPStatus.UNAUTHORIZED, {"error": "unauthorized"}
+            )
+        trigger = parse_trigger(method, path)
+        if not trigger:
+            return await respond(writer, HTTPStatus.NOT_FOUND, {"error": "not found"})
+        scheduled = handler(trigger)
+        if scheduled is None:
+            return await respond(
+                writer, HTTPStatus.NOT_FOUND, {"error": "unknown demo"}
+            )
+        logger.info(f"Triggered {trigger.kind} {','.join(trigger.idents)}")
+        await respond(writer, HTTPStatus.ACCEPTED, {"scheduled": scheduled})
+    except ConnectionError:
+        ...
+    finally:
+        writer.close()
+
+
+async def serve_triggers(
+    handler: TriggerHandler, host: str, port: int, token: str
+) -> asyncio.Server:
+    """listening server calling handler for each (authorized) trigger"""
+    return await asyncio.start_server(
+        lambda reader, writer: handle_request(reader, writer, handler, token),
+        host=host,
+        port=port,
+        limit=MAX_LINE_SIZE,
+    )
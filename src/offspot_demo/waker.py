@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""Wake hibernated demos up on request
+
+multi-proxy calls GET /wake/{ident} (forward_auth) before proxying a request to a
+hibernated demo, holding the request until we respond: 200 once demo is ready,
+503 if it failed to start. Concurrent requests for a demo share a single start.
+
+Listens on OFFSPOT_DEMO_HOST_IP only (where multi-proxy reaches the host) and
+requires OFFSPOT_DEMO_WAKER_TOKEN as bearer token (set by multi-proxy)."""
+
+import argparse
+import logging
+import re
+import sys
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from offspot_demo import logger
+from offspot_demo.config_watcher import load_configured_deployments
+from offspot_demo.constants import (
+    OFFSPOT_DEMO_HOST_IP,
+    OFFSPOT_DEMO_WAKER_PORT,
+    OFFSPOT_DEMO_WAKER_TOKEN,
+    STARTUP_DURATION,
+)
+from offspot_demo.utils import fail
+from offspot_demo.utils.compose_plan import start_demos
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.hibernation import record_activity
+from offspot_demo.utils.locks import LockTimeoutError, demo_lock
+from offspot_demo.utils.multiproxy import reconfigure_multiproxy
+from offspot_demo.utils.process import CommandError
+from offspot_demo.utils.readiness import Readiness, wait_until_replicas_ready
+from offspot_demo.utils.trigger import is_authorized
+
+
+def wake_for(deployment: Deployment) -> Readiness:
+    """start a hibernated deployment, waiting for it to be ready"""
+    logger.info(f"Waking {deployment} up")
+    started_on = time.time()
+    try:
+        start_demos(deployment.replica_deployments)
+    except CommandError as exc:
+        logger.error(f"{deployment} failed to start: {exc}")
+        return Readiness(
+            ready=False, duration=time.time() - started_on, reason=str(exc)
+        )
+    readiness = wait_until_replicas_ready(
+        deployment.replica_deployments,
+        since=started_on,
+        timeout=STARTUP_DURATION,
+    )
+    if not readiness.ready:
+        logger.error(f"{deployment} failed to wake up: {readiness.reason}")
+        return readiness
+
+    logger.info(f"{deployment} woke up in {readiness.duration:.1f}s (cold start)")
+    deployment.set_hibernated(hibernated=False)
+    record_activity(deployment)
+    # requests don't need to go through us anymore
+    reconfigure_multiproxy(load_configured_deployments().values())
+    return readiness
+
+
+class WakerHandler(BaseHTTPRequestHandler):
+    def reply(self, status: HTTPStatus, message: str):
+        body = f"{message}\n".encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        if not is_authorized(headers, OFFSPOT_DEMO_WAKER_TOKEN):
+            return self.reply(HTTPStatus.UNAUTHORIZED, "Unauthorized")
+
+        match = re.fullmatch(r"/wake/(?P<ident>[^/?]+)", self.path)
+        deployment = (
+            load_configured_deployments().get(match.group("ident")) if match else None
+        )
+        if not deployment:
+            return self.reply(HTTPStatus.NOT_FOUND, "No such demo")
+
+        # concurrent requests share a single start ; demo may also be deploying
+        try:
+            with demo_lock(deployment, purpose="wake", timeout=STARTUP_DURATION):
+                if not deployment.is_hibernated:
+                    return self.reply(HTTPStatus.OK, "Awake")
+                readiness = wake_for(deployment)
+        except LockTimeoutError as exc:
+            logger.warning(str(exc))
+            return self.reply(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                f"The “{deployment.ident}” demo is being worked on. "
+                "Please retry later.",
+            )
+
+        if not readiness.ready:
+            return self.reply(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                f"The “{deployment.ident}” demo failed to start. "
+                "Please retry later.",
+            )
+        return self.reply(HTTPStatus.OK, f"Started in {readiness.duration:.1f}s")
+
+    def log_message(self, format: str, *args: object):  # noqa: A002
+        logger.debug(format % args)
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        prog="demo-waker",
+        description="Start hibernated demos on request from multi-proxy",
+    )
+
+    parser.add_argument(
+        "--host",
+        dest="host",
+        default=OFFSPOT_DEMO_HOST_IP,
+        help=f"Address to listen on. Defaults to {OFFSPOT_DEMO_HOST_IP}",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=OFFSPOT_DEMO_WAKER_PORT,
+        help=f"Port to listen on. Defaults to {OFFSPOT_DEMO_WAKER_PORT}",
+    )
+
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="debug",
+        default=False,
+        help="Activate debug logs",
+    )
+
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    if not OFFSPOT_DEMO_WAKER_TOKEN:
+        sys.exit(fail("OFFSPOT_DEMO_WAKER_TOKEN is not set"))
+
+    try:
+        server = ThreadingHTTPServer((args.host, args.port), WakerHandler)
+        logger.info(f"Listening on {args.host}:{args.port}")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except Exception as exc:
+        logger.exception(exc)
+        logger.critical(str(exc))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
@@ -0,0 +1,23 @@
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import deployment, locks, state
+from offspot_demo.utils.deployment import Deployment
+
+
+@pytest.fixture
+def host(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """state store, locks and demos files in a temp folder"""
+    monkeypatch.setattr(state, "STATE_DB_PATH", tmp_path / "state.sqlite3")
+    monkeypatch.setattr(locks, "LOCKS_DIR", tmp_path / "locks")
+    for name in ("TARGET", "COMPOSE", "IMAGES"):
+        monkeypatch.setattr(
+            deployment, f"OFFSPOT_DEMO_{name}_ROOT_DIR", tmp_path / name.lower()
+        )
+    monkeypatch.setattr(
+        Deployment,
+        "log_dir",
+        property(lambda self: tmp_path.joinpath("log", self.ident, self.slot)),
+    )
+    return tmp_path
@@ -0,0 +1,83 @@
+import dataclasses
+import shutil
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import cache, deployment, state
+from offspot_demo.utils.deployment import Deployment
+
+
+@pytest.fixture
+def ted(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Deployment:
+    monkeypatch.setattr(state, "STATE_DB_PATH", tmp_path / "state.sqlite3")
+    monkeypatch.setattr(deployment, "OFFSPOT_DEMO_TARGET_ROOT_DIR", tmp_path / "mnt")
+    monkeypatch.setattr(
+        deployment, "OFFSPOT_DEMO_COMPOSE_ROOT_DIR", tmp_path / "compose"
+    )
+    monkeypatch.setattr(Deployment, "log_dir", property(lambda _: tmp_path / "log"))
+    ted = Deployment.using("ted", slot="blue")
+    ted.dashboard_path.parent.mkdir(parents=True)
+    ted.dashboard_path.write_text("dashboard")
+    ted.compose_dir.mkdir(parents=True)
+    ted.image_compose_path.write_text("compose")
+    ted.subdomains = ["kiwix", "edupi"]
+    return ted
+
+
+def test_store_restore(ted: Deployment):
+    assert not cache.restore_prepared(ted, "key")
+    cache.store_prepared(ted, "key")
+
+    # slot torn down: its compose dir is gone, the cache is not
+    shutil.rmtree(ted.compose_dir)
+    ted.subdomains = []
+    assert cache.restore_prepared(ted, "key")
+    assert ted.image_compose_path.read_text() == "compose"
+    assert ted.dashboard_path.read_text() == "dashboard"
+    assert ted.subdomains == ["kiwix", "edupi"]
+
+
+def test_least_recently_used_removed(ted: Deployment):
+    assert cache.PREPARE_CACHE_MAX_ENTRIES == 3
+    for index in range(cache.PREPARE_CACHE_MAX_ENTRIES):
+        cache.store_prepared(ted, f"key{index}")
+    # restoring an entry makes it the most recently used
+    assert cache.restore_prepared(ted, "key0")
+    cache.store_prepared(ted, "new")
+
+    assert not cache.restore_prepared(ted, "key1")
+    assert all(cache.restore_prepared(ted, key) for key in ("key0", "key2", "new"))
+
+
+def test_prepare_cache_key(ted: Deployment, monkeypatch: pytest.MonkeyPatch):
+    key = cache.get_prepare_cache_key(ted, "image: yaml")
+    assert key == cache.get_prepare_cache_key(ted, "image: yaml")
+    # name only shows in multi-proxy
+    assert key == cache.get_prepare_cache_key(
+        dataclasses.replace(ted, name="TED"), "image: yaml"
+    )
+
+    # any input of prepare changes it
+    assert (
+        len(
+            {
+                key,
+                cache.get_prepare_cache_key(ted, "image: other"),
+                cache.get_prepare_cache_key(ted.in_slot("green"), "image: yaml"),
+                cache.get_prepare_cache_key(
+                    dataclasses.replace(ted, alias="talks"), "image: yaml"
+                ),
+                cache.get_prepare_cache_key(
+                    dataclasses.replace(ted, settings={"profile": "large"}),
+                    "image: yaml",
+                ),
+            }
+        )
+        == 5
+    )
+    ted.update_state(image_etag="etag-2")
+    assert cache.get_prepare_cache_key(ted, "image: yaml") != key
+    ted.update_state(image_etag="")
+    monkeypatch.setattr(cache, "OFFSPOT_DEMO_TLS_EMAIL", "other@kiwix.org")
+    assert cache.get_prepare_cache_key(ted, "image: yaml") != key
@@ -0,0 +1,108 @@
+from typing import Any
+
+import pytest
+
+from offspot_demo.utils import compose_plan, docker
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.yaml import yaml_dump
+
+LOCAL_IMAGES = {"ghcr.io/offspot/kiwix-serve:3.7.0", "caddy:latest", "home:latest"}
+
+
+def container(service: str) -> dict[str, Any]:
+    return {"Id": service, "Labels": {docker.COMPOSE_SERVICE_LABEL: service}}
+
+
+@pytest.mark.parametrize(
+    "services, running, expected",
+    [
+        # all images local, no orphan: only up
+        (
+            {
+                "kiwix": {"image": "ghcr.io/offspot/kiwix-serve:3.7.0"},
+                "proxy": {"image": "docker.io/library/caddy"},
+            },
+            ["kiwix", "proxy"],
+            ["up"],
+        ),
+        # service removed from compose: down first
+        (
+            {"kiwix": {"image": "ghcr.io/offspot/kiwix-serve:3.7.0"}},
+            ["kiwix", "edupi"],
+            ["down (orphans: edupi)", "up"],
+        ),
+        # missing images are pulled, unless not pullable
+        (
+            {
+                "kiwix": {"image": "ghcr.io/offspot/kiwix-serve:3.8.0"},
+                "files": {"image": "ghcr.io/offspot/files:1.0"},
+                "local": {"image": "mine:1.0", "pull_policy": "never"},
+                "proxy": {"image": "caddy"},
+            },
+            [],
+            ["pull (kiwix,files)", "up"],
+        ),
+        # buildable services are built (only if their image is missing)
+        (
+            {
+                "home": {"image": "home", "build": "."},
+                "edupi": {"image": "edupi:2", "build": {"context": "edupi"}},
+                "anonymous": {"build": "."},
+                "pulled": {"image": "pulled:1", "build": ".", "pull_policy": "build"},
+            },
+            ["home"],
+            ["build (edupi,anonymous,pulled)", "up"],
+        ),
+        # everything at once, in order
+        (
+            {
+                "kiwix": {"image": "ghcr.io/offspot/kiwix-serve:3.8.0"},
+                "edupi": {"image": "edupi:2", "build": "."},
+            },
+            ["kiwix", "gone"],
+            ["down (orphans: gone)", "pull (kiwix)", "build (edupi)", "up"],
+        ),
+    ],
+)
+@pytest.mark.usefixtures("host")
+def test_plan_start(
+    monkeypatch: pytest.MonkeyPatch,
+    services: dict[str, Any],
+    running: list[str],
+    expected: list[str],
+):
+    def get_project_containers(project: str) -> list[dict[str, Any]]:
+        assert project == "offspot_ted_blue"
+        return [container(service) for service in running]
+
+    monkeypatch.setattr(docker, "get_project_containers", get_project_containers)
+    monkeypatch.setattr(compose_plan, "get_local_images", lambda: LOCAL_IMAGES)
+
+    ted = Deployment.using("ted")
+    ted.compose_path.write_text(yaml_dump({"services": services}))
+    plan = compose_plan.plan_start(ted)
+
+    assert [str(step) for step in plan.steps] == expected
+    assert plan.command_for(plan.steps[-1]) == [
+        "docker",
+        "compose",
+        "-f",
+        str(ted.compose_path),
+        "up",
+        "-d",
+        "--remove-orphans",
+    ]
+
+
+@pytest.mark.usefixtures("host")
+def test_plan_start_without_containers_listing(monkeypatch: pytest.MonkeyPatch):
+    def get_project_containers(_: str) -> list[dict[str, Any]]:
+        raise docker.DockerAPIError(0, "daemon unreachable")
+
+    monkeypatch.setattr(docker, "get_project_containers", get_project_containers)
+    monkeypatch.setattr(compose_plan, "get_local_images", set)
+
+    ted = Deployment.using("ted")
+    ted.compose_path.write_text(yaml_dump({"services": {"proxy": {"image": "caddy"}}}))
+    # nothing known to be orphan, image considered missing
+    assert str(compose_plan.plan_start(ted)) == "pull (proxy), up"
@@ -0,0 +1,84 @@
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import locks
+from offspot_demo.utils.config_diff import (
+    ADDED,
+    ALIAS,
+    IMAGE,
+    NAME,
+    REMOVED,
+    DemoChange,
+    clear_change,
+    diff_demos,
+    load_pending_changes,
+    record_changes,
+)
+
+
+def test_diff_demos():
+    changes = diff_demos(
+        previous=[
+            {"ident": "same", "alias": "same"},
+            {"ident": "gone"},
+            {"ident": "renamed", "name": "Old"},
+            {"ident": "realiased", "alias": "old", "name": "Old"},
+            {"ident": "resized", "profile": "small"},
+            {"ident": "other", "extra": 1},
+        ],
+        current=[
+            {"ident": "same"},
+            {"ident": "new"},
+            {"ident": "renamed", "name": "New"},
+            {"ident": "realiased", "alias": "new", "name": "New"},
+            {"ident": "resized", "profile": "large"},
+            {"ident": "other", "extra": 2},
+        ],
+    )
+    assert {ident: change.kind for ident, change in changes.items()} == {
+        "gone": REMOVED,
+        "new": ADDED,
+        "renamed": NAME,
+        "realiased": ALIAS,
+        "resized": ALIAS,
+        "other": IMAGE,
+    }
+    assert changes["realiased"].fields == ["alias", "name"]
+
+
+def test_merge_changes():
+    assert DemoChange("x", ADDED).merged_with(DemoChange("x", REMOVED)) is None
+    assert DemoChange("x", REMOVED).merged_with(DemoChange("x", ADDED)) == DemoChange(
+        "x", IMAGE
+    )
+    assert DemoChange("x", ADDED).merged_with(
+        DemoChange("x", ALIAS, ["alias"])
+    ) == DemoChange("x", ADDED, ["alias"])
+    assert DemoChange("x", NAME, ["name"]).merged_with(
+        DemoChange("x", ALIAS, ["alias"])
+    ) == DemoChange("x", ALIAS, ["alias", "name"])
+
+
+def test_record_changes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(locks, "LOCKS_DIR", tmp_path / "locks")
+    fpath = tmp_path / "changes.json"
+    assert load_pending_changes(fpath) == {}
+
+    record_changes({"a": DemoChange("a", NAME, ["name"])}, fpath)
+    record_changes(
+        {"a": DemoChange("a", ALIAS, ["alias"]), "b": DemoChange("b", ADDED)}, fpath
+    )
+    record_changes({"b": DemoChange("b", REMOVED)}, fpath)
+
+    assert load_pending_changes(fpath) == {
+        "a": DemoChange("a", ALIAS, ["alias", "name"])
+    }
+
+    # handled change is cleared unless superseded meanwhile
+    handled = DemoChange("a", ALIAS, ["alias", "name"])
+    record_changes({"c": DemoChange("c", ADDED)}, fpath)
+    clear_change(handled, fpath)
+    clear_change(DemoChange("c", NAME, ["name"]), fpath)
+    assert load_pending_changes(fpath) == {"c": DemoChange("c", ADDED)}
+    assert [path.name for path in tmp_path.iterdir() if path.is_file()] == [fpath.name]
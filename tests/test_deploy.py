@@ -0,0 +1,160 @@
+from pathlib import Path
+
+import pytest
+
+from offspot_demo import deploy
+from offspot_demo.constants import Mode
+from offspot_demo.utils import readiness, state
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.planner import ActualDemo, DesiredDemo, plan_demo
+
+
+def always(*_: object, **__: object) -> bool:
+    return True
+
+
+def never(*_: object, **__: object) -> bool:
+    return False
+
+
+def write_slot(deployment: Deployment, size: int = 8192, *, verified: bool = True):
+    """fake an image and prepared compose in deployment's slot"""
+    deployment.image_path.parent.mkdir(parents=True, exist_ok=True)
+    deployment.image_path.write_bytes(b"\1" * size)
+    deployment.compose_dir.mkdir(parents=True, exist_ok=True)
+    deployment.image_compose_path.write_text("services: {}")
+    deployment.mark_verified(verified=verified)
+
+
+@pytest.fixture
+def calls(host: Path, monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """host operations deploy would run, recorded instead"""
+    calls: list[str] = []
+
+    def record(name: str, rc: int = 0):
+        def func(deployment: Deployment, *_: object, **__: object) -> int:
+            calls.append(f"{name} {deployment.slot}")
+            return rc
+
+        return func
+
+    monkeypatch.setattr(deploy, "OFFSPOT_DEMO_IMAGES_ROOT_DIR", host / "images")
+    monkeypatch.setattr(deploy, "is_root", lambda: True)
+    monkeypatch.setattr(deploy, "is_mounted", never)
+    monkeypatch.setattr(deploy, "reconfigure_multiproxy", lambda: None)
+    for name in ("stop_demo", "unmount_detach_release", "attach_and_mount"):
+        monkeypatch.setattr(deploy, name, record(name))
+    monkeypatch.setattr(deploy, "toggle_demo", record("toggle_demo"))
+    monkeypatch.setattr(deploy, "teardown_slot", record("teardown_slot"))
+    return calls
+
+
+def test_retire_slot_within_budget(calls: list[str], monkeypatch: pytest.MonkeyPatch):
+    # budget of 16KiB
+    monkeypatch.setattr(deploy, "OFFSPOT_DEMO_ROLLBACK_BUDGET_GIB", 2**14 / 2**30)
+    # 8KiB kept for wiki (green while blue is active)
+    wiki = Deployment.using("wiki", slot="green")
+    write_slot(wiki)
+    wiki.in_slot("blue").activate()
+    assert deploy.get_kept_images_size(excluding="ted") == 2**13
+
+    ted = Deployment.using("ted", slot="green")
+    write_slot(ted)
+    assert deploy.retire_slot(ted) == 0
+    assert calls == ["stop_demo green", "unmount_detach_release green"]
+    assert ted.state.phase == state.RETIRED
+
+    # wiki's and ted's kept images leave no room for another one
+    calls.clear()
+    ted.in_slot("blue").activate()
+    other = Deployment.using("other", slot="green")
+    write_slot(other)
+    assert deploy.retire_slot(other) == 0
+    assert calls == ["teardown_slot green"]
+
+
+def test_retire_unverified_slot(calls: list[str]):
+    ted = Deployment.using("ted", slot="green")
+    write_slot(ted, verified=False)
+    assert deploy.retire_slot(ted) == 0
+    assert calls == ["teardown_slot green"]
+
+
+def test_rollback(calls: list[str]):
+    good = Deployment.using("ted", slot="blue")
+    write_slot(good)
+    good.update_state(image_url="https://s3/ted-1.img")
+    bad = good.in_slot("green")
+    write_slot(bad, verified=False)
+    bad.update_state(image_url="https://s3/ted-2.img")
+    bad.activate()
+    bad.write_last_image_url("https://s3/ted-2.img")
+
+    assert deploy.rollback_for(bad) == 0
+    assert calls[:2] == ["attach_and_mount blue", "toggle_demo blue"]
+    assert calls[-1] == "teardown_slot green"
+    demo = state.get_demo("ted")
+    assert (demo.active_slot, demo.last_image_url, demo.rolled_back_from) == (
+        "blue",
+        "https://s3/ted-1.img",
+        "https://s3/ted-2.img",
+    )
+
+    # rejected image is not deployed again, a newer one is
+    actual = ActualDemo(
+        "ted",
+        last_image_url=demo.last_image_url,
+        rolled_back_from=demo.rolled_back_from,
+        image_present=True,
+        mounted=True,
+        prepared=True,
+        running=True,
+    )
+    assert plan_demo(DesiredDemo("ted", "https://s3/ted-2.img"), actual) is None
+    assert plan_demo(DesiredDemo("ted", "https://s3/ted-3.img"), actual)
+    good.write_last_image_url("https://s3/ted-3.img")
+    assert not state.get_demo("ted").rolled_back_from
+
+    # nothing to rollback to
+    assert deploy.rollback_for(good) == 1
+
+
+def test_wait_until_served(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(readiness, "BACKOFF_MIN_DELAY", 0.01)
+    monkeypatch.setattr(readiness, "BACKOFF_MAX_DELAY", 0.01)
+    probes: list[bool] = [False, False, True]
+    monkeypatch.setattr(readiness, "is_demo_healthy", always)
+
+    def probe_http(*_: object, **__: object) -> bool:
+        return probes.pop(0)
+
+    monkeypatch.setattr(readiness, "probe_http", probe_http)
+    ted = Deployment.using("ted")
+    assert readiness.wait_until_served(ted, timeout=5).ready
+    assert not probes
+
+    monkeypatch.setattr(readiness, "is_demo_healthy", never)
+    served = readiness.wait_until_served(ted, timeout=0.05)
+    assert not served.ready
+    assert "not served" in served.reason
+
+
+@pytest.mark.usefixtures("calls")
+def test_failure_recorded(monkeypatch: pytest.MonkeyPatch):
+    def do_deploy(deployment: Deployment, **_: object) -> int:
+        deployment.set_phase(state.PREPARING)
+        return deploy.fail("Failed to prepare image", deploy.fail("No image.yaml"))
+
+    monkeypatch.setattr(deploy, "do_deploy", do_deploy)
+
+    def get_mode(_: Deployment) -> Mode:
+        return Mode.IMAGE
+
+    monkeypatch.setattr(deploy, "get_mode", get_mode)
+    monkeypatch.setattr(deploy, "is_demo_healthy", always)
+    ted = Deployment.using("ted", slot="green")
+    assert deploy.deploy_for(ted, reuse_image=False) == 1
+    assert ted.state.phase == state.FAILED
+    assert ted.state.last_error == (
+        "Failed to prepare image: No image.yaml (while preparing)"
+    )
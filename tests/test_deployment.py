@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import state
+from offspot_demo.utils.deployment import Deployment, port_from
+
+
+def test_slots(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(state, "STATE_DB_PATH", tmp_path / "state.sqlite3")
+    blue = Deployment.using("wikipedia", slot="blue")
+    green = blue.in_slot(blue.other_slot)
+    assert green.slot == "green"
+    assert green.other_slot == "blue"
+    assert blue.http_port == port_from("wikipedia")
+    assert green.http_port == blue.http_port + 30000
+    assert green.captive_http_port == green.http_port + 10000
+
+    # slots never share anything they could conflict on
+    for attr in (
+        "target_dir",
+        "compose_dir",
+        "compose_project",
+        "image_path",
+        "log_dir",
+    ):
+        assert getattr(blue, attr) != getattr(green, attr)
+    # but the served image URL is the demo's
+    blue.write_last_image_url("https://example.com/wikipedia.img")
+    assert green.last_image_url == "https://example.com/wikipedia.img"
+    # as is the active slot
+    green.activate()
+    assert Deployment.using("wikipedia").slot == "green"
+    assert blue.in_slot("green").is_active
+
+
+def test_replicas():
+    single = Deployment.using("wikipedia", slot="blue")
+    assert single.replicas == 1
+    assert single.replica_deployments == [single]
+
+    demo = Deployment.using("wikipedia", slot="green", settings={"replicas": 9})
+    replicas = demo.replica_deployments
+    assert len(replicas) == demo.replicas == 4
+    assert replicas[0] == demo
+    ports = {replica.http_port for replica in replicas}
+    ports |= {replica.in_slot("blue").http_port for replica in replicas}
+    ports |= {demo.captive_http_port, demo.in_slot("blue").captive_http_port}
+    assert len(ports) == 10
+    assert all(port < 65536 for port in ports)
+
+    # replicas share the mounted image but not their compose
+    assert {replica.target_dir for replica in replicas} == {demo.target_dir}
+    assert len({replica.compose_project for replica in replicas}) == 4
+    assert len({replica.compose_dir for replica in replicas}) == 4
+    assert replicas[2].in_slot("blue").replica == 2
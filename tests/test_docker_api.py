@@ -0,0 +1,245 @@
+import json
+import socketserver
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+
+from offspot_demo.utils import docker
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.docker_api import (
+    DOCKER_API_VERSION,
+    DockerAPIError,
+    DockerClient,
+    split_image_name,
+)
+
+CONTAINERS = [
+    {
+        "Id": "abc",
+        "Names": ["/web"],
+        "State": "running",
+        "Status": "Up 2 minutes (healthy)",
+        "Labels": {
+            "com.docker.compose.project": "offspot_up_blue",
+            "com.docker.compose.service": "web",
+        },
+    },
+    {
+        "Id": "def",
+        "Names": ["/files"],
+        "State": "exited",
+        "Status": "Exited (1) 3 seconds ago",
+        "Labels": {
+            "com.docker.compose.project": "offspot_down_blue",
+            "com.docker.compose.service": "files",
+        },
+    },
+]
+
+
+class FakeDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, FakeDaemonHandler)
+        self.connections = 0
+        # pulls of image `slow` wait for it
+        self.pulled = threading.Event()
+        self.requests: list[tuple[str, str]] = []
+
+
+class FakeDaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def daemon(self) -> FakeDaemon:
+        return cast(FakeDaemon, self.server)
+
+    def setup(self):
+        super().setup()
+        self.daemon.connections += 1
+
+    def log_message(self, format: str, *args: Any):  # noqa: A002
+        ...
+
+    def address_string(self) -> str:
+        return "unix"
+
+    def reply(self, payload: Any, status: int = 200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, messages: list[dict[str, Any]]):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for message in messages:
+            line = json.dumps(message).encode() + b"\n"
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def handle_request(self, method: str):
+        path = self.path.removeprefix(f"/v{DOCKER_API_VERSION}")
+        self.daemon.requests.append((method, path))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or "null")
+
+        if path.startswith("/containers/json"):
+            self.reply(CONTAINERS)
+        elif path.startswith("/images/missing/json"):
+            self.reply({"message": "No such image: missing"}, 404)
+        elif path.startswith("/images/create"):
+            if "fromImage=slow" in path:
+                self.daemon.pulled.wait(timeout=5)
+            if "fromImage=broken" in path:
+                self.stream([{"status": "Pulling"}, {"error": "manifest unknown"}])
+            else:
+                self.stream([{"status": "Pulling"}, {"status": "Downloaded"}])
+        elif path == "/containers/multi-proxy/exec":
+            self.reply({"Id": "exec1", "Cmd": body["Cmd"]}, 201)
+        elif path == "/exec/exec1/start":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(b"reloaded\n")
+            self.close_connection = True
+        elif path == "/exec/exec1/json":
+            self.reply({"ExitCode": 3})
+        elif method == "DELETE" and path.startswith("/containers/"):
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif path.startswith("/events"):
+            self.stream([{"Action": "start", "id": "abc"}, {"Action": "die"}])
+        else:
+            self.reply({"message": "page not found"}, 404)
+
+    def do_GET(self):  # noqa: N802
+        self.handle_request("GET")
+
+    def do_POST(self):  # noqa: N802
+        self.handle_request("POST")
+
+    def do_DELETE(self):  # noqa: N802
+        self.handle_request("DELETE")
+
+
+@pytest.fixture
+def daemon(tmp_path: Path) -> Iterator[FakeDaemon]:
+    server = FakeDaemon(str(tmp_path / "docker.sock"))
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    ).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(daemon: FakeDaemon) -> Iterator[DockerClient]:
+    client = DockerClient(socket_path=str(daemon.server_address), timeout=5)
+    yield client
+    client.close()
+
+
+def test_persistent_connection(daemon: FakeDaemon, client: DockerClient):
+    for _ in range(3):
+        assert client.containers()[0]["Names"] == ["/web"]
+    assert client.inspect_image("missing") is None
+    assert daemon.connections == 1
+    assert daemon.requests[0] == ("GET", "/containers/json?all=1")
+
+
+def test_filters_are_json_encoded(daemon: FakeDaemon, client: DockerClient):
+    client.containers(filters={"label": ["a=b"]})
+    assert daemon.requests[-1][1] == (
+        "/containers/json?all=1&filters=%7B%22label%22%3A+%5B%22a%3Db%22%5D%7D"
+    )
+
+
+def test_errors(client: DockerClient):
+    with pytest.raises(DockerAPIError) as exc_info:
+        client.inspect_container("unknown")
+    assert exc_info.value.status == 404
+    assert exc_info.value.message == "page not found"
+
+    client.pull("alpine:3.20")
+    with pytest.raises(DockerAPIError, match="manifest unknown"):
+        client.pull("broken")
+
+    with pytest.raises(DockerAPIError) as exc_info:
+        DockerClient(socket_path="/nonexistent.sock").containers()
+    assert exc_info.value.status == 0
+
+
+def test_pull_on_own_connection(daemon: FakeDaemon, client: DockerClient):
+    pull = threading.Thread(target=client.pull, args=("slow",))
+    pull.start()
+    while not any(path.startswith("/images/create") for _, path in daemon.requests):
+        time.sleep(0.01)
+    # not waiting for the ongoing pull
+    assert client.containers()
+    assert pull.is_alive()
+    daemon.pulled.set()
+    pull.join()
+
+
+def test_exec(daemon: FakeDaemon, client: DockerClient):
+    assert client.exec("multi-proxy", ["caddy-reload"]) == (3, "reloaded\n")
+    # regular requests still share a connection, exec output uses its own
+    assert daemon.connections == 2
+
+
+def test_events(client: DockerClient):
+    stream = client.events(filters={"type": ["container"]}, since=0)
+    assert [event["Action"] for event in stream] == ["start", "die"]
+    stream.close()
+
+
+def test_split_image_name():
+    assert split_image_name("alpine") == ("alpine", "latest")
+    assert split_image_name("ghcr.io/offspot/kiwix-serve:3.7.0") == (
+        "ghcr.io/offspot/kiwix-serve",
+        "3.7.0",
+    )
+    assert split_image_name("localhost:5000/img") == ("localhost:5000/img", "latest")
+    assert split_image_name("img@sha256:abc") == ("img", "sha256:abc")
+
+
+def test_fleet_health(
+    daemon: FakeDaemon, client: DockerClient, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(docker, "get_docker_client", lambda: client)
+    assert docker.get_fleet_health(
+        [Deployment.using(ident) for ident in ("up", "down", "absent")]
+    ) == {"up": True, "down": False, "absent": False}
+    # a single listing for the whole fleet
+    assert [path for _, path in daemon.requests if "/containers/" in path] == [
+        "/containers/json?all=1&filters=%7B%22label%22%3A+%5B%22"
+        "com.docker.compose.project%22%5D%7D"
+    ]
+
+
+def test_remove_stopped_containers(
+    daemon: FakeDaemon, client: DockerClient, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(docker, "get_docker_client", lambda: client)
+    # fake daemon doesn't filter: both are considered stopped
+    assert docker.remove_stopped_containers("offspot_down_blue") == 2
+    assert "offspot_down_blue" in daemon.requests[0][1]
+    assert "status" in daemon.requests[0][1]
+    assert daemon.requests[1:] == [
+        ("DELETE", "/containers/abc?v=1&force=0"),
+        ("DELETE", "/containers/def?v=1&force=0"),
+    ]
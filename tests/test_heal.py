@@ -0,0 +1,81 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+import pytest
+
+from offspot_demo import heal
+from offspot_demo.utils.deployment import Deployment
+
+
+def state(service: str, state: str = "running", health: str = "") -> dict[str, Any]:
+    return {"ID": service, "Name": service, "State": state, "Health": health}
+
+
+def test_get_failed_containers(monkeypatch: pytest.MonkeyPatch):
+    states: dict[str, list[dict[str, Any]]] = {
+        "offspot_ted_blue": [state("kiwix"), state("proxy", health="healthy")],
+        "offspot_ted_blue_r1": [
+            state("kiwix", "exited"),
+            state("proxy", health="unhealthy"),
+        ],
+    }
+
+    def get_compose_states(deployment: Deployment) -> list[dict[str, Any]]:
+        return states.get(deployment.compose_project, [])
+
+    monkeypatch.setattr(heal, "get_compose_states", get_compose_states)
+
+    # all running: nothing to restart
+    assert heal.get_failed_containers(Deployment.using("ted", slot="blue")) == []
+    # failed ones, across replicas
+    ted = Deployment.using("ted", slot="blue", settings={"replicas": 2})
+    assert heal.get_failed_containers(ted) == states["offspot_ted_blue_r1"]
+    # a replica without containers: restarting services can't help
+    ted = Deployment.using("ted", slot="blue", settings={"replicas": 3})
+    assert heal.get_failed_containers(ted) is None
+
+
+@dataclass
+class Ladder:
+    """outcome of each step (None: raises) and steps ran"""
+
+    outcomes: dict[str, int | None]
+    ran: list[str] = field(default_factory=list)
+
+
+@pytest.fixture
+def ladder(monkeypatch: pytest.MonkeyPatch) -> Ladder:
+    ladder = Ladder(outcomes=dict.fromkeys((name for name, _ in heal.LADDER), 1))
+
+    def step(name: str) -> Callable[[Deployment], int]:
+        def func(_: Deployment) -> int:
+            ladder.ran.append(name)
+            if (rc := ladder.outcomes[name]) is None:
+                raise RuntimeError(f"{name} crashed")
+            return rc
+
+        return func
+
+    monkeypatch.setattr(
+        heal, "LADDER", [(name, step(name)) for name in ladder.outcomes]
+    )
+    return ladder
+
+
+@pytest.mark.usefixtures("host")
+def test_ladder_stops_at_first_success(ladder: Ladder):
+    # steps failing (or raising) are stepped on
+    ladder.outcomes[heal.PROJECT] = None
+    ladder.outcomes[heal.REMOUNT] = 0
+    assert heal.heal_for(Deployment.using("ted")) == 0
+    assert ladder.ran == [heal.SERVICES, heal.PROJECT, heal.REMOUNT]
+
+
+@pytest.mark.usefixtures("host")
+def test_ladder_from(ladder: Ladder):
+    ladder.outcomes[heal.SERVICES] = 0
+    ladder.outcomes[heal.REDEPLOY] = 2
+    assert heal.heal_for(Deployment.using("ted"), since=heal.PROJECT) == 2
+    # services never tried ; last step's code returned
+    assert ladder.ran == [heal.PROJECT, heal.REMOUNT, heal.REDEPLOY]
@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+
+import pytest
+
+from offspot_demo.utils import hibernation, locks
+from offspot_demo.utils.deployment import Deployment
+
+
+@pytest.mark.usefixtures("host")
+def test_is_idle():
+    ted = Deployment.using("ted", settings={"replicas": 2})
+    assert hibernation.is_idle(ted, timeout=60)
+    assert not hibernation.is_idle(ted, timeout=0)
+
+    # a request logged by any replica
+    log = ted.replica_deployments[1].log_dir / "access.log"
+    log.parent.mkdir(parents=True)
+    log.write_text("GET /")
+    assert not hibernation.is_idle(ted, timeout=60)
+    os.utime(log, (time.time() - 120, time.time() - 120))
+    assert hibernation.is_idle(ted, timeout=60)
+
+    # or a start
+    ted.compose_path.symlink_to(ted.image_compose_path)
+    hibernation.record_activity(ted)
+    assert not hibernation.is_idle(ted, timeout=60)
+
+
+@pytest.mark.usefixtures("host")
+def test_hibernate_idle(monkeypatch: pytest.MonkeyPatch):
+    events: list[str] = []
+    monkeypatch.setattr(hibernation, "OFFSPOT_DEMO_IDLE_TIMEOUT", 60)
+
+    def is_idle(deployment: Deployment) -> bool:
+        return deployment.ident != "busy"
+
+    monkeypatch.setattr(hibernation, "is_idle", is_idle)
+
+    def reconfigure_multiproxy():
+        flagged = [
+            ident for ident in ("ted", "wiki") if Deployment.using(ident).is_hibernated
+        ]
+        events.append(f"reconfigure {','.join(flagged)}")
+
+    def stop_demo(deployment: Deployment):
+        events.append(f"stop {deployment.ident}")
+
+    monkeypatch.setattr(hibernation, "reconfigure_multiproxy", reconfigure_multiproxy)
+    monkeypatch.setattr(hibernation, "stop_demo", stop_demo)
+
+    # wiki is being deployed by another process
+    acquired, release = threading.Event(), threading.Event()
+
+    def deploy():
+        with locks.demo_lock(Deployment.using("wiki"), purpose="deploy_for"):
+            acquired.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=deploy)
+    thread.start()
+    assert acquired.wait(5)
+    try:
+        idle = hibernation.hibernate_idle(
+            [Deployment.using(ident) for ident in ("ted", "wiki", "busy", "down")],
+            {"ted": True, "wiki": True, "busy": True, "down": False},
+        )
+    finally:
+        release.set()
+        thread.join()
+
+    assert [deployment.ident for deployment in idle] == ["ted"]
+    # multi-proxy holds requests before the demo stops
+    assert events == ["reconfigure ted", "stop ted"]
+    assert not Deployment.using("wiki").is_hibernated
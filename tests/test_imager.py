@@ -0,0 +1,141 @@
+import base64
+import json
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, cast
+
+import pytest
+import requests
+
+from offspot_demo.utils.imager import ImagerAPIError, ImagerClient, get_token_expiry
+
+
+def make_token(exp: float) -> str:
+    claims = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode()
+    return f"header.{claims.rstrip('=')}.signature"
+
+
+class FakeImager(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeImagerHandler)
+        self.logins = 0
+        self.lookups: list[tuple[str, int]] = []
+        self.token_lifetime = 3600
+        self.revoked: set[str] = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeImagerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def imager(self) -> FakeImager:
+        return cast(FakeImager, self.server)
+
+    def log_message(self, format: str, *args: Any):  # noqa: A002
+        ...
+
+    def reply(self, status: int, payload: Any = None, etag: str = ""):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # noqa: N802
+        if self.path != "/auth/authorize" or self.headers["username"] != "demo":
+            return self.reply(401, {"message": "Unauthorized"})
+        self.imager.logins += 1
+        token = make_token(time.time() + self.imager.token_lifetime)
+        self.reply(200, {"access_token": f"{token}{self.imager.logins}"})
+
+    def do_GET(self):  # noqa: N802
+        token = self.headers["token"]
+        if not token or token in self.imager.revoked:
+            return self.reply(401, {"message": "Unauthorized"})
+        ident = self.path.split("/")[2]
+        if ident == "gone":
+            return self.reply(404, {"message": "Not found"})
+        etag = f'"{ident}-v1"'
+        if self.headers["If-None-Match"] == etag:
+            self.imager.lookups.append((ident, 304))
+            return self.reply(304)
+        self.imager.lookups.append((ident, 200))
+        payload = {} if ident == "broken" else {"http_url": f"https://s3/{ident}.img"}
+        self.reply(200, payload, etag=etag)
+
+
+@pytest.fixture
+def imager() -> Iterator[FakeImager]:
+    server = FakeImager()
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    ).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(imager: FakeImager) -> Iterator[ImagerClient]:
+    client = ImagerClient(api_url=imager.url, username="demo", password="pass")
+    yield client
+    client.close()
+
+
+def test_token_expiry():
+    assert get_token_expiry(make_token(1234)) == 1234
+    assert get_token_expiry("opaque") is None
+
+
+def test_token_is_cached(imager: FakeImager, client: ImagerClient):
+    for _ in range(3):
+        assert client.get_download_url("wikipedia") == "https://s3/wikipedia.img"
+    assert imager.logins == 1
+    # unchanged image is answered from cache
+    assert imager.lookups == [
+        ("wikipedia", 200),
+        ("wikipedia", 304),
+        ("wikipedia", 304),
+    ]
+
+    # renewed once about to expire
+    imager.token_lifetime = 30
+    client.get_token(renew=True)
+    client.get_token()
+    assert imager.logins == 3
+
+    # and when rejected
+    imager.token_lifetime = 3600
+    imager.revoked.add(client.get_token())
+    assert imager.logins == 4
+    assert client.get_download_url("ted") == "https://s3/ted.img"
+    assert imager.logins == 5
+
+
+def test_errors(client: ImagerClient):
+    with pytest.raises(requests.HTTPError):
+        client.get_download_url("gone")
+    with pytest.raises(ImagerAPIError):
+        client.get_download_url("broken")
+
+
+def test_resolve_all(imager: FakeImager, client: ImagerClient):
+    assert client.resolve_all(["wikipedia", "ted", "gone", "broken", "ted"]) == {
+        "wikipedia": "https://s3/wikipedia.img",
+        "ted": "https://s3/ted.img",
+    }
+    assert imager.logins == 1
+    assert (
+        ImagerClient(api_url=imager.url, username="nobody").resolve_all(["ted"]) == {}
+    )
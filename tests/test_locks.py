@@ -0,0 +1,60 @@
+import os
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import locks
+
+
+@pytest.fixture(autouse=True)
+def locks_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / "locks"
+    monkeypatch.setattr(locks, "LOCKS_DIR", path)
+    return path
+
+
+@pytest.fixture
+def held() -> Iterator[threading.Event]:
+    """demo:ted lock held by another thread until event is set"""
+    acquired, release = threading.Event(), threading.Event()
+
+    def hold():
+        with locks.lock("demo:ted", purpose="deploy_for"):
+            acquired.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    assert acquired.wait(5)
+    yield release
+    release.set()
+    thread.join()
+
+
+def test_reentrant():
+    with locks.lock("demo:ted"), locks.lock("demo:ted", timeout=0):
+        # other locks are independent
+        with locks.lock("demo:wiki", timeout=0):
+            ...
+    assert locks.get_holders() == []
+
+
+def test_timeout_reports_holder(held: threading.Event):
+    with pytest.raises(locks.LockTimeoutError) as exc_info:
+        with locks.lock("demo:ted", timeout=0.2):
+            ...
+    holder = exc_info.value.holder
+    assert holder is not None
+    assert (holder.pid, holder.purpose) == (os.getpid(), "deploy_for")
+    assert "deploy_for" in str(exc_info.value)
+
+    assert [holder.name for holder in locks.get_holders()] == ["demo:ted"]
+    held.set()
+
+
+def test_waits_for_release(held: threading.Event):
+    threading.Timer(0.2, held.set).start()
+    with locks.lock("demo:ted", timeout=5, purpose="toggle_demo"):
+        assert [holder.purpose for holder in locks.get_holders()] == ["toggle_demo"]
@@ -0,0 +1,87 @@
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import migration, state
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.planner import REDEPLOY, ActualDemo, DesiredDemo, plan_demo
+
+URL = "https://s3/ted.img"
+
+
+def always(*_: object) -> bool:
+    return True
+
+
+@pytest.fixture
+def calls(host: Path, monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """host operations migration would run, recorded instead"""
+    calls: list[str] = []
+    for name in ("IMAGES", "TARGET", "COMPOSE"):
+        for module in (migration, state):
+            monkeypatch.setattr(
+                module, f"OFFSPOT_DEMO_{name}_ROOT_DIR", host / name.lower()
+            )
+
+    def run_command(command: list[str], **_: object):
+        calls.append(" ".join(command[:4]))
+
+    def unmount(mount_point: Path) -> bool:
+        calls.append(f"unmount {mount_point.name}")
+        return True
+
+    def detach_device(loop_dev: str, **_: object) -> bool:
+        calls.append(f"detach {loop_dev}")
+        return True
+
+    def get_loopdev_used_by(image_path: Path) -> str:
+        return "/dev/loop3" if image_path.exists() else ""
+
+    monkeypatch.setattr(migration, "run_command", run_command)
+    monkeypatch.setattr(migration, "is_mounted", always)
+    monkeypatch.setattr(migration, "unmount", unmount)
+    monkeypatch.setattr(migration, "detach_device", detach_device)
+    monkeypatch.setattr(migration, "get_loopdev_used_by", get_loopdev_used_by)
+    return calls
+
+
+def test_migrate_legacy_layouts(host: Path, calls: list[str]):
+    def write(path: str, content: str = ""):
+        host.joinpath(path).parent.mkdir(parents=True, exist_ok=True)
+        host.joinpath(path).write_text(content)
+
+    # pre-slots ted ; wiki already in slots
+    write("images/ted/image.img", "img")
+    write("images/ted/image.etag", "etag-1")
+    write("images/ted/last_image", URL)
+    write("compose/ted/compose.yaml")
+    write("compose/ted/image-compose.yaml")
+    write("compose/ted/prepare-cache/abc/compose.yaml")
+    write("images/wiki/blue/image.img")
+
+    assert migration.migrate_legacy_layouts() == ["ted"]
+    assert calls == [
+        "docker compose -p offspot_ted",
+        "unmount ted",
+        "detach /dev/loop3",
+    ]
+    ted = Deployment.using("ted")
+    assert ted.slot == "blue"
+    assert ted.image_path.read_text() == "img"
+    assert not host.joinpath("images/ted/image.etag").exists()
+    assert not any(host.joinpath("compose/ted").iterdir())
+    assert (ted.state.image_url, ted.image_etag, ted.state.verified) == (
+        URL,
+        "etag-1",
+        True,
+    )
+
+    # redeployed off the moved image
+    action = plan_demo(
+        DesiredDemo("ted", URL),
+        ActualDemo("ted", last_image_url=ted.last_image_url, image_present=True),
+    )
+    assert action and action.kind == REDEPLOY
+
+    # only once
+    assert migration.migrate_legacy_layouts() == []
@@ -0,0 +1,149 @@
+import dataclasses
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from offspot_demo.utils import docker, planner, state
+from offspot_demo.utils.config_diff import ALIAS, IMAGE, NAME, DemoChange
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.planner import (
+    DEPLOY,
+    HEAL,
+    REDEPLOY,
+    REPREPARE,
+    RESUME,
+    UNDEPLOY,
+    ActualDemo,
+    DesiredDemo,
+    compute_plan,
+    gather_actual,
+)
+
+URL = "https://s3/ted.img"
+
+
+def running(ident: str = "ted", **values: bool) -> ActualDemo:
+    flags = {"image_present": True, "mounted": True, "prepared": True, "running": True}
+    return dataclasses.replace(
+        ActualDemo(ident=ident, last_image_url=URL), **{**flags, **values}
+    )
+
+
+def kinds(desired: DesiredDemo, actual: ActualDemo | None = None) -> list[str]:
+    plan = compute_plan(
+        {desired.ident: desired}, {actual.ident: actual} if actual else {}
+    )
+    return [action.kind for action in plan.actions]
+
+
+def test_up_to_date():
+    assert kinds(DesiredDemo("ted", URL), running()) == []
+    # failed lookup: assumed not updated
+    assert kinds(DesiredDemo("ted", None), running()) == []
+    # stopped on purpose
+    assert kinds(DesiredDemo("ted", URL), running(running=False, hibernated=True)) == []
+    assert (
+        kinds(DesiredDemo("ted", URL), running(running=False, maintenance=True)) == []
+    )
+
+    # alias change kept pending until out of maintenance
+    plan = compute_plan(
+        {"ted": DesiredDemo("ted", URL, DemoChange("ted", ALIAS, ["alias"]))},
+        {"ted": running(running=False, maintenance=True)},
+    )
+    assert (plan.actions, plan.deferred) == ([], {"ted"})
+
+
+def test_actions():
+    assert kinds(DesiredDemo("ted", URL)) == [DEPLOY]
+    assert kinds(DesiredDemo("ted", "https://s3/ted-2.img"), running()) == [DEPLOY]
+    assert kinds(DesiredDemo("ted", URL), running(image_present=False)) == [DEPLOY]
+    assert kinds(
+        DesiredDemo("ted", URL, DemoChange("ted", IMAGE, ["settings"])), running()
+    ) == [REDEPLOY]
+    assert kinds(DesiredDemo("ted", URL), running(mounted=False)) == [RESUME]
+    assert kinds(DesiredDemo("ted", URL), running(mounted=False, prepared=False)) == [
+        REDEPLOY
+    ]
+    assert kinds(DesiredDemo("ted", URL, DemoChange("ted", ALIAS)), running()) == [
+        REPREPARE
+    ]
+    assert kinds(DesiredDemo("ted", URL), running(running=False)) == [HEAL]
+    assert kinds(DesiredDemo("ted", URL), running(running=False, prepared=False)) == [
+        REDEPLOY
+    ]
+
+
+def test_proxy_refreshed_once():
+    plan = compute_plan(
+        {
+            "ted": DesiredDemo("ted", URL, DemoChange("ted", NAME)),
+            # name change handled by the deploy of the new image
+            "wiki": DesiredDemo("wiki", URL, DemoChange("wiki", NAME)),
+        },
+        {
+            "ted": running("ted"),
+            "wiki": ActualDemo("wiki", last_image_url="https://s3/wiki-old.img"),
+            "gone": ActualDemo("gone"),
+            "gone2": ActualDemo("gone2"),
+        },
+    )
+    assert [(action.kind, action.ident) for action in plan.actions] == [
+        (UNDEPLOY, "gone"),
+        (UNDEPLOY, "gone2"),
+        (DEPLOY, "wiki"),
+    ]
+    assert plan.refresh_proxy
+    assert not compute_plan({"ted": DesiredDemo("ted", URL)}, {"ted": running()})
+
+
+def test_name_change_refreshes_proxy():
+    def plan_for(actual: ActualDemo):
+        return compute_plan(
+            {"ted": DesiredDemo("ted", URL, DemoChange("ted", NAME))}, {"ted": actual}
+        )
+
+    # heal doesn't touch multi-proxy
+    plan = plan_for(running(running=False))
+    assert [action.kind for action in plan.actions] == [HEAL]
+    assert plan.refresh_proxy
+    # nor does anything for demos in maintenance
+    assert plan_for(running(maintenance=True)).refresh_proxy
+    # but a redeploy does
+    plan = plan_for(running(prepared=False, running=False))
+    assert [action.kind for action in plan.actions] == [REDEPLOY]
+    assert not plan.refresh_proxy
+
+
+class FakeClient:
+    def __init__(self, running: list[str], exited: list[str]):
+        self.listed = [
+            {
+                "Names": [f"/{project}-web"],
+                "State": "running" if project in running else "exited",
+                "Labels": {docker.COMPOSE_PROJECT_LABEL: project},
+            }
+            for project in running + exited
+        ]
+
+    def containers(self, **_: Any) -> list[dict[str, Any]]:
+        return self.listed
+
+
+def test_dead_replica_healed(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(state, "STATE_DB_PATH", tmp_path / "state.sqlite3")
+    ted = Deployment.using("ted", slot="blue", settings={"replicas": 3})
+    state.update_slot("ted", "blue", prepared=True)
+    monkeypatch.setattr(planner, "get_losetup", lambda: list[dict[str, str | int]]())
+    monkeypatch.setattr(planner, "get_mount_points", lambda: set[Path]())
+
+    # restart policy gave up on the last replica
+    projects = [replica.compose_project for replica in ted.replica_deployments]
+    client = FakeClient(running=projects[:-1], exited=projects[-1:])
+    monkeypatch.setattr(docker, "get_docker_client", lambda: client)
+    actual = gather_actual([ted])
+    assert not actual["ted"].running
+
+    actual["ted"].mounted = actual["ted"].image_present = True
+    assert kinds(DesiredDemo("ted", None), actual["ted"]) == [HEAL]
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from offspot_demo.utils.process import (
+    OUTPUT_TAIL_LINES,
+    CommandError,
+    run_command,
+    run_commands,
+)
+
+
+def test_run_command():
+    result = run_command(["sh", "-c", "echo out; echo err >&2"])
+    assert (result.returncode, result.stdout) == (0, "out\nerr")
+
+    # only the tail of output is kept
+    result = run_command(["seq", str(OUTPUT_TAIL_LINES * 2)])
+    assert result.stdout.splitlines()[0] == str(OUTPUT_TAIL_LINES + 1)
+
+
+def test_failures_raise():
+    with pytest.raises(CommandError) as exc_info:
+        run_command(["sh", "-c", "echo boom; exit 3"])
+    assert (exc_info.value.result.returncode, exc_info.value.result.stdout) == (
+        3,
+        "boom",
+    )
+
+    assert run_command(["sh", "-c", "exit 3"], ok_return_codes=[0, 3]).returncode == 3
+    assert run_command(["false"], failsafe=True).returncode == 1
+
+
+def test_timeout_terminates():
+    started_on = time.monotonic()
+    with pytest.raises(CommandError) as exc_info:
+        run_command(["sleep", "10"], timeout=0.2)
+    assert exc_info.value.result.timed_out
+    assert time.monotonic() - started_on < 5
+
+
+def test_run_commands():
+    started_on = time.monotonic()
+    results = run_commands([["sleep", "0.5"]] * 4)
+    assert [result.returncode for result in results] == [0] * 4
+    assert time.monotonic() - started_on < 1.5
+
+    # bounded
+    started_on = time.monotonic()
+    run_commands([["sleep", "0.3"]] * 4, max_parallel=2)
+    assert time.monotonic() - started_on >= 0.6
+
+    # all complete, first failure is raised
+    with pytest.raises(CommandError):
+        run_commands([["false"], ["true"]])
+    assert [
+        result.returncode for result in run_commands([["false"]], failsafe=True)
+    ] == [1]
@@ -0,0 +1,126 @@
+import queue
+import time
+from collections.abc import Iterator
+from typing import Any
+
+import pytest
+
+from offspot_demo.utils import readiness
+from offspot_demo.utils.deployment import Deployment
+
+
+def event(cid: str, action: str, exit_code: int | None = None) -> dict[str, Any]:
+    attributes = {"com.docker.compose.service": f"svc-{cid}"}
+    if exit_code is not None:
+        attributes["exitCode"] = str(exit_code)
+    return {"id": cid, "Action": action, "Actor": {"Attributes": attributes}}
+
+
+def state(cid: str, status: str = "Up 1 second", health: str = "") -> dict[str, Any]:
+    exited = status.startswith("Exited")
+    return {
+        "ID": cid,
+        "Service": f"svc-{cid}",
+        "State": "exited" if exited else "running",
+        "Status": status,
+        "Health": health,
+        "ExitCode": int(status.split("(")[1].split(")")[0]) if exited else 0,
+    }
+
+
+class FakeStream:
+    """events fed by the test, as the daemon would stream them"""
+
+    def __init__(self):
+        self.events: queue.Queue[dict[str, Any] | None] = queue.Queue()
+        self.closed = False
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        while (item := self.events.get()) is not None:
+            yield item
+
+    def close(self):
+        self.closed = True
+        self.events.put(None)
+
+
+class FakeClient:
+    def __init__(self, stream: FakeStream):
+        self.stream = stream
+
+    def events(self, **_: Any) -> FakeStream:
+        return self.stream
+
+
+@pytest.fixture
+def demo(monkeypatch: pytest.MonkeyPatch) -> dict[str, Any]:
+    """fake daemon: events stream, containers states and HTTP probe"""
+    fake: dict[str, Any] = {"stream": FakeStream(), "states": [], "serving": False}
+
+    def get_compose_states(_: Deployment) -> list[dict[str, Any]]:
+        return fake["states"]
+
+    def probe_http(_: Deployment) -> bool:
+        return fake["serving"]
+
+    monkeypatch.setattr(
+        readiness, "get_docker_client", lambda: FakeClient(fake["stream"])
+    )
+    monkeypatch.setattr(readiness, "get_compose_states", get_compose_states)
+    monkeypatch.setattr(readiness, "probe_http", probe_http)
+    return fake
+
+
+def wait(timeout: float = 1) -> readiness.Readiness:
+    return readiness.wait_until_ready(
+        Deployment.using("ted"), since=time.time(), timeout=timeout
+    )
+
+
+def test_ready(demo: dict[str, Any]):
+    for item in (event("a", "start"), event("init", "start")):
+        demo["stream"].events.put(item)
+    # one-off container completing is not a crash
+    demo["stream"].events.put(event("init", "die", exit_code=0))
+    demo["states"] = [state("a", health="healthy"), state("init", "Exited (0) now")]
+    demo["serving"] = True
+    result = wait()
+    assert result.ready, result.reason
+    assert demo["stream"].closed
+
+
+@pytest.mark.parametrize(
+    "events, reason",
+    [
+        (
+            [event("a", "start"), event("a", "die", exit_code=1)],
+            "svc-a die (exit code 1)",
+        ),
+        ([event("a", "start"), event("a", "oom")], "svc-a oom"),
+        ([event("a", "start"), event("a", "health_status: unhealthy")], "unhealthy"),
+    ],
+)
+def test_crash_noticed(demo: dict[str, Any], events: list[dict[str, Any]], reason: str):
+    for item in events:
+        demo["stream"].events.put(item)
+    started_on = time.time()
+    result = wait(timeout=10)
+    assert not result.ready
+    assert reason in result.reason
+    # right away, not at deadline
+    assert time.time() - started_on < 1
+
+
+def test_previous_containers_ignored(demo: dict[str, Any]):
+    # dying container was started before: only new ones are followed
+    demo["stream"].events.put(event("old", "die", exit_code=137))
+    demo["states"] = [state("a")]
+    result = wait(timeout=0.3)
+    assert not result.ready
+    assert result.reason == "not serving after 0.3s"
+
+
+def test_exited_container(demo: dict[str, Any]):
+    demo["states"] = [state("a"), state("b", "Exited (2) 1 second ago")]
+    result = wait()
+    assert (result.ready, result.reason) == (False, "svc-b is exited")
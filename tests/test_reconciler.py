@@ -0,0 +1,81 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+from offspot_demo.constants import OFFSPOT_DEMO_RECONCILE_INTERVAL as INTERVAL
+from offspot_demo.reconciler import (
+    MAX_BACKOFF,
+    RETRY_INTERVAL,
+    UNCHANGED,
+    UPDATED,
+    Reconciler,
+    Schedule,
+)
+from offspot_demo.utils import state
+from offspot_demo.utils.trigger import CONFIG, IMAGE, Trigger
+
+
+def test_schedule():
+    schedule = Schedule()
+    assert schedule.next_on == 0
+
+    # unchanged demos are checked less and less often
+    delays: list[float] = []
+    for now in range(10):
+        schedule.after(UNCHANGED, now)
+        delays.append(schedule.next_on - now)
+    assert delays[0] == INTERVAL
+    assert delays == sorted(delays)
+    assert delays[-1] == INTERVAL * MAX_BACKOFF
+
+    # failures are retried sooner, backing off
+    schedule.after(None, 0)
+    assert schedule.next_on == RETRY_INTERVAL
+    schedule.after(None, 0)
+    assert schedule.next_on == RETRY_INTERVAL * 2
+    for _ in range(10):
+        schedule.after(None, 0)
+    assert schedule.next_on == INTERVAL
+
+    # until it changes again
+    schedule.after(UPDATED, 0)
+    assert (schedule.failures, schedule.next_on) == (0, INTERVAL)
+
+
+def test_triggers_are_deduplicated():
+    async def main():
+        reconciler = Reconciler()
+        reconciler.schedules["ted"] = Schedule(next_on=time.monotonic() + 600)
+        assert reconciler.on_trigger(Trigger(kind=IMAGE, idents=["nope"])) is None
+        assert reconciler.on_trigger(Trigger(kind=IMAGE, idents=["ted"])) == ["ted"]
+        due_on = reconciler.schedules["ted"].next_on
+        assert due_on <= time.monotonic()
+        # already due: not queued again
+        reconciler.on_trigger(Trigger(kind=IMAGE, idents=["ted"]))
+        assert reconciler.schedules["ted"].next_on == due_on
+        # running: reconciled once more after
+        reconciler.running.add("ted")
+        reconciler.on_trigger(Trigger(kind=IMAGE, idents=["ted"]))
+        reconciler.on_trigger(Trigger(kind=IMAGE, idents=["ted"]))
+        assert reconciler.requested == {"ted"}
+
+        assert reconciler.on_trigger(Trigger(kind=CONFIG, idents=[])) == []
+        assert reconciler.config_requested.is_set()
+
+    asyncio.run(main())
+
+
+def test_timed_survives_exits(monkeypatch: pytest.MonkeyPatch):
+    loops: list[tuple[str, str]] = []
+
+    def record_loop(name: str, *args: float | str):
+        loops.append((name, str(args[-1])))
+
+    def exiting():
+        sys.exit(2)
+
+    monkeypatch.setattr(state, "record_loop", record_loop)
+    assert asyncio.run(Reconciler().timed("ted", exiting)) is None
+    assert loops == [("ted", "exited with 2")]
@@ -0,0 +1,58 @@
+from typing import Any
+
+import pytest
+
+from offspot_demo.utils import resources
+from offspot_demo.utils.resources import (
+    RESOURCE_PROFILES,
+    apply_resource_limits,
+    get_resource_limits,
+    parse_bytes,
+)
+
+
+def test_get_resource_limits(monkeypatch: pytest.MonkeyPatch):
+    assert get_resource_limits("large") == RESOURCE_PROFILES["large"]
+    assert get_resource_limits("huge") == RESOURCE_PROFILES["default"]
+    monkeypatch.setattr(resources, "OFFSPOT_DEMO_RESOURCE_PROFILE", "small")
+    assert get_resource_limits() == RESOURCE_PROFILES["small"]
+
+    limits = get_resource_limits(
+        "large",
+        {"mem_limit": "3g", "cpus": "1.5", "pids_limit": "many", "swap": "1g"},
+    )
+    assert (limits.mem_limit, limits.cpus) == ("3g", 1.5)
+    # invalid and unknown overrides are ignored
+    assert limits.pids_limit == RESOURCE_PROFILES["large"].pids_limit
+    assert get_resource_limits("large", {"mem_limit": "lots"}).mem_limit == "2g"
+
+
+def test_parse_bytes():
+    assert parse_bytes("1024") == 2**10
+    assert parse_bytes("512m") == 2**29
+    assert parse_bytes("3GB") == 3 * 2**30
+    assert parse_bytes("1.5g") == 3 * 2**29
+
+
+def test_budget_split_among_services():
+    compose: dict[str, Any] = {
+        "services": {"reverse-proxy": {"image": "caddy"}, "home": {}, "kiwix": {}}
+    }
+    apply_resource_limits(compose, get_resource_limits("large"))
+    for service in compose["services"].values():
+        assert service["cpus"] == 0.67
+        assert service["mem_limit"] == "682m"
+        assert service["pids_limit"] == 341
+        # relative: not split
+        assert service["blkio_config"] == {"weight": 500}
+    assert compose["services"]["reverse-proxy"]["image"] == "caddy"
+
+    # single service gets it all
+    compose = {"services": {"home": {}}}
+    apply_resource_limits(compose, get_resource_limits("small"))
+    assert compose["services"]["home"]["mem_limit"] == "512m"
+
+    # down to a floor
+    tiny = get_resource_limits("small", {"mem_limit": "16m", "cpus": 0.01})
+    assert tiny.split(8).to_compose()["mem_limit"] == "6m"
+    assert tiny.split(8).cpus == 0.01
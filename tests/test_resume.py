@@ -0,0 +1,86 @@
+from pathlib import Path
+
+import pytest
+
+from offspot_demo import resume
+from offspot_demo.constants import Mode
+from offspot_demo.utils import locks
+from offspot_demo.utils.deployment import Deployment
+
+
+def write_prepared(deployment: Deployment):
+    """fake an image and prepared compose (for all replicas) in deployment's slot"""
+    deployment.image_path.parent.mkdir(parents=True, exist_ok=True)
+    deployment.image_path.write_bytes(b"\1")
+    for replica in deployment.replica_deployments:
+        replica.compose_dir.mkdir(parents=True, exist_ok=True)
+        replica.image_compose_path.write_text("services: {}")
+    deployment.mark_prepared()
+
+
+@pytest.mark.usefixtures("host")
+def test_get_unresumable_reason():
+    ted = Deployment.using("ted", settings={"replicas": 2})
+    assert resume.get_unresumable_reason(ted) == "not prepared"
+    ted.mark_prepared()
+    assert resume.get_unresumable_reason(ted) == "no image on disk"
+    write_prepared(ted)
+    assert resume.get_unresumable_reason(ted) == ""
+    ted.replica_deployments[1].image_compose_path.unlink()
+    assert resume.get_unresumable_reason(ted) == "no prepared compose"
+
+
+@pytest.fixture
+def calls(host: Path, monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """host operations resume would run, recorded instead"""
+    calls: list[str] = []
+
+    def attach_image(img_fpath: Path) -> str:
+        locked = locks.LOOP_DEVICES in {holder.name for holder in locks.get_holders()}
+        calls.append(f"attach {img_fpath.parent.parent.name} locked={locked}")
+        return "/dev/loop7"
+
+    def mount_on(dev_path: str, mount_point: Path, filesystem: str) -> bool:
+        calls.append(f"mount {mount_point.parent.name} {dev_path} {filesystem}")
+        return True
+
+    def get_mount_points() -> set[Path]:
+        return {host / "target" / "wiki" / "blue"}
+
+    def toggle_demo(deployment: Deployment, mode: Mode) -> int:
+        calls.append(f"start {deployment.ident} {mode.name}")
+        return 0
+
+    monkeypatch.setattr(resume, "attach_image", attach_image)
+    monkeypatch.setattr(resume, "mount_on", mount_on)
+    monkeypatch.setattr(resume, "get_mount_points", get_mount_points)
+    monkeypatch.setattr(resume, "toggle_demo", toggle_demo)
+    monkeypatch.setattr(resume, "reconfigure_multiproxy", lambda: calls.append("proxy"))
+    return calls
+
+
+def test_resume_all(calls: list[str]):
+    demos = [Deployment.using(ident) for ident in ("ted", "wiki", "off", "down")]
+    for deployment in demos[:-1]:
+        write_prepared(deployment)
+    demos[2].set_hibernated()
+    demos[3].mark_prepared()
+
+    # down has no image: left to update-watcher
+    assert resume.resume_all(demos) == 0
+    # attached under the loop-devices lock ; wiki already mounted
+    assert sorted(calls) == [
+        "attach off locked=True",
+        "attach ted locked=True",
+        "mount off /dev/loop7p3 ext4",
+        "mount ted /dev/loop7p3 ext4",
+        "proxy",
+        "start ted IMAGE",
+        "start wiki IMAGE",
+    ]
+    # hibernated and in-maintenance demos are only mounted
+    calls.clear()
+    demos[0].set_maintenance()
+    assert resume.resume_all(demos[:1]) == 0
+    assert "start ted IMAGE" not in calls
+    assert calls[-1] == "proxy"
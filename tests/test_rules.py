@@ -0,0 +1,185 @@
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from offspot_demo.utils.rules import RuleSet, get_compose_rules
+
+CONTEXT = {
+    "fqdn": "free.demo.test",
+    "orig_fqdn": "generic.hotspot",
+    "target_dir": "/data/demo/data/free",
+    "log_dir": "/var/log/offspot-demo_free",
+    "http_port": 1445,
+    "captive_http_port": 11445,
+    "tls_email": "dev@kiwix.org",
+}
+
+
+def get_compose() -> dict[str, Any]:
+    return {
+        "services": {
+            "reverse-proxy": {
+                "image": "ghcr.io/offspot/reverse-proxy:1.8",
+                "container_name": "reverse-proxy",
+                "cap_add": ["NET_ADMIN"],
+                "ports": ["80:80", "443:443"],
+                "volumes": [
+                    {"type": "bind", "source": "/data/contents", "target": "/data"},
+                    {"type": "bind", "source": "/etc", "target": "/etc"},
+                ],
+                "environment": {
+                    "FQDN": "generic.hotspot",
+                    "SERVICES": "kiwix:kiwix,wikipedia:files",
+                    "FILES_MAPPING": "zim:zim",
+                    "PROTECTED_SERVICES": "generic.hotspot",
+                },
+            },
+            "home": {
+                "image": "ghcr.io/offspot/dashboard:1.0",
+                "privileged": True,
+                "ports": ["8080:80"],
+                "environment": ["URL=http://generic.hotspot/"],
+            },
+            "home-portal": {
+                "image": "ghcr.io/offspot/captive-portal:1.0",
+                "network_mode": "host",
+            },
+            "metrics": {
+                "image": "ghcr.io/offspot/metrics:0.4",
+                "depends_on": {"home": {"condition": "service_healthy"}},
+            },
+        }
+    }
+
+
+def test_default_rules_loaded_once():
+    assert get_compose_rules() is get_compose_rules()
+    assert get_compose_rules().rules
+
+
+def test_default_rules():
+    compose = get_compose()
+    result = get_compose_rules().apply(compose, CONTEXT)
+    proxy = compose["services"]["reverse-proxy"]
+    home = compose["services"]["home"]
+    portal = compose["services"]["home-portal"]
+    metrics = compose["services"]["metrics"]
+
+    assert "container_name" not in proxy
+    assert "cap_add" not in proxy
+    assert proxy["ports"] == ["1445:80"]
+    assert proxy["volumes"] == [
+        {"type": "bind", "source": "/data/demo/data/free/contents", "target": "/data"}
+    ]
+    assert proxy["environment"]["FQDN"] == "free.demo.test"
+    assert proxy["environment"]["PROTECTED_SERVICES"] == "generic.hotspot"
+    assert proxy["environment"]["IS_ONLINE_DEMO"] == "true"
+
+    assert "privileged" not in home
+    assert "ports" not in home
+    assert home["healthcheck"] == {"disable": True}
+    assert home["environment"] == {"URL": "http://free.demo.test/"}
+
+    assert "network_mode" not in portal
+    assert portal["ports"] == ["11445:2080"]
+    assert portal["volumes"] == []
+
+    assert metrics["depends_on"] == {"home": {"condition": "service_started"}}
+
+    # crashes heal on their own
+    assert {service["restart"] for service in compose["services"].values()} == {
+        "on-failure:5"
+    }
+
+    assert result.subdomains == ["kiwix", "wikipedia", "zim"]
+    assert ("reverse-proxy-port", "reverse-proxy", "ports") in result.touches
+    assert ("volumes", "reverse-proxy", "-volumes:/etc") in result.touches
+
+
+def test_replica_rules():
+    compose = get_compose()
+    compose["services"]["home"]["depends_on"] = {"home-portal": {}}
+    compose["services"]["reverse-proxy"]["depends_on"] = ["home", "home-portal"]
+    result = get_compose_rules().apply(compose, {**CONTEXT, "replica": 1})
+
+    # single captive-portal and metrics per demo
+    assert set(compose["services"]) == {"reverse-proxy", "home"}
+    assert "depends_on" not in compose["services"]["home"]
+    assert compose["services"]["reverse-proxy"]["depends_on"] == ["home"]
+    assert ("primary_only", "home-portal", "-service") in result.touches
+    assert ("primary_only", "metrics", "-service") in result.touches
+
+
+def test_rules_matching():
+    rules = RuleSet.from_yaml(
+        """
+rules:
+- name: all
+  remove: [a]
+- name: named
+  services: [one, two]
+  set: {b: "{http_port}"}
+- name: named-image
+  services: [one]
+  images: ["ghcr.io/offspot/"]
+  set: {c: 1}
+"""
+    )
+    assert [rule.name for rule in rules.rules_for("one", "ghcr.io/offspot/x:1")] == [
+        "all",
+        "named",
+        "named-image",
+    ]
+    assert [rule.name for rule in rules.rules_for("one", "docker.io/x:1")] == [
+        "all",
+        "named",
+    ]
+    assert [rule.name for rule in rules.rules_for("three", "")] == ["all"]
+
+
+def test_rules_render_fresh_values():
+    rules = RuleSet.from_yaml(
+        """
+rules:
+- name: ports
+  set: {ports: ["{http_port}:80"]}
+"""
+    )
+    compose: dict[str, Any] = {"services": {"one": {}, "two": {}}}
+    rules.apply(compose, CONTEXT)
+    assert compose["services"]["one"]["ports"] == ["1445:80"]
+    assert (
+        compose["services"]["one"]["ports"] is not compose["services"]["two"]["ports"]
+    )
+
+
+def test_rules_volume_mkdir(tmp_path: Path):
+    rules = RuleSet.from_yaml(
+        """
+rules:
+- name: logs
+  volumes:
+  - {source: /var/log, to: "{log_dir}", mkdir: true}
+"""
+    )
+    compose: dict[str, Any] = {
+        "services": {
+            "one": {
+                "volumes": [
+                    {"source": "/var/log"},
+                    {"source": "/var/log/nested"},
+                ]
+            }
+        }
+    }
+    rules.apply(compose, {"log_dir": tmp_path / "logs"})
+    assert compose["services"]["one"]["volumes"] == [{"source": str(tmp_path / "logs")}]
+    assert tmp_path.joinpath("logs").is_dir()
+
+
+def test_invalid_rule():
+    with pytest.raises(ValueError, match="Unknown key"):
+        RuleSet.from_yaml("rules: [{name: x, unknown: 1}]")
+    with pytest.raises(ValueError, match="Invalid rule"):
+        RuleSet.from_yaml("rules: [{name: x, replace: [{path: a.b}]}]")
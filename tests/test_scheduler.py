@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from offspot_demo.utils.scheduler import (
+    DEFAULT_STAGE_LIMITS,
+    Job,
+    parse_stage_limits,
+    run_jobs,
+    stage,
+)
+
+
+def test_parse_stage_limits():
+    assert parse_stage_limits("") == DEFAULT_STAGE_LIMITS
+    assert parse_stage_limits("network=4, docker=0")["network"] == 4
+    assert parse_stage_limits("docker=0")["docker"] == 1
+    with pytest.raises(ValueError, match="Unknown stage"):
+        parse_stage_limits("gpu=1")
+
+
+def test_jobs_run_concurrently_within_stage_limits():
+    lock = threading.Lock()
+    running: list[int] = [0, 0]  # current, max
+
+    def mount() -> int:
+        with stage("mount"):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            # re-entrant: doesn't wait for another mount slot
+            with stage("mount"):
+                time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        return 0
+
+    def download() -> int:
+        with stage("network"):
+            time.sleep(0.05)
+        return 0
+
+    def broken() -> int:
+        raise RuntimeError("boom")
+
+    def exiting() -> int:
+        raise SystemExit(3)
+
+    jobs = [
+        Job(name="first", func=mount),
+        Job(name="second", func=mount),
+        Job(name="download", func=download),
+        Job(name="broken", func=broken),
+        Job(name="exiting", func=exiting),
+    ]
+    started_on = time.monotonic()
+    run_jobs(jobs, max_parallel=4)
+
+    # mounts (limited to 1) are serialized, download runs alongside
+    assert running[1] == 1
+    assert time.monotonic() - started_on < 0.15
+    assert [job.rc for job in jobs] == [0, 0, 0, 1, 3]
+
+    # second mount waited for the first one
+    waited = sorted(job.timings[0].waited for job in jobs[:2])
+    assert waited[1] >= 0.04
+    assert [timing.stage for timing in jobs[0].timings] == ["mount"]
+    assert "mount" in max(jobs, key=lambda job: job.duration).breakdown()
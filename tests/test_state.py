@@ -0,0 +1,136 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from offspot_demo.utils import state
+
+
+@pytest.fixture(autouse=True)
+def db_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / "state" / "state.sqlite3"
+    monkeypatch.setattr(state, "STATE_DB_PATH", path)
+    return path
+
+
+def test_defaults_without_database(db_path: Path):
+    assert state.get_demos() == []
+    assert state.get_demo("wikipedia") == state.DemoState(ident="wikipedia")
+    assert not state.get_slot("wikipedia", "blue").prepared
+    assert state.get_prepared_idents() == set()
+    # reading never creates the database
+    assert not db_path.exists()
+
+
+def test_slots():
+    state.update_slot("wikipedia", "blue", image_etag="abc", prepared=True)
+    state.update_slot("wikipedia", "blue", subdomains="kiwix,files")
+    state.update_slot("ted", "green", hibernated=True)
+    state.update_demo("wikipedia", active_slot="blue")
+
+    slot = state.get_slot("wikipedia", "blue")
+    assert (slot.image_etag, slot.prepared, slot.subdomains) == (
+        "abc",
+        True,
+        "kiwix,files",
+    )
+    assert state.get_slot("ted", "green").hibernated
+    assert state.get_prepared_idents() == {"wikipedia"}
+    assert [demo.ident for demo in state.get_demos()] == ["ted", "wikipedia"]
+    demo = state.get_demo("wikipedia")
+    assert demo.active == slot
+
+    with pytest.raises(KeyError):
+        state.update_slot("wikipedia", "blue", unknown=1)
+
+    state.clear_slot("wikipedia", "blue")
+    assert state.get_demo("wikipedia").active is None
+    state.remove_demo("ted")
+    assert [demo.ident for demo in state.get_demos()] == ["wikipedia"]
+
+
+def test_phases():
+    for phase in state.IN_PROGRESS_PHASES:
+        state.set_phase("wikipedia", "green", phase)
+    started_on = state.get_slot("wikipedia", "green").started_on
+    state.set_phase("wikipedia", "green", state.SERVING)
+    slot = state.get_slot("wikipedia", "green")
+    assert slot.started_on == started_on
+    assert slot.duration is not None
+    assert slot.phase_since and started_on and slot.phase_since >= started_on
+
+    state.set_phase("wikipedia", "blue", state.PREPARING)
+    state.fail_in_progress("wikipedia", "code 1")
+    failed = state.get_slot("wikipedia", "blue")
+    assert failed.phase == state.FAILED
+    assert failed.last_error == "code 1 (while preparing)"
+    # slot not being deployed is left untouched
+    assert state.get_slot("wikipedia", "green").phase == state.SERVING
+
+    # a new deploy resets error
+    state.set_phase("wikipedia", "blue", state.DOWNLOADING)
+    assert not state.get_slot("wikipedia", "blue").last_error
+
+
+def test_columns_added(db_path: Path):
+    db_path.parent.mkdir(parents=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE demos (ident TEXT PRIMARY KEY, active_slot TEXT, "
+        "last_image_url TEXT NOT NULL DEFAULT '', updated_on REAL)"
+    )
+    conn.execute("INSERT INTO demos (ident, last_image_url) VALUES ('ted', 'url')")
+    conn.commit()
+    conn.close()
+
+    assert state.get_demo("ted").rolled_back_from == ""
+    state.update_demo("ted", rolled_back_from="bad-url")
+    assert state.get_demo("ted").rolled_back_from == "bad-url"
+
+
+def test_import_legacy_files(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    for name in ("IMAGES", "TARGET", "COMPOSE"):
+        monkeypatch.setattr(
+            state, f"OFFSPOT_DEMO_{name}_ROOT_DIR", tmp_path / name.lower()
+        )
+    monkeypatch.setattr(state, "LEGACY_ACTIVE_SLOTS_DIR", tmp_path / "slots")
+
+    def write(path: str, content: str = ""):
+        tmp_path.joinpath(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.joinpath(path).write_text(content)
+
+    write("slots/ted", "green")
+    write("images/ted/last_image", "https://s3/ted-2.img")
+    for slot, url in (
+        ("blue", "https://s3/ted-1.img"),
+        ("green", "https://s3/ted-2.img"),
+    ):
+        write(f"images/ted/{slot}/image.img")
+        write(f"images/ted/{slot}/image.url", url)
+        write(f"images/ted/{slot}/image.etag", f"etag-{slot}")
+        write(f"images/ted/{slot}/verified")
+    write("target/ted/green/prepared.ok")
+    write("target/ted/green/subdomains", "kiwix,edupi")
+    write("compose/ted/green/hibernated")
+
+    # imported on first read
+    assert state.get_prepared_idents() == {"ted"}
+    demo = state.get_demo("ted")
+    assert (demo.active_slot, demo.last_image_url) == ("green", "https://s3/ted-2.img")
+    green, blue = demo.slots["green"], demo.slots["blue"]
+    assert (green.phase, green.image_etag, green.subdomains) == (
+        state.SERVING,
+        "etag-green",
+        "kiwix,edupi",
+    )
+    assert green.prepared and green.verified and green.hibernated
+    assert (blue.phase, blue.image_url, blue.prepared) == (
+        state.RETIRED,
+        "https://s3/ted-1.img",
+        False,
+    )
+
+    # only once
+    state.remove_demo("ted")
+    state.SCHEMA_READY.clear()
+    assert state.get_demos() == []
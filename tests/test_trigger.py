@@ -0,0 +1,67 @@
+import asyncio
+
+import requests
+
+from offspot_demo.utils.trigger import (
+    CONFIG,
+    IMAGE,
+    Trigger,
+    is_authorized,
+    parse_trigger,
+    serve_triggers,
+)
+
+
+def test_parse_trigger():
+    assert parse_trigger("POST", "/config") == Trigger(kind=CONFIG, idents=[])
+    assert parse_trigger("POST", "/images/ted,wikipedia_en,ted?x=1") == Trigger(
+        kind=IMAGE, idents=["ted", "wikipedia_en"]
+    )
+    assert parse_trigger("GET", "/config") is None
+    assert parse_trigger("POST", "/images/") is None
+    assert parse_trigger("POST", "/images/../etc") is None
+
+
+def test_is_authorized():
+    assert is_authorized({"authorization": "Bearer secret"}, "secret")
+    assert not is_authorized({"authorization": "Bearer other"}, "secret")
+    assert not is_authorized({"authorization": "Basic secret"}, "secret")
+    # no token, no trigger
+    assert not is_authorized({"authorization": "Bearer "}, "")
+
+
+def test_server():
+    triggers: list[Trigger] = []
+
+    def handler(trigger: Trigger) -> list[str] | None:
+        triggers.append(trigger)
+        return None if "unknown" in trigger.idents else trigger.idents
+
+    async def main() -> list[int]:
+        server = await serve_triggers(handler, "127.0.0.1", 0, token="secret")
+        port = server.sockets[0].getsockname()[1]
+
+        def post(path: str, token: str = "secret") -> int:
+            return requests.post(
+                f"http://127.0.0.1:{port}{path}",
+                headers={"Authorization": f"Bearer {token}"},
+                data=b"{}",
+                timeout=5,
+            ).status_code
+
+        statuses = [
+            await asyncio.to_thread(post, path, token)
+            for path, token in (
+                ("/images/ted", "secret"),
+                ("/images/ted", "wrong"),
+                ("/images/unknown", "secret"),
+                ("/unknown", "secret"),
+                ("/config", "secret"),
+            )
+        ]
+        server.close()
+        await server.wait_closed()
+        return statuses
+
+    assert asyncio.run(main()) == [202, 401, 404, 404, 202]
+    assert [trigger.kind for trigger in triggers] == [IMAGE, IMAGE, CONFIG]
@@ -0,0 +1,82 @@
+import threading
+from collections.abc import Iterator
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+from offspot_demo import waker
+from offspot_demo.utils import locks
+from offspot_demo.utils.deployment import Deployment
+from offspot_demo.utils.readiness import Readiness
+
+
+@pytest.fixture
+def woken(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """idents demo-waker starts, ted being hibernated"""
+    woken: list[str] = []
+    ted = Deployment.using("ted")
+    ted.set_hibernated()
+
+    def wake_for(deployment: Deployment) -> Readiness:
+        woken.append(deployment.ident)
+        return Readiness(ready=deployment.ident != "broken", duration=1.0)
+
+    monkeypatch.setattr(waker, "OFFSPOT_DEMO_WAKER_TOKEN", "secret")
+    monkeypatch.setattr(waker, "STARTUP_DURATION", 0)
+    monkeypatch.setattr(waker, "wake_for", wake_for)
+    monkeypatch.setattr(
+        waker, "load_configured_deployments", lambda: {"ted": Deployment.using("ted")}
+    )
+    return woken
+
+
+@pytest.fixture
+def url() -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), waker.WakerHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    thread.join()
+
+
+def wake(url: str, ident: str, token: str = "secret") -> int:
+    return requests.get(
+        f"{url}/wake/{ident}",
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=5,
+    ).status_code
+
+
+@pytest.mark.usefixtures("host")
+def test_wake(url: str, woken: list[str]):
+    assert wake(url, "ted", token="wrong") == 401
+    assert wake(url, "unknown") == 404
+    assert woken == []
+
+    assert wake(url, "ted") == 200
+    assert woken == ["ted"]
+    Deployment.using("ted").set_hibernated(hibernated=False)
+    assert wake(url, "ted") == 200
+    assert woken == ["ted"]
+
+
+@pytest.mark.usefixtures("host")
+def test_busy_demo(url: str, woken: list[str]):
+    acquired, release = threading.Event(), threading.Event()
+
+    def deploy():
+        with locks.demo_lock(Deployment.using("ted"), purpose="deploy_for"):
+            acquired.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=deploy)
+    thread.start()
+    assert acquired.wait(5)
+    try:
+        assert wake(url, "ted") == 503
+    finally:
+        release.set()
+        thread.join()
+    assert woken == []